@@ -3,8 +3,74 @@ ASGI config for ByteForge AI project.
 """
 
 import os
+import asyncio
+
+import django
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'byteforge.settings')
 
-application = get_asgi_application()
\ No newline at end of file
+django_application = get_asgi_application()
+
+# Tokenizers are read from the vendored BPE files here, before the first request
+from chat.tokenizers import load_encodings  # noqa: E402
+load_encodings()
+
+
+async def _watch_disconnect(receive, body_read, disconnected):
+    """After Django has read the body, wait for the client to go away."""
+    await body_read.wait()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def _with_disconnect_watch(scope, receive, send):
+    """
+    Run a Django HTTP request with scope['disconnected'] set once the client goes away.
+
+    Django 4.2 stops reading from the connection once the body is in, and the
+    server silently drops writes to a closed connection, so without this a
+    streaming response never learns that nobody is listening.
+    """
+    disconnected = asyncio.Event()
+    body_read = asyncio.Event()
+    scope = dict(scope, disconnected=disconnected)
+
+    async def tracked_receive():
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+        elif not message.get('more_body'):
+            body_read.set()
+        return message
+
+    watcher = asyncio.ensure_future(_watch_disconnect(receive, body_read, disconnected))
+    try:
+        await django_application(scope, tracked_receive, send)
+    finally:
+        watcher.cancel()
+
+
+async def application(scope, receive, send):
+    """Django ASGI app plus lifespan handling (warms upstream connections and the model catalog at worker boot)."""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                from asgiref.sync import sync_to_async
+                from chat.catalog import model_catalog
+                from chat.clients import aprewarm
+                await aprewarm()
+                await sync_to_async(model_catalog.warm)()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] == 'http' and django.VERSION < (5, 0):
+        # Django 5 listens for disconnects itself
+        await _with_disconnect_watch(scope, receive, send)
+        return
+    await django_application(scope, receive, send)
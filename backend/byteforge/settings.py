@@ -247,6 +247,153 @@ SOCIAL_AUTH_NEW_USER_REDIRECT_URL = SOCIAL_AUTH_LOGIN_REDIRECT_URL
 # AI Configuration — OpenRouter (single key for 400+ models)
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY', '')
 
+# Shared OpenRouter connection pool (one per worker process)
+OPENROUTER_POOL_MAX_CONNECTIONS = int(os.getenv('OPENROUTER_POOL_MAX_CONNECTIONS', 100))
+OPENROUTER_POOL_MAX_KEEPALIVE = int(os.getenv('OPENROUTER_POOL_MAX_KEEPALIVE', 20))
+OPENROUTER_POOL_KEEPALIVE_EXPIRY = float(os.getenv('OPENROUTER_POOL_KEEPALIVE_EXPIRY', 60))
+OPENROUTER_HTTP2 = os.getenv('OPENROUTER_HTTP2', 'False').lower() == 'true'
+
+# Hedged streams: if the first token is slow, race the next healthy fallback model.
+# LLM_HEDGE_DELAY is 'p90' (observed TTFT of the selected model) or a number of seconds.
+LLM_HEDGE_STREAMS = os.getenv('LLM_HEDGE_STREAMS', 'False').lower() == 'true'
+LLM_HEDGE_DELAY = os.getenv('LLM_HEDGE_DELAY', 'p90')
+LLM_HEDGE_FALLBACK_DELAY = float(os.getenv('LLM_HEDGE_FALLBACK_DELAY', 2.0))
+
+# Model routing policy: 'pinned' (the user's pick, then the best fallbacks), 'fastest' or
+# 'cheapest' (cheapest model with a TTFT p90 under LLM_ROUTER_MAX_P90 seconds); see chat.router
+LLM_ROUTER_POLICY = os.getenv('LLM_ROUTER_POLICY', 'pinned')
+LLM_ROUTER_MAX_P90 = float(os.getenv('LLM_ROUTER_MAX_P90', 3.0))
+LLM_ROUTER_REFERENCE_TOKENS = int(os.getenv('LLM_ROUTER_REFERENCE_TOKENS', 500))
+# Routing decisions are logged at DEBUG as JSON lines, to stderr or to LLM_ROUTER_LOG_FILE.
+# Off unless LLM_ROUTER_LOG is set or a log file is given.
+LLM_ROUTER_LOG_FILE = os.getenv('LLM_ROUTER_LOG_FILE', '')
+LLM_ROUTER_LOG = os.getenv('LLM_ROUTER_LOG', 'False').lower() == 'true' or bool(LLM_ROUTER_LOG_FILE)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json_lines': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'router_decisions': (
+            {'class': 'logging.FileHandler', 'filename': LLM_ROUTER_LOG_FILE, 'formatter': 'json_lines'}
+            if LLM_ROUTER_LOG_FILE else
+            {'class': 'logging.StreamHandler', 'formatter': 'json_lines'}
+        ),
+    },
+    'loggers': {
+        'chat.router.decisions': {
+            'handlers': ['router_decisions'],
+            'level': 'DEBUG' if LLM_ROUTER_LOG else 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# End-to-end deadlines (seconds) per endpoint, shared by every retry and fallback attempt
+LLM_DEADLINES = {
+    'default': float(os.getenv('LLM_DEADLINE_DEFAULT', 120)),
+    'send': float(os.getenv('LLM_DEADLINE_SEND', 60)),
+    'stream': float(os.getenv('LLM_DEADLINE_STREAM', 180)),
+    'compare': float(os.getenv('LLM_DEADLINE_COMPARE', 180)),
+    'batch': float(os.getenv('LLM_DEADLINE_BATCH', 300)),
+    'background': float(os.getenv('LLM_DEADLINE_BACKGROUND', 60)),
+}
+# Stream timeouts: connecting, waiting for the first token, and the longest gap between tokens
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', 5))
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv('LLM_FIRST_TOKEN_TIMEOUT', 30))
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv('LLM_STREAM_IDLE_TIMEOUT', 30))
+
+# Longest answer per persona; answers are also capped by the conversation's remaining
+# tokens and the model's output and context limits (see chat.context.completion_budget)
+LLM_PERSONA_MAX_TOKENS = {
+    'general': int(os.getenv('LLM_MAX_TOKENS_GENERAL', 2000)),
+    'developer': int(os.getenv('LLM_MAX_TOKENS_DEVELOPER', 4000)),
+    'creative': int(os.getenv('LLM_MAX_TOKENS_CREATIVE', 3000)),
+    'analyst': int(os.getenv('LLM_MAX_TOKENS_ANALYST', 3000)),
+}
+
+# Usage ledger: one row per upstream call, written in batches off the request path
+LLM_USAGE_FLUSH_SIZE = int(os.getenv('LLM_USAGE_FLUSH_SIZE', 200))
+LLM_USAGE_FLUSH_INTERVAL = float(os.getenv('LLM_USAGE_FLUSH_INTERVAL', 2.0))
+LLM_USAGE_MAX_PENDING = int(os.getenv('LLM_USAGE_MAX_PENDING', 10000))
+
+# Exact-match LLM response cache (per worker process, shared across users).
+# Only deterministic calls use it: temperature 0 and templated batch prompts.
+LLM_RESPONSE_CACHE_ENABLED = os.getenv('LLM_RESPONSE_CACHE_ENABLED', 'False').lower() == 'true'
+LLM_RESPONSE_CACHE_TTL = int(os.getenv('LLM_RESPONSE_CACHE_TTL', 3600))
+LLM_RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('LLM_RESPONSE_CACHE_MAX_ENTRIES', 1000))
+LLM_RESPONSE_CACHE_MAX_BYTES = int(os.getenv('LLM_RESPONSE_CACHE_MAX_BYTES', 20 * 1024 * 1024))
+
+# Conversation titles are generated in the background with a cheap model, batched
+LLM_TITLE_MODEL = os.getenv('LLM_TITLE_MODEL', 'google/gemini-2.0-flash-001')
+LLM_TITLE_BATCH_WINDOW = float(os.getenv('LLM_TITLE_BATCH_WINDOW', 0.5))
+LLM_TITLE_MAX_BATCH = int(os.getenv('LLM_TITLE_MAX_BATCH', 8))
+LLM_TITLE_PUSH_WAIT = float(os.getenv('LLM_TITLE_PUSH_WAIT', 5))
+
+# Rolling summaries: once unsummarized history passes the trigger, older turns are folded
+# into Conversation.summary in the background, keeping the most recent turns verbatim
+LLM_SUMMARY_ENABLED = os.getenv('LLM_SUMMARY_ENABLED', 'True').lower() == 'true'
+LLM_SUMMARY_MODEL = os.getenv('LLM_SUMMARY_MODEL', LLM_TITLE_MODEL)
+LLM_SUMMARY_TRIGGER_TOKENS = int(os.getenv('LLM_SUMMARY_TRIGGER_TOKENS', 6000))
+LLM_SUMMARY_KEEP_RECENT_TOKENS = int(os.getenv('LLM_SUMMARY_KEEP_RECENT_TOKENS', 2000))
+LLM_SUMMARY_CHUNK_TOKENS = int(os.getenv('LLM_SUMMARY_CHUNK_TOKENS', 6000))
+LLM_SUMMARY_MAX_WORDS = int(os.getenv('LLM_SUMMARY_MAX_WORDS', 300))
+
+# Pre-generation stages (RAG lookup, history) run concurrently; RAG that misses its deadline is
+# dropped, history is always waited for
+LLM_CONTEXT_WORKERS = int(os.getenv('LLM_CONTEXT_WORKERS', 8))
+LLM_CONTEXT_RAG_TIMEOUT = float(os.getenv('LLM_CONTEXT_RAG_TIMEOUT', 1.5))           # Seconds
+
+# Provider prompt caching: cache_control breakpoints for models that need them (comma-separated prefixes)
+LLM_PROMPT_CACHE_ENABLED = os.getenv('LLM_PROMPT_CACHE_ENABLED', 'True').lower() == 'true'
+LLM_PROMPT_CACHE_BREAKPOINT_MODELS = [
+    prefix.strip() for prefix in os.getenv('LLM_PROMPT_CACHE_BREAKPOINT_MODELS', 'anthropic/,google/gemini-2.5').split(',')
+    if prefix.strip()
+]
+
+# Resumable streams: partial answers are checkpointed every N tokens or M seconds
+LLM_STREAM_CHECKPOINT_TOKENS = int(os.getenv('LLM_STREAM_CHECKPOINT_TOKENS', 50))
+LLM_STREAM_CHECKPOINT_INTERVAL = float(os.getenv('LLM_STREAM_CHECKPOINT_INTERVAL', 1.0))
+LLM_STREAM_SESSION_TTL = int(os.getenv('LLM_STREAM_SESSION_TTL', 60))          # Keep finished sessions for late reconnects
+LLM_STREAM_STALE_AFTER = int(os.getenv('LLM_STREAM_STALE_AFTER', 30))          # Give up following a checkpoint that stopped moving
+LLM_STREAM_DISCONNECT_GRACE = float(os.getenv('LLM_STREAM_DISCONNECT_GRACE', 5))  # Wait for a resume before cancelling upstream
+# Token frames are coalesced: flushed every window or once this many bytes are pending (first token goes out at once)
+LLM_STREAM_COALESCE_WINDOW = float(os.getenv('LLM_STREAM_COALESCE_WINDOW', 0.03))
+LLM_STREAM_COALESCE_BYTES = int(os.getenv('LLM_STREAM_COALESCE_BYTES', 256))
+
+# Upstream scheduler: concurrent LLM calls per worker process and per user, with a bounded
+# priority queue (paid > interactive > background) that sheds load past the latency target
+LLM_SCHEDULER_MAX_CONCURRENCY = int(os.getenv('LLM_SCHEDULER_MAX_CONCURRENCY', 32))
+LLM_SCHEDULER_MAX_PER_USER = int(os.getenv('LLM_SCHEDULER_MAX_PER_USER', 3))
+LLM_SCHEDULER_MAX_QUEUE = int(os.getenv('LLM_SCHEDULER_MAX_QUEUE', 100))
+LLM_SCHEDULER_QUEUE_TARGET = float(os.getenv('LLM_SCHEDULER_QUEUE_TARGET', 10))       # Seconds
+LLM_SCHEDULER_BACKGROUND_MAX_WAIT = float(os.getenv('LLM_SCHEDULER_BACKGROUND_MAX_WAIT', 300))
+
+# Model catalog: shared OpenRouter model list, served stale and refreshed in the background after this many seconds
+LLM_CATALOG_TTL = int(os.getenv('LLM_CATALOG_TTL', 600))
+
+# Model comparison (/api/chat/compare/): most models per request and max_tokens per model
+LLM_COMPARE_MAX_MODELS = int(os.getenv('LLM_COMPARE_MAX_MODELS', 4))
+LLM_COMPARE_MAX_TOKENS = int(os.getenv('LLM_COMPARE_MAX_TOKENS', 2000))
+
+# Batch jobs: items per job, concurrent calls per worker process (at background priority), how often
+# a running job records a heartbeat, and seconds without one before another worker picks it up
+LLM_BATCH_MAX_ITEMS = int(os.getenv('LLM_BATCH_MAX_ITEMS', 1000))
+LLM_BATCH_CONCURRENCY = int(os.getenv('LLM_BATCH_CONCURRENCY', 4))
+LLM_BATCH_HEARTBEAT_INTERVAL = int(os.getenv('LLM_BATCH_HEARTBEAT_INTERVAL', 30))
+LLM_BATCH_STALL_AFTER = int(os.getenv('LLM_BATCH_STALL_AFTER', 300))
+
+# Prometheus metrics at /metrics, served only to scrapers sending `Authorization: Bearer <METRICS_TOKEN>`.
+# Set PROMETHEUS_MULTIPROC_DIR (wiped at startup) to aggregate gunicorn workers.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR', '')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Tokenizers: tiktoken BPE files are vendored here at build time (manage.py vendor_tokenizers)
+TIKTOKEN_CACHE_DIR = os.getenv('TIKTOKEN_CACHE_DIR', str(BASE_DIR / 'chat' / 'tokenizer_data'))
+# Refuse to start the server without the vendored tokenizers (character estimates otherwise)
+TIKTOKEN_REQUIRED = os.getenv('TIKTOKEN_REQUIRED', str(not DEBUG)).lower() == 'true'
+
 # Token Configuration
 DEFAULT_TOKEN_LIMIT = 20000
 TOKEN_TOP_UP_AMOUNT = 10000
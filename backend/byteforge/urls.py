@@ -8,11 +8,14 @@ from django.conf.urls.static import static
 
 from django.http import HttpResponse
 
+from chat.views import metrics_view
+
 def home(request):
     return HttpResponse("ByteForge AI Backend is running!")
 
 urlpatterns = [
     path('', home),
+    path('metrics', metrics_view, name='metrics'),
     path('admin/', admin.site.urls),
     path('api/auth/', include('authentication.urls')),
     path('api/chat/', include('chat.urls')),
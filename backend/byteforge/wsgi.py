@@ -7,4 +7,8 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'byteforge.settings')
 
-application = get_wsgi_application()
\ No newline at end of file
+application = get_wsgi_application()
+
+# Tokenizers are read from the vendored BPE files here, before the first request
+from chat.tokenizers import load_encodings  # noqa: E402
+load_encodings()
\ No newline at end of file
@@ -3,17 +3,30 @@ AI Provider Module — Powered by OpenRouter
 Single API key → 400+ models (GPT, Claude, Gemini, Llama, Mistral, DeepSeek, etc.)
 
 Production-ready with:
-  - Automatic retry with exponential backoff
+  - Automatic retry with jittered exponential backoff
   - Smart model fallback chain on rate limits
+  - Shared model health registry (circuit breaker honouring Retry-After)
+  - Exact-match response cache with single-flight for identical requests
+  - End-to-end deadlines shared by every retry and fallback attempt
   - Free model rotation to spread load
 """
 
 import time
+import asyncio
 import logging
+from decimal import Decimal
 from typing import List, Dict, Tuple, Optional
 from django.conf import settings
 import openai
 
+from . import clients, metrics, router, tokenizers
+from .prompt_cache import with_breakpoints, prompt_cache_stats, cached_tokens
+from .deadlines import Deadline, DeadlineExceeded, StreamTimeout, first_token_timeout, idle_timeout
+from .health import model_health, backoff_delay, parse_retry_after, MAX_INLINE_WAIT
+from .response_cache import response_cache, areplay
+from .catalog import model_catalog
+from .tasks import usage_ledger
+
 logger = logging.getLogger(__name__)
 
 # Fallback chain: if selected model is rate-limited, try these in order
@@ -32,34 +45,46 @@ FALLBACK_MODELS = [
     'deepseek/deepseek-r1-distill-llama-70b:free', # Free
 ]
 
+# Errors worth a quick jittered retry on the same model
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.InternalServerError, StreamTimeout)
+TIMEOUT_ERRORS = (openai.APITimeoutError, StreamTimeout)
+
+# Sampling temperature for chat; calls at 0 are deterministic enough to cache
+DEFAULT_TEMPERATURE = 0.7
+
 
 class AIProvider:
     """Base class for AI providers."""
     
-    def count_tokens(self, text: str) -> int:
-        """Estimate token count (1 token ≈ 4 characters)."""
-        return len(text) // 4 if text else 0
+    model_name = None
+
+    def count_tokens(self, text: str, cache: bool = False) -> int:
+        """Token count for this provider's model (see chat.tokenizers); cache=True for repeated prompt parts."""
+        return tokenizers.count_tokens(text, self.model_name, cache=cache)
 
-    def generate_response(self, messages: List[Dict[str, str]], max_tokens: int = 4096) -> Tuple[str, int, int]:
-        """Generate response and return (text, prompt_tokens, completion_tokens)."""
+    def generate_response(self, messages: List[Dict[str, str]], max_tokens: int = 4096, deadline=None,
+                          call=None) -> Tuple[str, int, int]:
+        """Generate response and return (text, prompt_tokens, completion_tokens) within the deadline."""
         raise NotImplementedError
 
-    def truncate_context(self, messages: List[Dict], max_tokens: int, reserve_for_response: int = 1000) -> List[Dict]:
-        """Truncate message history to fit within token limit."""
+    def truncate_context(self, messages: List[Dict], max_tokens: int, reserve_for_response: int = 1000,
+                         model: str = None) -> List[Dict]:
+        """Truncate message history to fit within token limit, counted for `model` (default: this provider's)."""
         available_tokens = max_tokens - reserve_for_response
         if available_tokens <= 0:
             return []
+        model = model or self.model_name
         
         truncated = []
         current_tokens = 0
         
         # Last message = current user prompt — always included
         user_prompt = messages[-1]
-        user_tokens = user_prompt.get('tokens_used') or self.count_tokens(user_prompt.get('content', ''))
+        user_tokens = user_prompt.get('tokens_used') or tokenizers.count_tokens(user_prompt.get('content', ''), model)
         
         # System instruction
         system_instr = messages[0] if messages[0]['role'] == 'system' else None
-        system_tokens = self.count_tokens(system_instr['content']) if system_instr else 0
+        system_tokens = tokenizers.count_tokens(system_instr['content'], model, cache=True) if system_instr else 0
         
         available_tokens -= (user_tokens + system_tokens)
         
@@ -67,12 +92,15 @@ class AIProvider:
         history = messages[1:-1] if system_instr else messages[:-1]
         
         for message in reversed(history):
-            message_tokens = message.get('tokens_used') or (self.count_tokens(message.get('content', '')) + 4)
+            message_tokens = message.get('tokens_used') or (
+                tokenizers.count_tokens(message.get('content', ''), model, cache=True) + 4
+            )
             if current_tokens + message_tokens <= available_tokens:
-                truncated.insert(0, message)
+                truncated.append(message)
                 current_tokens += message_tokens
             else:
                 break
+        truncated.reverse()
         
         final_messages = []
         if system_instr:
@@ -82,17 +110,27 @@ class AIProvider:
         
         return final_messages
 
-    def generate_title(self, first_message: str) -> str:
-        """Generate a title for the conversation."""
-        prompt_msg = [
-            {"role": "user", "content": f"Generate a short (max 5 words) conversation title for: '{first_message}'. Respond ONLY with the title."}
-        ]
-        try:
-            title, _, _ = self.generate_response(prompt_msg, max_tokens=20)
-            return title.strip().strip('"')[:100]
-        except Exception as e:
-            logger.error(f"Title Gen Error: {e}")
-            return first_message[:50] + "..." if len(first_message) > 50 else first_message
+
+class UpstreamCall:
+    """
+    Per-call state, passed down through every attempt: who the usage ledger
+    bills, the sampling temperature, the routing decision, and the usage the
+    provider reported (set once a stream completes). Calls on one provider can
+    run concurrently, so none of this lives on the provider.
+
+    Only deterministic calls may use the response cache: temperature 0, or
+    templated prompts (cacheable=True) where the caller accepts a repeated answer.
+    """
+    
+    def __init__(self, endpoint: str = '', user_id: int = None, conversation_id: int = None,
+                 temperature: float = DEFAULT_TEMPERATURE, cacheable: bool = None):
+        self.endpoint = endpoint
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.temperature = temperature
+        self.cacheable = temperature == 0 if cacheable is None else cacheable
+        self.route = None   # router.RouteDecision, set when the call starts
+        self.usage = None   # Provider-reported usage of the completed stream
 
 
 class OpenRouterProvider(AIProvider):
@@ -101,49 +139,170 @@ class OpenRouterProvider(AIProvider):
     Single API key → 400+ models with automatic retry and fallback.
     """
     
-    MAX_RETRIES = 3          # Max retries per model
-    INITIAL_BACKOFF = 2      # Seconds before first retry
+    MAX_RETRIES = 3          # Max attempts per model
+    INITIAL_BACKOFF = 0.5    # Jittered backoff base (seconds) for transient errors
+    MIN_HEDGE_DELAY = 0.5    # Never hedge sooner than this (seconds)
     
-    def __init__(self, model_name='openai/gpt-4o'):
+    def __init__(self, model_name='openai/gpt-4o', routing=None):
         self.api_key = getattr(settings, 'OPENROUTER_API_KEY', None)
         self.model_name = model_name
-        if self.api_key:
-            self.client = openai.OpenAI(
-                base_url='https://openrouter.ai/api/v1',
-                api_key=self.api_key,
-                default_headers={
-                    'HTTP-Referer': getattr(settings, 'FRONTEND_URL', 'http://localhost:3000'),
-                    'X-Title': 'ByteForge AI',
-                }
-            )
-        else:
-            self.client = None
+        self.routing = routing   # Router policy (None: LLM_ROUTER_POLICY)
+
+    @property
+    def client(self):
+        """Shared keep-alive client (one connection pool per process)."""
+        return clients.get_openai_client() if self.api_key else None
+
+    @property
+    def async_client(self):
+        """Shared async client for the running event loop (ASGI streaming path)."""
+        return clients.get_async_openai_client() if self.api_key else None
+
+    def _clean_messages(self, messages: List[Dict[str, str]]) -> list:
+        """Only send role + content (strip internal fields like tokens_used)."""
+        return [
+            {'role': msg['role'], 'content': msg['content']}
+            for msg in messages
+            if msg.get('content')
+        ]
+
+    def _fit_window(self, model: str, clean_messages: list, max_tokens: int):
+        """
+        Messages and max_tokens for one model of the chain. The prompt is packed for
+        the selected model; if a fallback's context window is smaller, the oldest
+        history is dropped and the answer capped to fit it.
+        """
+        window = model_catalog.context_window(model)
+        if window is None:
+            return clean_messages, max_tokens
+        prompt_tokens = tokenizers.count_messages_tokens(clean_messages, model)
+        if prompt_tokens + max_tokens <= window:
+            return clean_messages, max_tokens
+        # Shrink the answer to what the window leaves, but keep at least a quarter of it for the answer
+        max_tokens = min(max_tokens, max(window // 4, window - prompt_tokens))
+        packed = self.truncate_context(clean_messages, window - max_tokens, reserve_for_response=0, model=model)
+        logger.info(f"Re-packed the prompt for '{model}' ({window}-token window): "
+                    f"{len(clean_messages)} -> {len(packed)} messages, max_tokens {max_tokens}")
+        return packed, max_tokens
 
-    def _call_api(self, model: str, clean_messages: list, max_tokens: int):
-        """Make a single API call with retry logic."""
+    def _models_to_try(self) -> router.RouteDecision:
+        """
+        Fallback chain for one call: the selected model and the fallbacks, ordered by the routing
+        policy (see chat.router). The decision is per call and travels in its UpstreamCall.
+        """
+        return router.route(self.model_name, FALLBACK_MODELS, self.routing)
+
+    def _record_usage(self, model: str, call: UpstreamCall, status: str = 'ok',
+                      latency: float = None, ttft: float = None, usage=None, prompt_tokens: int = 0,
+                      completion_tokens: int = 0):
+        """Queue a usage ledger row for one upstream call; reported usage wins over the given estimates."""
+        if usage is not None:
+            prompt_tokens = usage.prompt_tokens or 0
+            completion_tokens = usage.completion_tokens or 0
+        cost = None
+        entry = model_catalog.lookup(model)
+        if entry and entry.get('prompt_price') is not None and entry.get('completion_price') is not None:
+            dollars = (prompt_tokens * entry['prompt_price'] + completion_tokens * entry['completion_price']) / 1_000_000
+            cost = Decimal(f"{dollars:.8f}")
+        chain = call.route.order if call.route is not None else [self.model_name]
+        usage_ledger.record(
+            user_id=call.user_id,
+            conversation_id=call.conversation_id,
+            endpoint=call.endpoint,
+            model=model,
+            requested_model=self.model_name,
+            fallback_depth=chain.index(model) if model in chain else 0,
+            status=status,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cached_tokens=cached_tokens(usage),
+            estimated=usage is None and status in ('ok', 'cancelled'),
+            latency_ms=round(latency * 1000) if latency is not None else None,
+            ttft_ms=round(ttft * 1000) if ttft is not None else None,
+            cost=cost,
+        )
+
+    def _retry_delay(self, model: str, error: Exception, attempt: int, call: UpstreamCall,
+                     kind: str = 'complete', ledger: bool = True) -> Optional[float]:
+        """
+        Record a failed attempt in the health registry, metrics and (unless the caller already
+        wrote its row) the usage ledger, and decide whether to retry the same model.
+        Returns the seconds to wait before retrying, or None to move on.
+        """
+        delay = self._next_delay(model, error, attempt)
+        metrics.observe_failure(model, kind, isinstance(error, openai.RateLimitError))
+        if ledger:
+            self._record_usage(model, call, 'rate_limited' if isinstance(error, openai.RateLimitError) else 'error')
+        if delay is not None:
+            metrics.RETRIES.labels(model).inc()
+        return delay
+
+    def _deadline_cut(self, model: str, error: Exception, deadline: Deadline, call: UpstreamCall,
+                      kind: str = 'complete') -> bool:
+        """
+        True if the attempt timed out because the request's deadline ran out (every attempt's
+        timeouts are capped by it). That says nothing about the model, so it is recorded as a
+        'deadline' outcome and doesn't count towards the model's circuit.
+        """
+        if not (isinstance(error, TIMEOUT_ERRORS) and deadline.expired):
+            return False
+        metrics.observe_deadline(model, kind)
+        self._record_usage(model, call, 'deadline')
+        return True
+
+    def _next_delay(self, model: str, error: Exception, attempt: int) -> Optional[float]:
+        can_retry = attempt + 1 < self.MAX_RETRIES
+        if isinstance(error, openai.RateLimitError):
+            retry_after = parse_retry_after(error)
+            model_health.record_rate_limit(model, retry_after)
+            # Only wait in-request for a short, explicit Retry-After; otherwise fall back right away
+            if can_retry and retry_after is not None and retry_after <= MAX_INLINE_WAIT:
+                return retry_after + backoff_delay(0, self.INITIAL_BACKOFF)
+            return None
+        
+        model_health.record_error(model)
+        if can_retry and isinstance(error, TRANSIENT_ERRORS):
+            return backoff_delay(attempt, self.INITIAL_BACKOFF)
+        return None
+
+    def _observe_success(self, model: str, kind: str, latency: float, call: UpstreamCall, usage=None,
+                         ttft=None, completion_tokens=None, prompt_tokens=None):
+        metrics.observe_success(model, kind, latency, usage, ttft, completion_tokens)
+        self._record_usage(model, call, 'ok', latency, ttft, usage, prompt_tokens or 0, completion_tokens or 0)
+        if model != self.model_name:
+            metrics.FALLBACKS.labels(model, kind).inc()
+        if call.route is not None:
+            call.route.served(model, kind, latency, ttft, completion_tokens)
+
+    def _call_api(self, model: str, clean_messages: list, max_tokens: int, deadline: Deadline, call: UpstreamCall):
+        """Make a single API call with retry logic, each attempt bounded by what is left of the deadline."""
         last_error = None
         
         for attempt in range(self.MAX_RETRIES):
+            deadline.check()
+            started = time.monotonic()
             try:
                 response = self.client.chat.completions.create(
                     model=model,
-                    messages=clean_messages,
+                    messages=with_breakpoints(model, clean_messages),
                     max_tokens=max_tokens,
-                    temperature=0.7,
+                    temperature=call.temperature,
+                    timeout=deadline.http_timeout(),
                 )
+                latency = time.monotonic() - started
                 
                 content = response.choices[0].message.content
                 usage = response.usage
-                prompt_tokens = usage.prompt_tokens if usage else self.count_tokens(str(clean_messages))
-                completion_tokens = usage.completion_tokens if usage else self.count_tokens(content)
+                if usage:
+                    tokenizers.observe_usage(model, clean_messages, usage.prompt_tokens)
+                    prompt_cache_stats.record(model, usage, latency)
+                prompt_tokens = usage.prompt_tokens if usage else tokenizers.count_messages_tokens(clean_messages, model)
+                completion_tokens = usage.completion_tokens if usage else tokenizers.count_tokens(content, model)
+                model_health.record_success(model, latency, tokens_per_second=completion_tokens / latency if latency > 0 else None)
+                self._observe_success(model, 'complete', latency, call, usage, completion_tokens=completion_tokens,
+                                      prompt_tokens=prompt_tokens)
                 return content, prompt_tokens, completion_tokens
                 
-            except openai.RateLimitError as e:
-                last_error = e
-                wait_time = self.INITIAL_BACKOFF * (2 ** attempt)  # 2s, 4s, 8s
-                logger.warning(f"Rate limit on '{model}' (attempt {attempt+1}/{self.MAX_RETRIES}). Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-                
             except openai.AuthenticationError as e:
                 logger.error(f"OpenRouter Auth Error: {e}")
                 raise Exception("OpenRouter API key is invalid. Please check your OPENROUTER_API_KEY in .env.")
@@ -153,43 +312,58 @@ class OpenRouterProvider(AIProvider):
                 raise  # Don't retry bad requests — model doesn't exist or similar
                 
             except Exception as e:
+                if self._deadline_cut(model, e, deadline, call):
+                    raise DeadlineExceeded(deadline.budget) from e
                 last_error = e
-                logger.error(f"API error on '{model}': {e}")
-                break  # Don't retry unknown errors
+                wait_time = self._retry_delay(model, e, attempt, call)
+                if wait_time is None or not deadline.allows(wait_time):
+                    logger.warning(f"API error on '{model}' ({type(e).__name__}): {e}. Moving on.")
+                    break
+                logger.warning(f"API error on '{model}' (attempt {attempt+1}/{self.MAX_RETRIES}). Retrying in {wait_time:.1f}s...")
+                time.sleep(wait_time)
         
         # If we get here, retries were exhausted
         raise last_error or Exception(f"Failed to get response from '{model}'")
 
-    def generate_response(self, messages: List[Dict[str, str]], max_tokens: int = 4096):
+    def generate_response(self, messages: List[Dict[str, str]], max_tokens: int = 4096, deadline: Deadline = None,
+                          call: UpstreamCall = None):
+        """
+        Generate a response, served from the exact-match cache when possible.
+        Raises DeadlineExceeded if the deadline (LLM_DEADLINES['default'] if not given) runs out.
+        """
+        if deadline is None:
+            deadline = Deadline.for_endpoint('default')
+        if call is None:
+            call = UpstreamCall()
+        if not (response_cache.enabled and call.cacheable):
+            return self._generate_response(messages, max_tokens, deadline, call)
+        key = response_cache.make_key(self.model_name, messages, max_tokens)
+        return response_cache.call(key, lambda: self._generate_response(messages, max_tokens, deadline, call))
+
+    def _generate_response(self, messages: List[Dict[str, str]], max_tokens: int, deadline: Deadline, call: UpstreamCall):
         if not self.client:
             raise Exception(
                 "OpenRouter API key not configured. "
                 "Get one at https://openrouter.ai/keys and add OPENROUTER_API_KEY to your .env file."
             )
         
-        # Clean messages — only send role + content (strip internal fields like tokens_used)
-        clean_messages = [
-            {'role': msg['role'], 'content': msg['content']}
-            for msg in messages
-            if msg.get('content')
-        ]
-        
-        # Build fallback chain: selected model first, then fallbacks (skip duplicates)
-        models_to_try = [self.model_name]
-        for fb in FALLBACK_MODELS:
-            if fb != self.model_name:
-                models_to_try.append(fb)
+        clean_messages = self._clean_messages(messages)
+        call.route = self._models_to_try()
         
         last_error = None
-        for i, model in enumerate(models_to_try):
+        for i, model in enumerate(call.route.order):
+            deadline.check()
             try:
                 if i > 0:
                     logger.info(f"Falling back to model: {model}")
-                result = self._call_api(model, clean_messages, max_tokens)
+                result = self._call_api(model, *self._fit_window(model, clean_messages, max_tokens), deadline, call)
                 if i > 0:
                     logger.info(f"Fallback to '{model}' succeeded!")
                 return result
                 
+            except DeadlineExceeded:
+                raise
+                
             except openai.RateLimitError as e:
                 last_error = e
                 logger.warning(f"Model '{model}' rate-limited after retries. Trying next fallback...")
@@ -212,92 +386,304 @@ class OpenRouterProvider(AIProvider):
             "Tip: Add credits at https://openrouter.ai to unlock higher rate limits."
         )
 
-    def _stream_api(self, model: str, clean_messages: list, max_tokens: int):
-        """Make a streaming API call with retry logic. Yields token chunks."""
+    def _record_cancelled(self, model: str, call: UpstreamCall, clean_messages: list, started: float,
+                          ttft, usage, chunks: int):
+        """Ledger row for a stream closed before it finished."""
+        prompt_tokens = tokenizers.count_messages_tokens(clean_messages, model) if usage is None else 0
+        self._record_usage(model, call, 'cancelled', time.monotonic() - started, ttft, usage, prompt_tokens, chunks)
+
+    def _record_stream_success(self, model: str, call: UpstreamCall, clean_messages: list, usage,
+                               started: float, ttft, chunks: int):
+        """Health, metrics, tokenizer calibration and prompt cache stats for a completed stream."""
+        latency = time.monotonic() - started
+        call.usage = usage
+        generating = latency - (ttft or 0)
+        # Without reported usage, content chunks are a close stand-in for completion tokens
+        completion_tokens = usage.completion_tokens if usage and usage.completion_tokens else chunks
+        model_health.record_success(model, latency, ttft, completion_tokens / generating if generating > 0 else None)
+        prompt_tokens = usage.prompt_tokens if usage else tokenizers.count_messages_tokens(clean_messages, model)
+        self._observe_success(model, 'stream', latency, call, usage, ttft, completion_tokens=completion_tokens,
+                              prompt_tokens=prompt_tokens)
+        if usage:
+            tokenizers.observe_usage(model, clean_messages, usage.prompt_tokens)
+            prompt_cache_stats.record(model, usage, latency, ttft)
+
+    async def _astream_api(self, model: str, clean_messages: list, max_tokens: int, deadline: Deadline,
+                           call: UpstreamCall):
+        """
+        Make a streaming API call with retry logic. Yields token chunks without blocking the event loop.
+        Waits at most the first-token timeout for the first token and the idle timeout
+        between tokens (never past the deadline).
+        """
         last_error = None
         
         for attempt in range(self.MAX_RETRIES):
+            deadline.check()
+            started = time.monotonic()
+            ttft = None
             try:
-                stream = self.client.chat.completions.create(
+                stream = await self.async_client.chat.completions.create(
                     model=model,
-                    messages=clean_messages,
+                    messages=with_breakpoints(model, clean_messages),
                     max_tokens=max_tokens,
-                    temperature=0.7,
+                    temperature=call.temperature,
                     stream=True,
+                    stream_options={'include_usage': True},
+                    timeout=deadline.http_timeout(read=first_token_timeout()),
                 )
                 
-                # If we get here, the stream was established successfully
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        yield chunk.choices[0].delta.content
+                usage = None
+                chunks = 0
+                chunk_iter = stream.__aiter__()
+                try:
+                    while True:
+                        limit = first_token_timeout() if ttft is None else idle_timeout()
+                        try:
+                            chunk = await asyncio.wait_for(chunk_iter.__anext__(), deadline.cap(limit))
+                        except StopAsyncIteration:
+                            break
+                        except asyncio.TimeoutError:
+                            deadline.check()
+                            what = 'first token' if ttft is None else 'next token'
+                            raise StreamTimeout(f"No {what} from '{model}' within {limit:g}s")
+                        if chunk.usage:
+                            usage = chunk.usage
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if ttft is None:
+                                ttft = time.monotonic() - started
+                            chunks += 1
+                            yield chunk.choices[0].delta.content
+                except (asyncio.CancelledError, GeneratorExit):
+                    # Closed early (client gone, budget used up, hedge lost): the tokens so far still count
+                    self._record_cancelled(model, call, clean_messages, started, ttft, usage, chunks)
+                    raise
+                finally:
+                    await stream.close()
+                self._record_stream_success(model, call, clean_messages, usage, started, ttft, chunks)
                 return  # Stream completed successfully
                 
-            except openai.RateLimitError as e:
-                last_error = e
-                wait_time = self.INITIAL_BACKOFF * (2 ** attempt)
-                logger.warning(f"Stream rate limit on '{model}' (attempt {attempt+1}/{self.MAX_RETRIES}). Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-                
             except openai.AuthenticationError as e:
                 raise Exception("OpenRouter API key is invalid.")
                 
             except openai.BadRequestError as e:
                 raise
                 
+            except DeadlineExceeded:
+                raise
+                
             except Exception as e:
+                if self._deadline_cut(model, e, deadline, call, 'stream'):
+                    raise DeadlineExceeded(deadline.budget) from e
                 last_error = e
-                break
+                stalled = ttft is not None and isinstance(e, StreamTimeout)
+                if stalled:
+                    # Went quiet after sending tokens: those were delivered, so they count as for a disconnect
+                    self._record_cancelled(model, call, clean_messages, started, ttft, usage, chunks)
+                wait_time = self._retry_delay(model, e, attempt, call, 'stream', ledger=not stalled)
+                if ttft is not None or wait_time is None or not deadline.allows(wait_time):
+                    break  # Tokens already sent, or not worth retrying this model
+                logger.warning(f"Stream error on '{model}' (attempt {attempt+1}/{self.MAX_RETRIES}). Retrying in {wait_time:.1f}s...")
+                await asyncio.sleep(wait_time)
         
         raise last_error or Exception(f"Failed to stream from '{model}'")
 
-    def generate_response_stream(self, messages: List[Dict[str, str]], max_tokens: int = 4096):
+    async def agenerate_response_stream(self, messages: List[Dict[str, str]], max_tokens: int = 4096, hedge: bool = False,
+                                        deadline: Deadline = None, call: UpstreamCall = None):
         """
-        Stream response tokens one-by-one. Yields string chunks.
-        Includes automatic model fallback on rate limits.
+        Stream response tokens for the ASGI streaming path. Yields string chunks,
+        falling back across models on rate limits, within the deadline.
+        With hedge=True, a slow first token triggers a parallel request to the next healthy model.
+        Provider-reported usage lands in call.usage (None when served from the cache).
         """
-        if not self.client:
+        if not self.async_client:
             raise Exception("OpenRouter API key not configured.")
+        if deadline is None:
+            deadline = Deadline.for_endpoint('stream')
+        if call is None:
+            call = UpstreamCall()
         
-        clean_messages = [
-            {'role': msg['role'], 'content': msg['content']}
-            for msg in messages
-            if msg.get('content')
-        ]
+        clean_messages = self._clean_messages(messages)
         
-        # Build fallback chain
-        models_to_try = [self.model_name]
-        for fb in FALLBACK_MODELS:
-            if fb != self.model_name:
-                models_to_try.append(fb)
+        # Exact-match cache: replay a cached answer, or share an identical in-flight stream
+        cache_key = future = None
+        if response_cache.enabled and call.cacheable:
+            cache_key = response_cache.make_key(self.model_name, messages, max_tokens)
+            cached = response_cache.get(cache_key)
+            if cached is None:
+                future, leader = response_cache.begin(cache_key)
+                if not leader:
+                    cached = await response_cache.await_leader(future)
+                    future = None  # The leader owns the in-flight entry
+            if cached is not None:
+                async for chunk in areplay(cached[0]):
+                    yield chunk
+                return
         
-        last_error = None
+        call.route = self._models_to_try()
+        if hedge and len(call.route.order) > 1:
+            stream = self._ahedged_stream(clean_messages, max_tokens, call, deadline)
+        else:
+            stream = self._astream_chain(clean_messages, max_tokens, call, deadline)
+        
+        parts = []
+        try:
+            async for token in stream:
+                parts.append(token)
+                yield token
+        except Exception as e:
+            if future is not None:
+                response_cache.finish(cache_key, future, error=e)
+            raise
+        except BaseException:
+            # Closed early (client gone, budget used up): the followers still want a whole answer
+            if future is not None:
+                response_cache.finish(cache_key, future, error=Exception('Leader cancelled'))
+            raise
+        finally:
+            await stream.aclose()
+        
+        if future is not None:
+            text = ''.join(parts)
+            value = (text, tokenizers.count_messages_tokens(clean_messages, self.model_name), self.count_tokens(text)) if text else None
+            response_cache.finish(cache_key, future, value)
+
+    async def astream_model(self, messages: List[Dict[str, str]], max_tokens: int = 4096, deadline: Deadline = None,
+                            call: UpstreamCall = None):
+        """
+        Stream from the selected model only: no fallback, hedging or response cache
+        (comparisons must show what that model said). Usage lands in call.usage.
+        """
+        if not self.async_client:
+            raise Exception("OpenRouter API key not configured.")
+        if deadline is None:
+            deadline = Deadline.for_endpoint('stream')
+        if call is None:
+            call = UpstreamCall()
+        
+        clean_messages, max_tokens = self._fit_window(self.model_name, self._clean_messages(messages), max_tokens)
+        async for token in self._astream_api(self.model_name, clean_messages, max_tokens, deadline, call):
+            yield token
+
+    async def _astream_chain(self, clean_messages: list, max_tokens: int, call: UpstreamCall, deadline: Deadline,
+                             models_to_try: List[str] = None, last_error=None):
+        """Stream from the first model in the chain (the route's order by default) that works before the deadline."""
+        if models_to_try is None:
+            models_to_try = call.route.order
         for i, model in enumerate(models_to_try):
+            deadline.check()
+            started = False
             try:
                 if i > 0:
                     logger.info(f"Stream fallback to: {model}")
-                yield from self._stream_api(model, clean_messages, max_tokens)
+                async for token in self._astream_api(model, *self._fit_window(model, clean_messages, max_tokens), deadline, call):
+                    started = True
+                    yield token
                 return  # Success
                 
+            except DeadlineExceeded:
+                raise
             except openai.RateLimitError:
                 last_error = Exception(f"Rate limited on {model}")
                 continue
             except openai.BadRequestError:
                 continue
             except Exception as e:
-                if "API key is invalid" in str(e):
-                    raise
+                if "API key is invalid" in str(e) or started:
+                    raise  # Auth errors, or tokens already sent to the client
                 last_error = e
                 continue
         
         raise last_error or Exception("All models rate-limited. Please wait and try again.")
 
+    def _hedge_delay(self, model: str) -> float:
+        """How long to wait for the primary's first token before hedging (observed p90 TTFT by default)."""
+        configured = getattr(settings, 'LLM_HEDGE_DELAY', 'p90')
+        if configured == 'p90':
+            delay = model_health.ttft_percentile(model, 0.9)
+            if delay is None:
+                delay = getattr(settings, 'LLM_HEDGE_FALLBACK_DELAY', 2.0)
+        else:
+            delay = float(configured)
+        return max(self.MIN_HEDGE_DELAY, delay)
+
+    async def _ahedged_stream(self, clean_messages: list, max_tokens: int, call: UpstreamCall, deadline: Deadline):
+        """
+        Race the primary model against the next healthy fallback.
+        The hedge only starts if the primary has not produced a token within the hedge delay;
+        whichever lane yields first wins and the other request is cancelled.
+        """
+        models_to_try = call.route.order
+        delay = self._hedge_delay(models_to_try[0])
+        lanes = {}  # first-token task -> (model, generator)
+        
+        def start_lane(model):
+            gen = self._astream_api(model, *self._fit_window(model, clean_messages, max_tokens), deadline, call)
+            lanes[asyncio.ensure_future(gen.__anext__())] = (model, gen)
+        
+        start_lane(models_to_try[0])
+        hedged = False
+        winner = None
+        last_error = None
+        try:
+            while lanes and winner is None:
+                done, _ = await asyncio.wait(
+                    set(lanes),
+                    timeout=None if hedged else delay,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    logger.info(f"No first token from '{models_to_try[0]}' after {delay:.1f}s. Hedging with '{models_to_try[1]}'")
+                    start_lane(models_to_try[1])
+                    hedged = True
+                    continue
+                for task in done:
+                    model, gen = lanes.pop(task)
+                    try:
+                        winner = (model, gen, task.result())
+                    except StopAsyncIteration:
+                        winner = (model, gen, None)  # Finished without content
+                    except Exception as e:
+                        if "API key is invalid" in str(e) or isinstance(e, DeadlineExceeded):
+                            raise
+                        last_error = e
+                        await gen.aclose()
+                        continue
+                    break
+        finally:
+            # Cancel the losing request(s)
+            for task, (model, gen) in lanes.items():
+                task.cancel()
+                try:
+                    await task
+                except BaseException:
+                    pass
+                await gen.aclose()
+                logger.info(f"Cancelled hedge loser '{model}'")
+        
+        if winner is None:
+            # Both lanes failed before their first token: continue with the regular chain
+            remaining = models_to_try[2 if hedged else 1:]
+            async for token in self._astream_chain(clean_messages, max_tokens, call, deadline, remaining, last_error):
+                yield token
+            return
+        
+        model, gen, first = winner
+        if hedged and model != models_to_try[0]:
+            logger.info(f"Hedge won: streaming from '{model}'")
+        try:
+            if first is not None:
+                yield first
+                async for token in gen:
+                    yield token
+        finally:
+            await gen.aclose()
+
     @staticmethod
     def fetch_available_models():
         """Fetch the list of available models from OpenRouter API."""
-        import requests as http_requests
         try:
-            response = http_requests.get(
-                'https://openrouter.ai/api/v1/models',
+            response = clients.get_http_client().get(
+                f'{clients.OPENROUTER_BASE_URL}/models',
                 timeout=10
             )
             if response.status_code == 200:
@@ -310,6 +696,7 @@ class OpenRouterProvider(AIProvider):
                     name = model.get('name', model_id)
                     pricing = model.get('pricing', {})
                     context_length = model.get('context_length', 0)
+                    max_completion_tokens = (model.get('top_provider') or {}).get('max_completion_tokens')
                     
                     # Cost per 1M tokens
                     prompt_cost = float(pricing.get('prompt', 0)) * 1_000_000 if pricing.get('prompt') else None
@@ -333,6 +720,9 @@ class OpenRouterProvider(AIProvider):
                         'name': name,
                         'provider': provider,
                         'context_length': context_length,
+                        'max_completion_tokens': max_completion_tokens,
+                        'prompt_price': prompt_cost,
+                        'completion_price': completion_cost,
                         'is_free': is_free,
                         'pricing': {
                             'prompt': f"${prompt_cost:.2f}/1M" if prompt_cost is not None else 'N/A',
@@ -367,6 +757,6 @@ class AIServiceFactory:
     ]
 
     @staticmethod
-    def get_service(provider_id: str = None, model_id: str = None):
+    def get_service(provider_id: str = None, model_id: str = None, routing: str = None):
         """Get an AI service. Everything goes through OpenRouter with automatic fallback."""
-        return OpenRouterProvider(model_id or 'openai/gpt-4o-mini')
+        return OpenRouterProvider(model_id or 'openai/gpt-4o-mini', routing)
@@ -0,0 +1,288 @@
+"""
+Shared OpenRouter model catalog.
+
+The model list lives in a single ModelCatalog row, so every worker serves the
+same copy and it is fetched once per refresh, not once per process. Each
+worker also keeps the list in memory and only checks the row's ETag every few
+seconds.
+
+Once the list is older than LLM_CATALOG_TTL it is still served as-is while
+one worker refreshes it in the background. Only the worker that claims the
+row's refresh lock calls OpenRouter (single flight). A failed refresh keeps
+the old list, and the lock's expiry spaces out the retries. Only the very first
+fetch makes requests wait: one worker fetches, the rest poll for its result.
+"""
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+REFRESH_LOCK = 60          # Seconds a refresh claim holds before another worker may retry
+COLD_WAIT = 10             # Longest wait for another worker's first fetch
+LOCAL_CHECK_INTERVAL = 5   # Seconds between row checks for the in-memory copy
+
+# Served when no OpenRouter key is configured
+LEGACY_MODELS = [
+    {'id': 'gemini-flash-latest', 'name': 'Gemini 1.5 Flash', 'provider': 'gemini'},
+    {'id': 'gemini-pro-latest', 'name': 'Gemini 1.5 Pro', 'provider': 'gemini'},
+    {'id': 'gemini-2.0-flash', 'name': 'Gemini 2.0 Flash', 'provider': 'gemini'},
+    {'id': 'claude-3-5-sonnet-20240620', 'name': 'Claude 3.5 Sonnet', 'provider': 'anthropic'},
+    {'id': 'gpt-4o', 'name': 'GPT-4o', 'provider': 'openai'},
+    {'id': 'gpt-3.5-turbo', 'name': 'GPT-3.5 Turbo', 'provider': 'openai'},
+]
+
+
+def _etag(models):
+    return hashlib.sha1(json.dumps(models, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _curate(models):
+    """Mark featured models and sort: featured first, then by provider, then by name."""
+    from .ai_providers import AIServiceFactory
+
+    featured_ids = {m['id'] for m in AIServiceFactory.FEATURED_MODELS}
+    for model in models:
+        model['featured'] = model['id'] in featured_ids
+    models.sort(key=lambda m: (not m.get('featured', False), m.get('provider', 'zzz'), m.get('name', '')))
+    return models
+
+
+class Catalog:
+    """Snapshot of the model list served to clients."""
+
+    def __init__(self, models, etag, source, fetched_at=None):
+        self.models = models
+        self.etag = etag
+        self.source = source
+        self.fetched_at = fetched_at
+        self._index = None
+
+    def find(self, model_id):
+        """The entry for a model id, or None."""
+        if self._index is None:
+            self._index = {m['id']: m for m in self.models}
+        return self._index.get(model_id)
+
+
+class ModelCatalogStore:
+    """Reads the shared catalog row and keeps it fresh."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = None
+        self._checked_at = 0.0
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'LLM_CATALOG_TTL', 600)
+
+    def get(self):
+        """The current catalog. Never blocks on OpenRouter once a list has been fetched."""
+        if not getattr(settings, 'OPENROUTER_API_KEY', ''):
+            return Catalog(LEGACY_MODELS, _etag(LEGACY_MODELS), 'legacy')
+
+        local = self._local
+        if local is not None and time.monotonic() - self._checked_at < LOCAL_CHECK_INTERVAL:
+            return local
+
+        from .models import ModelCatalog
+
+        row = ModelCatalog.objects.filter(pk=1).only('etag', 'fetched_at').first()
+        if row is None or row.fetched_at is None:
+            return self._cold_fetch()
+
+        if local is None or local.etag != row.etag:
+            entries = ModelCatalog.objects.values_list('entries', flat=True).get(pk=1)
+            local = Catalog(entries, row.etag, 'openrouter', row.fetched_at)
+        self._local = local
+        self._checked_at = time.monotonic()
+
+        if timezone.now() - row.fetched_at > timedelta(seconds=self.ttl) and self._claim():
+            threading.Thread(target=self._refresh_in_background, name='model-catalog', daemon=True).start()
+        return local
+
+    def lookup(self, model_id, load=None):
+        """
+        Catalog entry for a model, or None if it is not listed. Never calls OpenRouter.
+
+        With `load`, the stored row is read when this worker holds no list yet or
+        has not checked the row's ETag for a few seconds, so a refresh by another
+        worker shows up here too. By default it loads except on the event loop,
+        which uses the list the worker holds (warmed at startup, see warm()).
+        """
+        if load is None:
+            load = not _on_event_loop()
+        catalog = self._stored() if load else self._local
+        return catalog.find(model_id) if catalog is not None else None
+
+    def warm(self):
+        """Load the stored list at worker startup, so lookups on the event loop have it."""
+        try:
+            self._stored()
+        except Exception as e:
+            logger.warning(f"Could not load the model catalog at startup: {e}")
+
+    def _stored(self):
+        """This worker's list, re-read from the row if it has changed since the last check."""
+        local = self._local
+        if local is not None and time.monotonic() - self._checked_at < LOCAL_CHECK_INTERVAL:
+            return local
+        if not getattr(settings, 'OPENROUTER_API_KEY', ''):
+            return local
+
+        from .models import ModelCatalog
+
+        row = ModelCatalog.objects.filter(pk=1, fetched_at__isnull=False).only('etag', 'fetched_at').first()
+        if row is None:
+            return local
+        if local is None or local.etag != row.etag:
+            entries = ModelCatalog.objects.values_list('entries', flat=True).get(pk=1)
+            local = Catalog(entries, row.etag, 'openrouter', row.fetched_at)
+        self._local = local
+        self._checked_at = time.monotonic()
+        return local
+
+    def context_window(self, model_id, load=None):
+        """The model's context length in tokens, or None if the catalog does not know it."""
+        entry = self.lookup(model_id, load)
+        return (entry or {}).get('context_length') or None
+
+    def _claim(self):
+        """Take the refresh lock on the row. True for exactly one worker per lock period."""
+        from .models import ModelCatalog
+
+        now = timezone.now()
+        ModelCatalog.objects.get_or_create(pk=1)
+        expired = now - timedelta(seconds=REFRESH_LOCK)
+        return bool(
+            ModelCatalog.objects.filter(pk=1)
+            .filter(Q(refreshing_since__isnull=True) | Q(refreshing_since__lt=expired))
+            .update(refreshing_since=now)
+        )
+
+    def _refresh(self):
+        """Fetch from OpenRouter and store the result. Returns the new Catalog, or None on failure."""
+        from .ai_providers import OpenRouterProvider
+        from .models import ModelCatalog
+
+        models = OpenRouterProvider.fetch_available_models()
+        if not models:
+            logger.warning("Model catalog refresh failed; keeping the previous list")
+            # Keep the claim for the retry backoff, but age it so cold waiters stop waiting
+            backdated = timezone.now() - timedelta(seconds=COLD_WAIT)
+            ModelCatalog.objects.filter(pk=1).update(refreshing_since=backdated)
+            return None
+
+        models = _curate(models)
+        etag = _etag(models)
+        now = timezone.now()
+        ModelCatalog.objects.filter(pk=1).update(entries=models, etag=etag, fetched_at=now, refreshing_since=None)
+        logger.info(f"Model catalog refreshed: {len(models)} models")
+        return Catalog(models, etag, 'openrouter', now)
+
+    def _refresh_in_background(self):
+        try:
+            catalog = self._refresh()
+            if catalog is not None:
+                self._local = catalog
+                self._checked_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Model catalog refresh error: {e}")
+        finally:
+            close_old_connections()
+
+    def _cold_fetch(self):
+        """First fetch: one worker calls OpenRouter, the others wait for its result."""
+        from .ai_providers import AIServiceFactory
+        from .models import ModelCatalog
+
+        with self._lock:
+            if self._local is not None:
+                return self._local
+
+            catalog = self._refresh() if self._claim() else None
+            deadline = time.monotonic() + COLD_WAIT
+            while catalog is None and time.monotonic() < deadline:
+                row = ModelCatalog.objects.filter(pk=1, fetched_at__isnull=False).first()
+                if row is not None:
+                    catalog = Catalog(row.entries, row.etag, 'openrouter', row.fetched_at)
+                    break
+                fetching_since = timezone.now() - timedelta(seconds=COLD_WAIT)
+                if not ModelCatalog.objects.filter(pk=1, refreshing_since__gt=fetching_since).exists():
+                    break
+                time.sleep(0.25)
+
+            if catalog is None:
+                # No list yet: offer the featured models until a fetch succeeds
+                featured = [dict(m) for m in AIServiceFactory.FEATURED_MODELS]
+                return Catalog(featured, _etag(featured), 'featured')
+
+            self._local = catalog
+            self._checked_at = time.monotonic()
+            return catalog
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _is_subsequence(term, text):
+    chars = iter(text)
+    return all(char in chars for char in term)
+
+
+def _match_score(model, terms):
+    """Fuzzy match of all search terms against name and id. None if any term misses."""
+    haystack = f"{model.get('name', '')} {model.get('id', '')}".lower()
+    score = 0.0
+    for term in terms:
+        position = haystack.find(term)
+        if position == 0:
+            score += 3
+        elif position > 0:
+            score += 2 if not haystack[position - 1].isalnum() else 1
+        elif _is_subsequence(term, haystack):
+            score += 0.25
+        else:
+            return None
+    return score
+
+
+def search(models, provider=None, free=None, min_context=None, query=None):
+    """
+    Filter the catalog. `provider` is a set of provider names, `free` a bool,
+    `min_context` a token count and `query` a fuzzy name search (results are
+    then ordered by match quality, ties keeping the catalog order).
+    """
+    results = models
+    if provider:
+        results = [m for m in results if m.get('provider') in provider]
+    if free is not None:
+        results = [m for m in results if bool(m.get('is_free')) == free]
+    if min_context:
+        results = [m for m in results if (m.get('context_length') or 0) >= min_context]
+    if query:
+        terms = query.lower().split()
+        scored = [(_match_score(m, terms), m) for m in results]
+        scored = [(score, m) for score, m in scored if score is not None]
+        scored.sort(key=lambda item: -item[0])
+        results = [m for _, m in scored]
+    return results
+
+
+# Process-wide store
+model_catalog = ModelCatalogStore()
@@ -0,0 +1,233 @@
+"""
+Shared upstream HTTP clients for OpenRouter.
+
+Every OpenRouterProvider used to build its own openai.OpenAI client, which
+meant a fresh connection pool (and TLS handshake) per message. This module
+keeps one keep-alive pool per process instead:
+  - Thread-safe lazy creation, rebuilt in the child after a fork
+  - Tunable pool limits and optional HTTP/2 (requires the `h2` package)
+  - One async pool per event loop for the ASGI streaming path
+  - Pre-warming at worker boot and pool statistics for monitoring
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import weakref
+
+import httpx
+import openai
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+OPENROUTER_BASE_URL = 'https://openrouter.ai/api/v1'
+
+_lock = threading.Lock()
+_sync_clients = {}                              # name -> client
+_async_clients = weakref.WeakKeyDictionary()   # event loop -> {name: client}
+_stats = {'requests': 0, 'responses': 0, 'created_at': None, 'prewarmed_at': None}
+
+
+def _reset_after_fork():
+    """Drop inherited clients in a forked child; their sockets belong to the parent."""
+    global _lock, _sync_clients, _async_clients
+    _lock = threading.Lock()
+    _sync_clients = {}
+    _async_clients = weakref.WeakKeyDictionary()
+    _stats.update({'requests': 0, 'responses': 0, 'created_at': None, 'prewarmed_at': None})
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=getattr(settings, 'OPENROUTER_POOL_MAX_CONNECTIONS', 100),
+        max_keepalive_connections=getattr(settings, 'OPENROUTER_POOL_MAX_KEEPALIVE', 20),
+        keepalive_expiry=getattr(settings, 'OPENROUTER_POOL_KEEPALIVE_EXPIRY', 60.0),
+    )
+
+
+def _default_timeout():
+    """Backstop for calls made without a deadline (requests normally pass their own, see chat.deadlines)."""
+    budget = getattr(settings, 'LLM_DEADLINES', {}).get('default', 120.0)
+    return httpx.Timeout(budget, connect=getattr(settings, 'LLM_CONNECT_TIMEOUT', 5.0))
+
+
+def _http2_enabled():
+    if not getattr(settings, 'OPENROUTER_HTTP2', False):
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("OPENROUTER_HTTP2 is enabled but the 'h2' package is not installed. Using HTTP/1.1.")
+        return False
+    return True
+
+
+def _default_headers():
+    return {
+        'HTTP-Referer': getattr(settings, 'FRONTEND_URL', 'http://localhost:3000'),
+        'X-Title': 'ByteForge AI',
+    }
+
+
+def _count_request(request):
+    _stats['requests'] += 1
+
+
+def _count_response(response):
+    _stats['responses'] += 1
+
+
+async def _acount_request(request):
+    _stats['requests'] += 1
+
+
+async def _acount_response(response):
+    _stats['responses'] += 1
+
+
+def get_http_client() -> httpx.Client:
+    """Process-wide keep-alive HTTP client for OpenRouter."""
+    client = _sync_clients.get('http')
+    if client is None:
+        with _lock:
+            client = _sync_clients.get('http')
+            if client is None:
+                client = httpx.Client(
+                    limits=_limits(),
+                    http2=_http2_enabled(),
+                    timeout=_default_timeout(),
+                    follow_redirects=True,
+                    event_hooks={'request': [_count_request], 'response': [_count_response]},
+                )
+                _sync_clients['http'] = client
+                _stats['created_at'] = time.time()
+                logger.info(f"Created OpenRouter connection pool (pid={os.getpid()})")
+    return client
+
+
+def get_openai_client() -> openai.OpenAI:
+    """Process-wide OpenAI-compatible client bound to the shared pool."""
+    client = _sync_clients.get('openai')
+    if client is None:
+        http_client = get_http_client()
+        with _lock:
+            client = _sync_clients.get('openai')
+            if client is None:
+                client = openai.OpenAI(
+                    base_url=OPENROUTER_BASE_URL,
+                    api_key=getattr(settings, 'OPENROUTER_API_KEY', ''),
+                    default_headers=_default_headers(),
+                    http_client=http_client,
+                    max_retries=0,  # The providers retry themselves, within the request deadline
+                )
+                _sync_clients['openai'] = client
+    return client
+
+
+def _loop_clients():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.get(loop)
+        if clients is None:
+            clients = {}
+            _async_clients[loop] = clients
+    return clients
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Keep-alive async HTTP client for the running event loop."""
+    clients = _loop_clients()
+    client = clients.get('http')
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=_limits(),
+            http2=_http2_enabled(),
+            timeout=_default_timeout(),
+            follow_redirects=True,
+            event_hooks={'request': [_acount_request], 'response': [_acount_response]},
+        )
+        clients['http'] = client
+    return client
+
+
+def get_async_openai_client() -> openai.AsyncOpenAI:
+    """Async OpenAI-compatible client for the running event loop."""
+    clients = _loop_clients()
+    client = clients.get('openai')
+    if client is None:
+        client = openai.AsyncOpenAI(
+            base_url=OPENROUTER_BASE_URL,
+            api_key=getattr(settings, 'OPENROUTER_API_KEY', ''),
+            default_headers=_default_headers(),
+            http_client=get_async_http_client(),
+            max_retries=0,  # The providers retry themselves, within the request deadline
+        )
+        clients['openai'] = client
+    return client
+
+
+def prewarm():
+    """Open a keep-alive connection to OpenRouter so the first request skips the TLS handshake."""
+    if not getattr(settings, 'OPENROUTER_API_KEY', ''):
+        return
+    try:
+        get_http_client().head(f'{OPENROUTER_BASE_URL}/models', timeout=5)
+        _stats['prewarmed_at'] = time.time()
+    except Exception as e:
+        logger.warning(f"OpenRouter pre-warm failed: {e}")
+
+
+async def aprewarm():
+    """Pre-warm both the async pool of the running loop and the sync pool."""
+    if not getattr(settings, 'OPENROUTER_API_KEY', ''):
+        return
+    try:
+        await asyncio.gather(
+            get_async_http_client().head(f'{OPENROUTER_BASE_URL}/models', timeout=5),
+            asyncio.to_thread(prewarm),
+        )
+        _stats['prewarmed_at'] = time.time()
+    except Exception as e:
+        logger.warning(f"OpenRouter async pre-warm failed: {e}")
+
+
+def _pool_info(client):
+    """Best-effort connection counts from the underlying httpcore pool."""
+    pool = getattr(getattr(client, '_transport', None), '_pool', None)
+    connections = list(getattr(pool, 'connections', []) or [])
+    idle = sum(1 for conn in connections if getattr(conn, 'is_idle', lambda: False)())
+    return {
+        'connections': len(connections),
+        'idle': idle,
+        'active': len(connections) - idle,
+    }
+
+
+def pool_stats():
+    """Snapshot of the shared pools for this process."""
+    stats = {
+        'pid': os.getpid(),
+        'created_at': _stats['created_at'],
+        'prewarmed_at': _stats['prewarmed_at'],
+        'requests': _stats['requests'],
+        'responses': _stats['responses'],
+        'limits': {
+            'max_connections': getattr(settings, 'OPENROUTER_POOL_MAX_CONNECTIONS', 100),
+            'max_keepalive_connections': getattr(settings, 'OPENROUTER_POOL_MAX_KEEPALIVE', 20),
+            'keepalive_expiry': getattr(settings, 'OPENROUTER_POOL_KEEPALIVE_EXPIRY', 60.0),
+            'http2': _http2_enabled(),
+        },
+        'sync_pool': _pool_info(_sync_clients['http']) if 'http' in _sync_clients else None,
+        'async_pools': [
+            _pool_info(clients['http'])
+            for clients in list(_async_clients.values())
+            if 'http' in clients
+        ],
+    }
+    return stats
@@ -0,0 +1,121 @@
+"""
+Side-by-side model comparison.
+
+The same assembled prompt is sent to several models at once and their answers
+are multiplexed onto one event stream, every event tagged with its model. Each
+model takes its own upstream slot and its own max_tokens, and streams without
+fallback, so a model that fails shows up as an error rather than as another
+model's answer. TTFT, throughput and token usage are reported per model with
+its result.
+"""
+import time
+import asyncio
+import logging
+
+from .ai_providers import UpstreamCall
+from .prompt_cache import cached_tokens
+from .scheduler import scheduler, UpstreamOverloaded
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRun:
+    """One model's answer and timings within a comparison."""
+
+    def __init__(self, service, max_tokens=None):
+        self.service = service
+        self.model = service.model_name
+        self.max_tokens = max_tokens
+        self.call = UpstreamCall('compare')   # Ledger scope and the usage the model reported
+        self.parts = []
+        self.started = None
+        self.ttft = None
+        self.duration = None
+        self.error = None
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    @property
+    def completion_tokens(self):
+        usage = self.call.usage
+        if usage is not None and usage.completion_tokens is not None:
+            return usage.completion_tokens
+        return self.service.count_tokens(self.text) if self.parts else 0
+
+    def stats(self):
+        usage = self.call.usage
+        completion_tokens = self.completion_tokens
+        generating = (self.duration or 0) - (self.ttft or 0)
+        return {
+            'ttft': round(self.ttft, 3) if self.ttft is not None else None,
+            'duration': round(self.duration, 3) if self.duration is not None else None,
+            'tokens_per_second': round(completion_tokens / generating, 1) if self.ttft is not None and generating > 0 else None,
+            'prompt_tokens': usage.prompt_tokens if usage is not None else None,
+            'completion_tokens': completion_tokens,
+            'cached_tokens': cached_tokens(usage),
+        }
+
+
+async def _run_model(run, messages, user_id, priority, deadline, queue):
+    try:
+        lease = await scheduler.aacquire(user_id, priority)
+    except UpstreamOverloaded as e:
+        run.error = str(e)
+        queue.put_nowait({'type': 'model_error', 'model': run.model, 'message': str(e), 'retry_after': e.retry_after})
+        return
+
+    try:
+        run.started = time.monotonic()
+        async for token in run.service.astream_model(messages, max_tokens=run.max_tokens, deadline=deadline,
+                                                  call=run.call):
+            if run.ttft is None:
+                run.ttft = time.monotonic() - run.started
+            run.parts.append(token)
+            queue.put_nowait({'type': 'token', 'model': run.model, 'content': token})
+        run.duration = time.monotonic() - run.started
+        queue.put_nowait({'type': 'model_done', 'model': run.model, 'content': run.text, 'stats': run.stats()})
+    except Exception as e:
+        logger.error(f"Compare stream error on '{run.model}': {e}")
+        run.error = str(e)
+        queue.put_nowait({'type': 'model_error', 'model': run.model, 'message': str(e)})
+    finally:
+        scheduler.release(lease)
+
+
+async def compare_stream(runs, messages, user_id, priority, deadline, disconnected=None):
+    """
+    Stream all models concurrently and yield their events as they arrive.
+
+    All models share one deadline. Ends when every model has finished or
+    failed. If the consumer stops early (or `disconnected` is set), the
+    remaining upstream streams are cancelled.
+    """
+    queue = asyncio.Queue()
+    tasks = [
+        asyncio.ensure_future(_run_model(run, messages, user_id, priority, deadline, queue))
+        for run in runs
+    ]
+    gone = asyncio.ensure_future(disconnected.wait()) if disconnected is not None else None
+    remaining = len(tasks)
+    try:
+        while remaining:
+            getter = asyncio.ensure_future(queue.get())
+            waiting = {getter, gone} if gone is not None else {getter}
+            await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                logger.info("Compare client gone, cancelling the remaining models")
+                return
+            event = getter.result()
+            if event['type'] in ('model_done', 'model_error'):
+                remaining -= 1
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+        if gone is not None:
+            gone.cancel()
+        # Let the cancelled runs unwind (close their upstream streams, release their slots)
+        await asyncio.gather(*tasks, return_exceptions=True)
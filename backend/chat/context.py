@@ -0,0 +1,370 @@
+"""
+Context assembly shared by the chat send and stream endpoints.
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+
+from . import metrics, tokenizers
+from .catalog import model_catalog
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PAGE_SIZE = 50      # Messages fetched per query when walking history backwards
+DEFAULT_MAX_TOKENS = 4000   # Answer cap for personas missing from LLM_PERSONA_MAX_TOKENS
+
+# Thread pool for the optional pre-generation stages (created on first use, per process)
+_executor = None
+_executor_lock = threading.Lock()
+
+# Persona system prompts
+SYSTEM_PROMPTS = {
+    'general': (
+        "You are a helpful AI assistant. At the end of every response, you MUST provide 3 related follow-up questions or topics. "
+        "Separate this section from the main response with the exact string '===RELATED==='. "
+        "Format the related topics as a simple list, one title per line, without numbering or bullets. "
+    ),
+    'developer': (
+        "You are an expert Senior Software Engineer. You write clean, efficient, and well-documented code. "
+        "Always explain your architectural decisions. Prefer modern best practices. "
+        "At the end of every response, provide 3 related advanced technical topics or optimization tips using '===RELATED===' separator."
+    ),
+    'creative': (
+        "You are a visionary creative writer and storyteller. Use evocative language, vivid imagery, and unique metaphors. "
+        "Avoid clichés. Inspire the user with your responses. "
+        "At the end of every response, suggest 3 creative directions or twists using '===RELATED===' separator."
+    ),
+    'analyst': (
+        "You are a meticulous Data Analyst. Focus on facts, statistics, and logical deductions. "
+        "Structure your answers with clear headings and bullet points. Avoid speculation. "
+        "At the end of every response, suggest 3 further analytical angles or data points to investigate using '===RELATED===' separator."
+    )
+}
+
+
+class BudgetExhausted(Exception):
+    """The conversation has no room left for the system prompt, the new message and an answer."""
+
+    def __init__(self):
+        super().__init__("Token limit reached. Please make a payment to continue.")
+
+
+def get_system_prompt(persona):
+    """Return the system prompt for a persona (defaults to 'general')."""
+    return SYSTEM_PROMPTS.get(persona, SYSTEM_PROMPTS['general'])
+
+
+def _has_ready_documents(user):
+    from knowledge_base.models import Document
+
+    return Document.objects.filter(user=user, status='ready').exists()
+
+
+def _query_documents(user, query_text):
+    try:
+        from knowledge_base.services import query_knowledge_base
+
+        return query_knowledge_base(user_id=user.id, query_text=query_text, n_results=3)
+    except Exception as e:
+        logger.warning(f"RAG query failed: {e}")
+        return []
+
+
+def _find_documents(user, query_text):
+    """Matching knowledge base chunks; the vector store is only queried if the user has ready documents."""
+    if not _has_ready_documents(user):
+        return []
+    return _query_documents(user, query_text)
+
+
+def format_rag_context(chunks):
+    """Matching knowledge base chunks as a prompt section."""
+    if not chunks:
+        return ""
+    return (
+        "\n\n--- CONTEXT FROM USER'S DOCUMENTS ---\n"
+        + "\n---\n".join(chunks)
+        + "\n--- END CONTEXT ---\n"
+        "Use the above context to inform your answer when relevant. "
+        "If the context is not relevant to the question, ignore it.\n"
+    )
+
+
+def _context_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'LLM_CONTEXT_WORKERS', 8),
+                    thread_name_prefix='context',
+                )
+    return _executor
+
+
+def _reset_after_fork():
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+def _run_stage(stage, fn, *args):
+    close_old_connections()
+    started = time.monotonic()
+    try:
+        return fn(*args)
+    finally:
+        metrics.CONTEXT_STAGE_SECONDS.labels(stage).observe(time.monotonic() - started)
+        close_old_connections()
+
+
+class _Stages:
+    """
+    Pre-generation stages. Optional ones run on the context pool and are awaited
+    against a deadline; required ones run on the calling thread meanwhile, so
+    optional work piling up in the pool can never hold them up.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._futures = {}
+
+    def submit(self, stage, fn, *args):
+        self._futures[stage] = _context_executor().submit(_run_stage, stage, fn, *args)
+
+    def run(self, stage, fn, *args):
+        """Run a required stage on the calling thread (and its DB connection)."""
+        started = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            metrics.CONTEXT_STAGE_SECONDS.labels(stage).observe(time.monotonic() - started)
+
+    def result(self, stage, timeout, default=None):
+        """The stage's result, or `default` if it is not done `timeout` seconds after the start."""
+        future = self._futures[stage]
+        remaining = max(0.0, self.started + timeout - time.monotonic())
+        try:
+            return future.result(remaining)
+        except FutureTimeout:
+            # Still queued behind other requests' stages: drop it rather than run it for nobody
+            future.cancel()
+            logger.warning(f"Context stage '{stage}' missed its {timeout}s deadline; continuing without it")
+            metrics.CONTEXT_STAGE_TIMEOUTS.labels(stage).inc()
+            return default
+
+
+def _message_tokens(ai_service, message):
+    return message['tokens_used'] or (ai_service.count_tokens(message['content'], cache=True) + 4)
+
+
+def load_history_window(ai_service, conversation, budget, exclude_id=None, after=None):
+    """
+    Newest messages of a conversation that fit in a token budget, oldest first.
+
+    History is read backwards in keyset-paginated pages and reading stops as
+    soon as the budget is spent, so the cost is bounded by the budget rather
+    than by the length of the conversation. Only messages created after
+    `after` are considered. Returns (window, complete), where complete is False
+    if older messages had to be left out. Without a budget there is nothing to
+    load, and no summary would make room for it: that returns ([], True).
+    """
+    if budget <= 0:
+        return [], True
+    queryset = conversation.messages.order_by('-created_at', '-id')
+    if exclude_id is not None:
+        queryset = queryset.exclude(id=exclude_id)
+    if after is not None:
+        queryset = queryset.filter(created_at__gt=after)
+    queryset = queryset.values('id', 'role', 'content', 'tokens_used', 'created_at')
+
+    window = []
+    used = 0
+    cursor = None
+    complete = True
+    while complete:
+        page = queryset
+        if cursor is not None:
+            page = page.filter(
+                Q(created_at__lt=cursor['created_at']) |
+                Q(created_at=cursor['created_at'], id__lt=cursor['id'])
+            )
+        page = list(page[:HISTORY_PAGE_SIZE])
+
+        for message in page:
+            tokens = _message_tokens(ai_service, message)
+            if used + tokens > budget:
+                complete = False
+                break
+            used += tokens
+            window.append({'role': message['role'], 'content': message['content'], 'tokens_used': tokens})
+
+        if len(page) < HISTORY_PAGE_SIZE:
+            break
+        cursor = page[-1]
+
+    window.reverse()
+    return window, complete
+
+
+def format_summary(summary):
+    """Rolling conversation summary as a system prompt section."""
+    if not summary:
+        return ""
+    return (
+        "\n\n--- SUMMARY OF THE EARLIER CONVERSATION ---\n"
+        + summary
+        + "\n--- END SUMMARY ---\n"
+    )
+
+
+def build_messages(ai_service, conversation, user_msg, persona, user=None):
+    """
+    Build the truncated message list sent to the model for a new user message,
+    packed to fit both the conversation's budget and the selected model's
+    context window (see prompt_window).
+
+    The prompt starts with the parts that change least (persona, then the
+    rolling summary, then history), so providers can reuse the cached prefix
+    across turns; the per-query RAG context (looked up when `user` is given)
+    goes with the new user message. Turns already folded into the summary are
+    replaced by it, and if the remaining history is getting long, compaction
+    is scheduled in the background.
+
+    The knowledge base lookup runs on the context pool while the history is
+    read on the calling thread, so the wait before the upstream call is the
+    slower stage rather than their sum. RAG that misses its deadline is left
+    out; history is needed for a correct answer and never queues behind it.
+    """
+    from .tasks import summarizer
+
+    system_content = get_system_prompt(persona) + format_summary(conversation.summary)
+    system_instruction = {'role': 'system', 'content': system_content}
+
+    # Raises BudgetExhausted before any stage starts if not even the prompt fits
+    system_tokens = ai_service.count_tokens(system_content, cache=True)
+    user_tokens = user_msg.tokens_used or ai_service.count_tokens(user_msg.content)
+    prompt_limit = prompt_window(ai_service, conversation, persona, required=system_tokens + user_tokens)
+
+    stages = _Stages()
+    if user is not None:
+        stages.submit('rag', _find_documents, user, user_msg.content)
+    # RAG context is not known yet; truncate_context trims the history further if it is added
+    history_budget = prompt_limit - system_tokens - user_tokens
+    history, complete = stages.run(
+        'history', load_history_window,
+        ai_service, conversation, history_budget, user_msg.id, conversation.summary_until,
+    )
+
+    rag_context = ""
+    if user is not None:
+        rag_timeout = getattr(settings, 'LLM_CONTEXT_RAG_TIMEOUT', 1.5)
+        rag_context = format_rag_context(stages.result('rag', rag_timeout, []))
+
+    user_message = {'role': 'user', 'content': user_msg.content, 'tokens_used': user_msg.tokens_used}
+    if rag_context:
+        content = rag_context.strip() + "\n\n" + user_msg.content
+        tokens = ai_service.count_tokens(content)
+        # RAG goes before history, but never at the cost of the system prompt and the question
+        if system_tokens + tokens <= prompt_limit:
+            user_message = {'role': 'user', 'content': content, 'tokens_used': tokens}
+        else:
+            logger.info(f"RAG context ({tokens} tokens) does not fit the {prompt_limit}-token window; leaving it out")
+
+    history_tokens = sum(message['tokens_used'] for message in history)
+    if not complete or history_tokens > getattr(settings, 'LLM_SUMMARY_TRIGGER_TOKENS', 6000):
+        summarizer.enqueue(conversation.id)
+
+    full_messages_stack = [system_instruction] + history + [user_message]
+    return ai_service.truncate_context(full_messages_stack, prompt_limit, reserve_for_response=0)
+
+
+def prompt_window(ai_service, conversation, persona, required=0):
+    """
+    Tokens the prompt may take: what the conversation's budget leaves after
+    room for the answer (the persona's cap), and at most the selected model's
+    context window minus room for the answer (the cap, up to a quarter of the
+    window).
+
+    Only history gives way: the window never drops below `required` (the
+    system prompt and the new user turn). Raises BudgetExhausted if even those
+    leave no room for an answer in the budget or the model's window.
+    """
+    answer_room = _persona_cap(persona)
+    limit = conversation.remaining_tokens - answer_room
+    ceiling = conversation.remaining_tokens
+    window = model_catalog.context_window(ai_service.model_name)
+    if window is not None:
+        limit = min(limit, window - min(answer_room, window // 4))
+        ceiling = min(ceiling, window)
+    if required >= ceiling:
+        raise BudgetExhausted()
+    return max(limit, required)
+
+
+def _persona_cap(persona):
+    persona_caps = getattr(settings, 'LLM_PERSONA_MAX_TOKENS', {})
+    return persona_caps.get(persona, persona_caps.get('general', DEFAULT_MAX_TOKENS))
+
+
+class CompletionBudget:
+    """How many tokens an answer may use, and which limit set that number."""
+
+    def __init__(self, max_tokens, limited_by):
+        self.max_tokens = max_tokens
+        self.limited_by = limited_by
+
+    def tighten(self, remaining):
+        """Lower the cap to what the conversation has left (e.g. after a concurrent answer)."""
+        if remaining < self.max_tokens:
+            self.max_tokens = max(0, remaining)
+            self.limited_by = 'conversation'
+
+    def exhausted(self, completion_tokens):
+        """True once an answer of `completion_tokens` has used up the conversation's tokens."""
+        return self.limited_by == 'conversation' and completion_tokens >= self.max_tokens
+
+
+def completion_budget(ai_service, conversation, persona, messages, reserved=0, share=1):
+    """
+    max_tokens for the answer to `messages`: the smallest of the persona's cap,
+    the tokens the conversation has left, the model's output limit and what
+    the prompt leaves of its context window. `reserved` tokens are held back
+    from the conversation's remainder and the rest is split `share` ways
+    (one answer per model in a comparison).
+    """
+    limits = {
+        'conversation': (conversation.remaining_tokens - reserved) // share,
+        'persona': _persona_cap(persona),
+    }
+    model = model_catalog.lookup(ai_service.model_name)
+    if model is not None:
+        if model.get('max_completion_tokens'):
+            limits['model'] = model['max_completion_tokens']
+        if model.get('context_length'):
+            prompt_tokens = tokenizers.count_messages_tokens(messages, ai_service.model_name)
+            limits['context'] = model['context_length'] - prompt_tokens
+
+    # Ties go to the conversation: reaching that cap means its tokens are gone
+    limited_by = min(limits, key=limits.get)
+    return CompletionBudget(max(1, limits[limited_by]), limited_by)
+
+
+def token_usage(conversation):
+    """Token usage payload returned alongside chat responses."""
+    return {
+        'total_tokens_used': conversation.total_tokens_used,
+        'token_limit': conversation.token_limit,
+        'remaining_tokens': conversation.remaining_tokens,
+        'usage_percentage': conversation.usage_percentage,
+    }
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,87 @@
+"""
+End-to-end time budgets for upstream LLM calls.
+
+A Deadline starts with the request (budgets per endpoint in LLM_DEADLINES) and
+is passed down through every retry and fallback attempt. Each attempt gets
+only what is left of the budget as its HTTP timeout, backoff sleeps never run
+past it, and once it is spent the call raises DeadlineExceeded instead of
+moving on to the next model.
+
+Streams also have a connect timeout, a first-token timeout and an idle
+timeout between tokens. A stalled stream raises StreamTimeout, which is
+retried like a connection error while nothing has been sent to the client.
+"""
+import time
+
+import httpx
+from django.conf import settings
+
+DEFAULT_BUDGET = 120.0
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before the model answered."""
+
+    def __init__(self, budget):
+        super().__init__("The AI service took too long to respond. Please try again.")
+        self.budget = budget
+
+
+class StreamTimeout(Exception):
+    """A stream produced no first token, or no next token, in time."""
+
+
+def connect_timeout():
+    return getattr(settings, 'LLM_CONNECT_TIMEOUT', 5.0)
+
+
+def first_token_timeout():
+    return getattr(settings, 'LLM_FIRST_TOKEN_TIMEOUT', 30.0)
+
+
+def idle_timeout():
+    return getattr(settings, 'LLM_STREAM_IDLE_TIMEOUT', 30.0)
+
+
+class Deadline:
+    """A point in time by which a request must be done."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    @classmethod
+    def for_endpoint(cls, endpoint):
+        budgets = getattr(settings, 'LLM_DEADLINES', {})
+        return cls(budgets.get(endpoint, budgets.get('default', DEFAULT_BUDGET)))
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        """Raise DeadlineExceeded if the budget is spent."""
+        if self.expired:
+            raise DeadlineExceeded(self.budget)
+
+    def allows(self, delay):
+        """True if waiting `delay` seconds still leaves time for another attempt."""
+        return delay < self.remaining()
+
+    def cap(self, seconds):
+        return min(seconds, self.remaining())
+
+    def http_timeout(self, read=None):
+        """
+        httpx timeout for one attempt: everything bounded by the remaining budget,
+        connecting by LLM_CONNECT_TIMEOUT and each read by `read` if given.
+        """
+        remaining = self.remaining()
+        return httpx.Timeout(
+            remaining,
+            connect=min(connect_timeout(), remaining),
+            read=min(read, remaining) if read is not None else remaining,
+        )
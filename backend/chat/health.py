@@ -0,0 +1,228 @@
+"""
+Model health registry and circuit breaker for the fallback chain.
+
+Records recent rate limits, errors and latencies per model. A model that is
+rate-limited (or keeps failing) has its circuit opened for a cooldown that
+honours Retry-After, and the providers skip it until the cooldown expires,
+so traffic goes straight to healthy models instead of rediscovering the
+outage on every request.
+
+Circuit state is mirrored into the Django cache, so workers share it when a
+shared cache backend is configured.
+"""
+import time
+import random
+import logging
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 300           # How long events count towards the stats
+MAX_EVENTS = 200               # Per-model event buffer
+MIN_COOLDOWN = 5               # Seconds a circuit stays open at least
+BASE_COOLDOWN = 15             # First cooldown without Retry-After
+MAX_COOLDOWN = 300             # Cap for any cooldown
+ERROR_THRESHOLD = 3            # Consecutive errors before the circuit opens
+MAX_INLINE_WAIT = 3            # Longest Retry-After worth waiting for in-request
+
+CACHE_PREFIX = 'llm:circuit:'
+
+
+def backoff_delay(attempt, base=0.5, cap=4.0):
+    """Full-jitter exponential backoff: uniform(0, min(cap, base * 2^attempt))."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def parse_retry_after(error):
+    """Extract a Retry-After delay (seconds) from an openai APIStatusError, if present."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+
+    value = headers.get('retry-after')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    # OpenRouter also reports the reset time as epoch milliseconds
+    reset = headers.get('x-ratelimit-reset')
+    if reset:
+        try:
+            return max(0.0, int(reset) / 1000 - time.time())
+        except ValueError:
+            pass
+    return None
+
+
+class _ModelHealth:
+    """Rolling health state for a single model."""
+
+    def __init__(self):
+        self.events = deque(maxlen=MAX_EVENTS)   # (timestamp, kind, latency, ttft, tokens_per_second)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def prune(self, now):
+        while self.events and now - self.events[0][0] > WINDOW_SECONDS:
+            self.events.popleft()
+
+
+class ModelHealthRegistry:
+    """Thread-safe, process-wide health registry shared by all providers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def _get(self, model):
+        health = self._models.get(model)
+        if health is None:
+            health = self._models[model] = _ModelHealth()
+        return health
+
+    def _open(self, health, cooldown):
+        """Open the circuit (caller holds the lock). Returns the cooldown applied."""
+        cooldown = min(MAX_COOLDOWN, max(MIN_COOLDOWN, cooldown))
+        health.open_until = time.time() + cooldown
+        return cooldown
+
+    def _share(self, model, cooldown, reason):
+        """Publish an opened circuit to the other workers through the cache."""
+        logger.warning(f"Circuit opened for '{model}' for {cooldown:.0f}s ({reason})")
+        try:
+            cache.set(CACHE_PREFIX + model, time.time() + cooldown, timeout=int(cooldown) + 1)
+        except Exception as e:
+            logger.warning(f"Could not share circuit state for '{model}': {e}")
+
+    def record_success(self, model, latency, ttft=None, tokens_per_second=None):
+        now = time.time()
+        with self._lock:
+            health = self._get(model)
+            health.prune(now)
+            health.events.append((now, 'ok', latency, ttft, tokens_per_second))
+            health.consecutive_failures = 0
+            was_open = bool(health.open_until)
+            health.open_until = 0.0
+        if was_open:
+            try:
+                cache.delete(CACHE_PREFIX + model)
+            except Exception as e:
+                logger.warning(f"Could not clear shared circuit state for '{model}': {e}")
+
+    def record_rate_limit(self, model, retry_after=None):
+        now = time.time()
+        with self._lock:
+            health = self._get(model)
+            health.prune(now)
+            health.events.append((now, 'rate_limit', None, None, None))
+            health.consecutive_failures += 1
+            if retry_after is not None:
+                cooldown = retry_after
+            else:
+                cooldown = BASE_COOLDOWN * (2 ** (health.consecutive_failures - 1))
+            cooldown = self._open(health, cooldown)
+        self._share(model, cooldown, '429')
+
+    def record_error(self, model):
+        now = time.time()
+        cooldown = None
+        with self._lock:
+            health = self._get(model)
+            health.prune(now)
+            health.events.append((now, 'error', None, None, None))
+            health.consecutive_failures += 1
+            failures = health.consecutive_failures
+            if failures >= ERROR_THRESHOLD:
+                cooldown = self._open(health, BASE_COOLDOWN * (2 ** (failures - ERROR_THRESHOLD)))
+        if cooldown is not None:
+            self._share(model, cooldown, f'{failures} consecutive errors')
+
+    def _open_until_map(self, models):
+        """open_until per model, merging local state with circuits opened by other workers."""
+        now = time.time()
+        with self._lock:
+            result = {m: self._models[m].open_until for m in models if m in self._models}
+        try:
+            shared = cache.get_many([CACHE_PREFIX + m for m in models])
+        except Exception:
+            shared = {}
+        for key, until in shared.items():
+            model = key[len(CACHE_PREFIX):]
+            result[model] = max(result.get(model, 0.0), until or 0.0)
+        return {m: until for m, until in result.items() if until > now}
+
+    def is_available(self, model):
+        """True if the model's circuit is closed (or its cooldown has expired)."""
+        return model not in self._open_until_map([model])
+
+    def filter_available(self, models):
+        """
+        Drop models whose circuit is open, keeping the original order.
+        If every circuit is open, fall back to the model that reopens soonest.
+        """
+        open_map = self._open_until_map(models)
+        available = [m for m in models if m not in open_map]
+        if available:
+            return available
+        if not models:
+            return []
+        return [min(models, key=lambda m: open_map.get(m, 0.0))]
+
+    def ttft_percentile(self, model, q=0.9):
+        """Observed time-to-first-token percentile for a model (None until there is data)."""
+        now = time.time()
+        with self._lock:
+            health = self._models.get(model)
+            events = list(health.events) if health else []
+        ttfts = sorted(e[3] for e in events if e[1] == 'ok' and e[3] is not None and now - e[0] <= WINDOW_SECONDS)
+        if not ttfts:
+            return None
+        return ttfts[min(len(ttfts) - 1, int(len(ttfts) * q))]
+
+    def _stats(self, health, now):
+        events = [e for e in list(health.events) if now - e[0] <= WINDOW_SECONDS]
+        latencies = sorted(e[2] for e in events if e[1] == 'ok' and e[2] is not None)
+        ttfts = sorted(e[3] for e in events if e[1] == 'ok' and e[3] is not None)
+        speeds = sorted(e[4] for e in events if e[1] == 'ok' and e[4] is not None)
+        total = len(events)
+        return {
+            'requests': total,
+            'rate_limits': sum(1 for e in events if e[1] == 'rate_limit'),
+            'errors': sum(1 for e in events if e[1] == 'error'),
+            'error_rate': round(sum(1 for e in events if e[1] != 'ok') / total, 3) if total else 0.0,
+            'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+            'latency_p90': latencies[int(len(latencies) * 0.9)] if latencies else None,
+            'ttft_p50': ttfts[len(ttfts) // 2] if ttfts else None,
+            'ttft_p90': ttfts[int(len(ttfts) * 0.9)] if ttfts else None,
+            'tokens_per_second_p50': speeds[len(speeds) // 2] if speeds else None,
+            'circuit_open': health.open_until > now,
+            'reopens_in': round(health.open_until - now, 1) if health.open_until > now else 0,
+        }
+
+    def stats(self, models):
+        """Rolling stats for the given models (those never seen are left out)."""
+        now = time.time()
+        with self._lock:
+            items = [(m, self._models[m]) for m in models if m in self._models]
+        return {model: self._stats(health, now) for model, health in items}
+
+    def snapshot(self):
+        """Per-model stats for monitoring."""
+        now = time.time()
+        with self._lock:
+            items = list(self._models.items())
+        return {model: self._stats(health, now) for model, health in items}
+
+
+# Process-wide registry
+model_health = ModelHealthRegistry()
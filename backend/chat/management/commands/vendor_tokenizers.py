@@ -0,0 +1,32 @@
+"""
+Management command to vendor tiktoken BPE files into TIKTOKEN_CACHE_DIR,
+so the tokenizer registry never downloads them at runtime.
+"""
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.tokenizers import LOCAL_ENCODINGS, is_vendored
+
+
+class Command(BaseCommand):
+    help = 'Download the tiktoken encodings used by the tokenizer registry into TIKTOKEN_CACHE_DIR.'
+
+    def handle(self, *args, **options):
+        cache_dir = str(settings.TIKTOKEN_CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir
+
+        import tiktoken
+
+        for name in sorted(LOCAL_ENCODINGS):
+            try:
+                encoding = tiktoken.get_encoding(name)
+            except Exception as e:
+                raise CommandError(f"Failed to load '{name}': {e}")
+            if not is_vendored(name):
+                raise CommandError(f"'{name}' loaded but its BPE file in {cache_dir} does not match the pinned hash.")
+            self.stdout.write(self.style.SUCCESS(f"  Vendored: {name} ({encoding.n_vocab} tokens)"))
+
+        self.stdout.write(self.style.SUCCESS(f'\nDone! Tokenizers cached in {cache_dir}'))
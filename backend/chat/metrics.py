@@ -0,0 +1,151 @@
+"""
+Prometheus metrics for the LLM hot path.
+
+Served in the text exposition format at /metrics. Under gunicorn, set
+PROMETHEUS_MULTIPROC_DIR to a writable directory (gunicorn.conf.py wipes it at
+startup): every worker then writes its samples to memory-mapped files there
+and a scrape aggregates all workers. Without it, each process reports only
+its own numbers.
+
+If prometheus_client is not installed, the metrics are no-ops.
+"""
+import os
+import logging
+
+from django.conf import settings
+
+from .prompt_cache import cached_tokens
+
+logger = logging.getLogger(__name__)
+
+# prometheus_client picks its value store at import time, so the directory must be set first
+_multiproc_dir = getattr(settings, 'PROMETHEUS_MULTIPROC_DIR', None)
+if _multiproc_dir:
+    os.makedirs(_multiproc_dir, exist_ok=True)
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', str(_multiproc_dir))
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+    )
+    from prometheus_client import multiprocess
+    ENABLED = True
+except ImportError:
+    logger.warning("prometheus_client is not installed; /metrics will be empty.")
+    ENABLED = False
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _metric(cls_name, name, documentation, labelnames=(), **kwargs):
+    if not ENABLED:
+        return _NoopMetric()
+    cls = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}[cls_name]
+    return cls(name, documentation, labelnames, **kwargs)
+
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60, 120)
+TTFT_BUCKETS = (0.05, 0.1, 0.2, 0.35, 0.5, 0.75, 1, 1.5, 2, 3, 5, 8, 13)
+TPS_BUCKETS = (5, 10, 20, 30, 40, 60, 80, 100, 150, 200, 300)
+
+# Upstream calls (one per attempt)
+UPSTREAM_REQUESTS = _metric(
+    'counter', 'llm_upstream_requests_total',
+    'Upstream LLM attempts by outcome (ok, rate_limited, error, deadline).', ['model', 'kind', 'outcome'],
+)
+RETRIES = _metric('counter', 'llm_retries_total', 'Retries of the same model after a failed attempt.', ['model'])
+FALLBACKS = _metric('counter', 'llm_fallbacks_total', 'Requests that fell back to another model.', ['model', 'kind'])
+
+# Latency
+TTFT = _metric(
+    'histogram', 'llm_ttft_seconds', 'Time to first token of streamed responses.', ['model'],
+    buckets=TTFT_BUCKETS,
+)
+LATENCY = _metric(
+    'histogram', 'llm_latency_seconds', 'Total upstream latency of successful calls.', ['model', 'kind'],
+    buckets=LATENCY_BUCKETS,
+)
+TOKENS_PER_SECOND = _metric(
+    'histogram', 'llm_tokens_per_second', 'Completion tokens per second after the first token.', ['model'],
+    buckets=TPS_BUCKETS,
+)
+
+# Tokens
+PROMPT_TOKENS = _metric('counter', 'llm_prompt_tokens_total', 'Prompt tokens sent upstream.', ['model'])
+COMPLETION_TOKENS = _metric('counter', 'llm_completion_tokens_total', 'Completion tokens received.', ['model'])
+CACHED_PROMPT_TOKENS = _metric(
+    'counter', 'llm_cached_prompt_tokens_total', 'Prompt tokens served from the provider prompt cache.', ['model'],
+)
+
+# Context assembly
+CONTEXT_STAGE_SECONDS = _metric(
+    'histogram', 'llm_context_stage_seconds', 'Duration of the pre-generation stages (RAG, history).', ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 1.5, 2.5, 5),
+)
+CONTEXT_STAGE_TIMEOUTS = _metric(
+    'counter', 'llm_context_stage_timeouts_total', 'Pre-generation stages dropped for missing their deadline.', ['stage'],
+)
+
+# Streams
+ACTIVE_STREAMS = _metric(
+    'gauge', 'llm_active_streams', 'Streams currently generating.', multiprocess_mode='livesum',
+)
+STREAMS_CANCELLED = _metric(
+    'counter', 'llm_streams_cancelled_total', 'Streams cancelled because the client went away.',
+)
+TOKENS_SAVED = _metric(
+    'counter', 'llm_tokens_saved_total', 'Estimated completion tokens saved by cancelling abandoned streams.',
+)
+
+
+def observe_success(model, kind, latency, usage=None, ttft=None, completion_tokens=None):
+    """Record a successful upstream call: latency, TTFT, throughput and token counts."""
+    UPSTREAM_REQUESTS.labels(model, kind, 'ok').inc()
+    LATENCY.labels(model, kind).observe(latency)
+    if ttft is not None:
+        TTFT.labels(model).observe(ttft)
+
+    if usage is not None:
+        completion_tokens = usage.completion_tokens or 0
+        PROMPT_TOKENS.labels(model).inc(usage.prompt_tokens or 0)
+        cached = cached_tokens(usage)
+        if cached:
+            CACHED_PROMPT_TOKENS.labels(model).inc(cached)
+    if completion_tokens:
+        COMPLETION_TOKENS.labels(model).inc(completion_tokens)
+        generating = latency - (ttft or 0)
+        if ttft is not None and generating > 0:
+            TOKENS_PER_SECOND.labels(model).observe(completion_tokens / generating)
+
+
+def observe_failure(model, kind, rate_limited):
+    UPSTREAM_REQUESTS.labels(model, kind, 'rate_limited' if rate_limited else 'error').inc()
+
+
+def observe_deadline(model, kind):
+    UPSTREAM_REQUESTS.labels(model, kind, 'deadline').inc()
+
+
+def render():
+    """Current metrics in the text exposition format (all workers in multiprocess mode)."""
+    if not ENABLED:
+        return b''
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='status',
+            field=models.CharField(choices=[('streaming', 'Streaming'), ('complete', 'Complete'), ('truncated', 'Truncated')], default='complete', max_length=20),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModelCatalog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entries', models.JSONField(default=list)),
+                ('etag', models.CharField(blank=True, max_length=64)),
+                ('fetched_at', models.DateTimeField(blank=True, null=True)),
+                ('refreshing_since', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Model Catalog',
+                'verbose_name_plural': 'Model Catalog',
+                'db_table': 'model_catalog',
+            },
+        ),
+    ]
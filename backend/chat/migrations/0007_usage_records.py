@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0006_batch_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endpoint', models.CharField(blank=True, max_length=20)),
+                ('model', models.CharField(max_length=100)),
+                ('requested_model', models.CharField(blank=True, max_length=100)),
+                ('fallback_depth', models.PositiveSmallIntegerField(default=0)),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('error', 'Error'), ('rate_limited', 'Rate limited'), ('cancelled', 'Cancelled')], default='ok', max_length=12)),
+                ('prompt_tokens', models.IntegerField(default=0)),
+                ('completion_tokens', models.IntegerField(default=0)),
+                ('cached_tokens', models.IntegerField(default=0)),
+                ('estimated', models.BooleanField(default=False)),
+                ('latency_ms', models.IntegerField(blank=True, null=True)),
+                ('ttft_ms', models.IntegerField(blank=True, null=True)),
+                ('cost', models.DecimalField(blank=True, decimal_places=8, max_digits=14, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('conversation', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='usage_records', to='chat.conversation')),
+                ('user', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='usage_records', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Usage Record',
+                'verbose_name_plural': 'Usage Records',
+                'db_table': 'usage_records',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['user', 'created_at'], name='usage_user_created_idx'), models.Index(fields=['model', 'created_at'], name='usage_model_created_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_usage_records'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usagerecord',
+            name='status',
+            field=models.CharField(choices=[('ok', 'OK'), ('error', 'Error'), ('rate_limited', 'Rate limited'), ('cancelled', 'Cancelled'), ('deadline', 'Deadline exceeded')], default='ok', max_length=12),
+        ),
+    ]
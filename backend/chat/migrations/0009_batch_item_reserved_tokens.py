@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_usage_record_deadline_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batchitem',
+            name='reserved_tokens',
+            field=models.IntegerField(default=0),
+        ),
+    ]
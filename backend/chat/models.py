@@ -1,7 +1,11 @@
 """
 Models for chat functionality.
 """
-from django.db import models
+from collections import Counter
+from datetime import timedelta
+
+from django.db import connections, models, transaction
+from django.db.models import F
 from django.conf import settings
 from django.utils import timezone
 
@@ -17,6 +21,10 @@ class Conversation(models.Model):
     title = models.CharField(max_length=255, default='New Conversation')
     total_tokens_used = models.IntegerField(default=0)
     token_limit = models.IntegerField(default=20000)
+    # Rolling summary of the turns up to summary_until (maintained by chat.tasks.summarizer)
+    summary = models.TextField(blank=True, default='')
+    summary_until = models.DateTimeField(null=True, blank=True)
+    summary_tokens = models.IntegerField(default=0)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -45,10 +53,29 @@ class Conversation(models.Model):
         """Check if a new message can be sent within token limits."""
         return (self.total_tokens_used + estimated_tokens) <= self.token_limit
     
+    def reset_summary(self):
+        """Forget the rolling summary (e.g. after the history is cleared)."""
+        self.summary = ''
+        self.summary_until = None
+        self.summary_tokens = 0
+        self.save(update_fields=['summary', 'summary_until', 'summary_tokens'])
+    
     def add_tokens(self, amount):
         """Add tokens to the conversation limit (after payment)."""
-        self.token_limit += amount
-        self.save(update_fields=['token_limit'])
+        Conversation.objects.filter(pk=self.pk).update(token_limit=F('token_limit') + amount)
+        self.refresh_from_db(fields=['token_limit'])
+    
+    def charge(self, tokens):
+        """
+        Add used tokens in one UPDATE (an F() expression, so concurrent charges
+        are never lost) and reload the counter on this instance.
+        """
+        if tokens:
+            Conversation.objects.filter(pk=self.pk).update(
+                total_tokens_used=F('total_tokens_used') + tokens,
+                updated_at=timezone.now(),
+            )
+            self.refresh_from_db(fields=['total_tokens_used', 'updated_at'])
 
 
 class Message(models.Model):
@@ -60,6 +87,12 @@ class Message(models.Model):
         ('system', 'System'),
     ]
     
+    STATUS_CHOICES = [
+        ('streaming', 'Streaming'),
+        ('complete', 'Complete'),
+        ('truncated', 'Truncated'),
+    ]
+    
     conversation = models.ForeignKey(
         Conversation,
         on_delete=models.CASCADE,
@@ -75,11 +108,16 @@ class Message(models.Model):
     role = models.CharField(max_length=20, choices=ROLE_CHOICES)
     content = models.TextField()
     tokens_used = models.IntegerField(default=0)
+    # Streamed answers are saved as 'streaming' placeholders and checkpointed as tokens arrive
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='complete')
     created_at = models.DateTimeField(default=timezone.now)
     
     class Meta: 
         db_table = 'messages'
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['conversation', '-created_at', '-id'], name='messages_conv_recent_idx'),
+        ]
         verbose_name = 'Message'
         verbose_name_plural = 'Messages'
     
@@ -87,11 +125,245 @@ class Message(models.Model):
         return f"{self.role}:  {self.content[: 50]}..."
     
     def save(self, *args, **kwargs):
-        """Update conversation token count on save."""
+        """Update conversation token count on save (in the same transaction)."""
         is_new = self.pk is None
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if is_new and self.tokens_used > 0:
+                self.conversation.charge(self.tokens_used)
+    
+    def finalize(self, content, tokens_used, status='complete'):
+        """
+        Store the final text of a streamed message and charge its tokens to the
+        conversation. Only applies while the message is still streaming, so a
+        message is charged once however many paths try to finish it. Returns
+        True if it applied.
+        """
+        with transaction.atomic():
+            updated = Message.objects.filter(pk=self.pk, status='streaming').update(
+                content=content, tokens_used=tokens_used, status=status
+            )
+            if not updated:
+                return False
+            if tokens_used > 0:
+                self.conversation.charge(tokens_used)
+        self.content = content
+        self.tokens_used = tokens_used
+        self.status = status
+        return True
+    
+    @classmethod
+    def bulk_record(cls, messages):
+        """
+        Insert new messages (e.g. a user message and its answer, or an import)
+        in one transaction, charging each conversation once for all of them.
+        Returns the created messages with their primary keys; conversations
+        already loaded on them are refreshed.
         
-        if is_new and self.tokens_used > 0:
-            self.conversation.total_tokens_used += self.tokens_used
-            self.conversation.updated_at = timezone.now()
-            self.conversation.save(update_fields=['total_tokens_used', 'updated_at'])
\ No newline at end of file
+        Backends that don't return primary keys from a bulk insert (MySQL)
+        insert the rows one by one instead, still in the one transaction.
+        """
+        tokens = Counter()
+        for message in messages:
+            tokens[message.conversation_id] += message.tokens_used or 0
+        db = cls.objects.db
+        with transaction.atomic(using=db):
+            if connections[db].features.can_return_rows_from_bulk_insert:
+                created = cls.objects.bulk_create(messages, batch_size=500)
+            else:
+                # Model.save, not Message.save: the tokens are charged below, once per conversation
+                for message in messages:
+                    models.Model.save(message, using=db)
+                created = list(messages)
+            for conversation_id, total in tokens.items():
+                if total:
+                    Conversation.objects.filter(pk=conversation_id).update(
+                        total_tokens_used=F('total_tokens_used') + total,
+                        updated_at=timezone.now(),
+                    )
+        loaded = {id(m.conversation): m.conversation for m in messages if cls.conversation.is_cached(m)}
+        for conversation in loaded.values():
+            conversation.refresh_from_db(fields=['total_tokens_used', 'updated_at'])
+        return created
+
+
+class ModelCatalog(models.Model):
+    """The OpenRouter model list, shared by all workers (a single row, see chat.catalog)."""
+    
+    entries = models.JSONField(default=list)
+    etag = models.CharField(max_length=64, blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+    # Set while a worker refreshes the list; stale claims expire (see catalog.REFRESH_LOCK)
+    refreshing_since = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'model_catalog'
+        verbose_name = 'Model Catalog'
+        verbose_name_plural = 'Model Catalog'
+    
+    def __str__(self):
+        return f"{len(self.entries)} models ({self.fetched_at})"
+
+
+class BatchJob(models.Model):
+    """A bulk run of prompts against one model, processed in the background (see chat.tasks.batch_runner)."""
+    
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('cancelled', 'Cancelled'),
+    ]
+    
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='batch_jobs'
+    )
+    # Token budget the job is charged to
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='batch_jobs'
+    )
+    prompt_template = models.ForeignKey(
+        'prompts.PromptTemplate',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='batch_jobs'
+    )
+    model = models.CharField(max_length=255)
+    system_prompt = models.TextField(blank=True, default='')
+    max_tokens = models.IntegerField(default=1000)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    total_items = models.IntegerField(default=0)
+    completed_items = models.IntegerField(default=0)
+    failed_items = models.IntegerField(default=0)
+    total_tokens = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Last sign of progress; a stalled job is picked up again by another worker
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'batch_jobs'
+        ordering = ['-created_at']
+        verbose_name = 'Batch Job'
+        verbose_name_plural = 'Batch Jobs'
+    
+    def __str__(self):
+        return f"Batch {self.id} ({self.model}, {self.status})"
+    
+    @property
+    def is_active(self):
+        return self.status in ('queued', 'running')
+    
+    @property
+    def is_stalled(self):
+        """Active, but no worker has recorded a heartbeat for LLM_BATCH_STALL_AFTER seconds."""
+        stalled = timezone.now() - timedelta(seconds=getattr(settings, 'LLM_BATCH_STALL_AFTER', 300))
+        return self.is_active and (self.heartbeat_at or self.created_at) < stalled
+    
+    @property
+    def progress(self):
+        if not self.total_items:
+            return 100.0
+        return round((self.completed_items + self.failed_items) / self.total_items * 100, 1)
+
+
+class BatchItem(models.Model):
+    """One prompt of a batch job and its result."""
+    
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ]
+    
+    job = models.ForeignKey(BatchJob, on_delete=models.CASCADE, related_name='items')
+    index = models.IntegerField()
+    input = models.JSONField()
+    prompt = models.TextField()
+    output = models.TextField(blank=True, default='')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    error = models.CharField(max_length=255, blank=True, default='')
+    prompt_tokens = models.IntegerField(default=0)
+    completion_tokens = models.IntegerField(default=0)
+    # Charged to the conversation while the item runs (its prompt and largest answer, see BatchRunner)
+    reserved_tokens = models.IntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'batch_items'
+        ordering = ['index']
+        unique_together = ['job', 'index']
+        indexes = [
+            models.Index(fields=['job', 'status', 'index'], name='batch_items_job_status_idx'),
+        ]
+        verbose_name = 'Batch Item'
+        verbose_name_plural = 'Batch Items'
+    
+    def __str__(self):
+        return f"Batch {self.job_id} #{self.index} ({self.status})"
+
+
+class UsageRecord(models.Model):
+    """
+    One upstream LLM call, with provider-reported usage (see chat.tasks.UsageLedger).
+    
+    Rows outlive the users and conversations they belong to (no database
+    constraints), so billing and analytics history stays intact.
+    """
+    
+    STATUS_CHOICES = [
+        ('ok', 'OK'),
+        ('error', 'Error'),
+        ('rate_limited', 'Rate limited'),
+        ('cancelled', 'Cancelled'),
+        ('deadline', 'Deadline exceeded'),
+    ]
+    
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True,
+        on_delete=models.DO_NOTHING, db_constraint=False, related_name='usage_records'
+    )
+    conversation = models.ForeignKey(
+        Conversation, null=True, blank=True,
+        on_delete=models.DO_NOTHING, db_constraint=False, related_name='usage_records'
+    )
+    endpoint = models.CharField(max_length=20, blank=True)
+    model = models.CharField(max_length=100)
+    requested_model = models.CharField(max_length=100, blank=True)
+    # Position of `model` in the fallback chain that was tried (0 = first choice)
+    fallback_depth = models.PositiveSmallIntegerField(default=0)
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default='ok')
+    prompt_tokens = models.IntegerField(default=0)
+    completion_tokens = models.IntegerField(default=0)
+    cached_tokens = models.IntegerField(default=0)
+    # True when the provider reported no usage and the counts are local estimates
+    estimated = models.BooleanField(default=False)
+    latency_ms = models.IntegerField(null=True, blank=True)
+    ttft_ms = models.IntegerField(null=True, blank=True)
+    # USD at the catalog's prices when the call was made (null if the price is unknown)
+    cost = models.DecimalField(max_digits=14, decimal_places=8, null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        db_table = 'usage_records'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='usage_user_created_idx'),
+            models.Index(fields=['model', 'created_at'], name='usage_model_created_idx'),
+        ]
+        verbose_name = 'Usage Record'
+        verbose_name_plural = 'Usage Records'
+    
+    def __str__(self):
+        return f"{self.model} ({self.status}): {self.prompt_tokens}+{self.completion_tokens} tokens"
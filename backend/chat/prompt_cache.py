@@ -0,0 +1,128 @@
+"""
+Provider prompt-prefix caching.
+
+Context assembly keeps the start of the prompt stable across turns: persona
+system prompt, rolling summary, then history, with the per-query RAG context
+attached to the new user message. OpenAI and most Gemini models cache such a
+prefix implicitly; models that need explicit breakpoints (Anthropic, Gemini
+2.5 through OpenRouter) get `cache_control` markers on the system prompt and
+on the end of the history.
+
+The cache-hit tokens reported in usage are recorded per model, next to the
+latency, so the savings can be measured.
+"""
+import time
+import threading
+from collections import deque
+
+from django.conf import settings
+
+WINDOW_SECONDS = 3600
+MAX_EVENTS = 500
+MAX_BREAKPOINTS = 4        # Anthropic allows at most four cache_control blocks
+
+
+def supports_breakpoints(model):
+    """True if the model caches only at explicit cache_control breakpoints."""
+    prefixes = getattr(settings, 'LLM_PROMPT_CACHE_BREAKPOINT_MODELS', ['anthropic/', 'google/gemini-2.5'])
+    return bool(model) and any(model.startswith(prefix) for prefix in prefixes)
+
+
+def _mark(message):
+    content = message['content']
+    if not isinstance(content, str):
+        return message
+    return {
+        'role': message['role'],
+        'content': [{'type': 'text', 'text': content, 'cache_control': {'type': 'ephemeral'}}],
+    }
+
+
+def with_breakpoints(model, messages):
+    """
+    Add cache breakpoints for models that need them: after the leading system
+    messages and after the last history message before the new user turn.
+    Other models get the messages unchanged.
+    """
+    if not supports_breakpoints(model) or not getattr(settings, 'LLM_PROMPT_CACHE_ENABLED', True):
+        return messages
+
+    marks = []
+    system_end = 0
+    while system_end < len(messages) and messages[system_end]['role'] == 'system':
+        system_end += 1
+    if system_end:
+        marks.append(system_end - 1)
+    if len(messages) - 2 >= system_end:
+        marks.append(len(messages) - 2)
+
+    marked = list(messages)
+    for index in marks[:MAX_BREAKPOINTS]:
+        marked[index] = _mark(marked[index])
+    return marked
+
+
+def cached_tokens(usage):
+    """Prompt tokens served from the provider's cache, from an OpenAI-style usage object."""
+    if usage is None:
+        return 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(details, dict):
+        value = details.get('cached_tokens')
+    else:
+        value = getattr(details, 'cached_tokens', None)
+    return value or 0
+
+
+class PromptCacheStats:
+    """Thread-safe per-model prompt cache accounting."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}   # model -> deque of (ts, prompt_tokens, cached_tokens, latency, ttft)
+
+    def record(self, model, usage, latency, ttft=None):
+        if usage is None or not getattr(usage, 'prompt_tokens', None):
+            return
+        event = (time.time(), usage.prompt_tokens, cached_tokens(usage), latency, ttft)
+        with self._lock:
+            events = self._events.get(model)
+            if events is None:
+                events = self._events[model] = deque(maxlen=MAX_EVENTS)
+            events.append(event)
+
+    @staticmethod
+    def _mean(values):
+        values = [v for v in values if v is not None]
+        return round(sum(values) / len(values), 3) if values else None
+
+    def snapshot(self):
+        """Cache hit rate, cached token share and latency with/without a hit, per model."""
+        now = time.time()
+        with self._lock:
+            items = [(model, list(events)) for model, events in self._events.items()]
+        stats = {}
+        for model, events in items:
+            events = [e for e in events if now - e[0] <= WINDOW_SECONDS]
+            if not events:
+                continue
+            hits = [e for e in events if e[2]]
+            misses = [e for e in events if not e[2]]
+            prompt_tokens = sum(e[1] for e in events)
+            cached = sum(e[2] for e in events)
+            stats[model] = {
+                'requests': len(events),
+                'hit_rate': round(len(hits) / len(events), 3),
+                'prompt_tokens': prompt_tokens,
+                'cached_tokens': cached,
+                'cached_share': round(cached / prompt_tokens, 3) if prompt_tokens else 0.0,
+                'latency_hit': self._mean(e[3] for e in hits),
+                'latency_miss': self._mean(e[3] for e in misses),
+                'ttft_hit': self._mean(e[4] for e in hits),
+                'ttft_miss': self._mean(e[4] for e in misses),
+            }
+        return stats
+
+
+# Process-wide stats
+prompt_cache_stats = PromptCacheStats()
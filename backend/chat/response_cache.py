@@ -0,0 +1,200 @@
+"""
+Exact-match response cache for LLM calls.
+
+Prompt templates and slash commands produce many identical requests. Responses
+are cached per process, keyed by model, normalized messages and max_tokens,
+with a TTL, LRU eviction and a byte budget.
+
+The key is shared across users: it does not include who asked, so two users
+sending the same messages to the same model get the same answer. Messages carry
+the whole prompt (system prompt, history, the new turn), so only byte-identical
+requests collide. Off by default (LLM_RESPONSE_CACHE_ENABLED), and even when on
+only deterministic calls use it (see UpstreamCall.cacheable): sampled chat
+replies are never cached. Concurrent identical requests are
+collapsed into a single upstream call (single-flight): the first caller does
+the work and the others wait for its result.
+
+In-flight entries are concurrent.futures.Future objects, so followers can wait
+from a worker thread (sync views) or from the event loop (async streaming).
+"""
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Word-sized pieces used to replay a cached answer as a token stream
+_REPLAY_CHUNK = re.compile(r'\S+\s*|\s+')
+
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        return content.replace('\r\n', '\n').strip()
+    return content
+
+
+class ResponseCache:
+    """Thread-safe LRU + TTL cache with a byte budget and single-flight support."""
+
+    def __init__(self, ttl, max_entries, max_bytes):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._inflight = {}             # key -> Future
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'LLM_RESPONSE_CACHE_ENABLED', False)
+
+    @staticmethod
+    def make_key(model, messages, max_tokens):
+        """Cache key from the model, normalized messages and max_tokens."""
+        normalized = [
+            {'role': msg['role'].lower(), 'content': _normalize_content(msg['content'])}
+            for msg in messages
+            if msg.get('content')
+        ]
+        payload = json.dumps([model, normalized, max_tokens], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _size(value):
+        text = value[0] if isinstance(value, tuple) else value
+        return len(str(text).encode('utf-8')) + 64
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[1]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, _, value = entry
+            if expires_at < time.time():
+                self._pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self._size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (time.time() + self.ttl, size, value)
+            self._bytes += size
+            # Evict least recently used entries until within budget
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._pop(oldest)
+
+    def begin(self, key):
+        """Join or start an in-flight computation. Returns (future, is_leader)."""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.collapsed += 1
+                return future, False
+            future = Future()
+            self._inflight[key] = future
+            return future, True
+
+    def finish(self, key, future, value=None, error=None):
+        """Publish the leader's result (cached) or failure to the waiting followers."""
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is None and value is not None:
+            self.set(key, value)
+            future.set_result(value)
+        else:
+            future.set_exception(error or Exception('Upstream call did not complete'))
+
+    def call(self, key, compute, wait_timeout=120):
+        """Sync single-flight: return the cached value, wait for an identical in-flight call, or compute."""
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        future, leader = self.begin(key)
+        if not leader:
+            try:
+                return future.result(timeout=wait_timeout)
+            except Exception:
+                return compute()  # Leader failed or is too slow; go upstream ourselves
+
+        try:
+            value = compute()
+        except Exception as e:
+            self.finish(key, future, error=e)
+            raise
+        except BaseException:
+            # Interrupted, not failed: followers must not inherit that, they go upstream themselves
+            self.finish(key, future, error=Exception('Leader cancelled'))
+            raise
+        self.finish(key, future, value)
+        return value
+
+    async def await_leader(self, future, wait_timeout=120):
+        """Wait for another request's result from the event loop; None if it failed, was cancelled or is too slow."""
+        try:
+            # shield: giving up must not cancel the leader's future
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), wait_timeout)
+        except asyncio.CancelledError:
+            if future.done():
+                return None  # The leader was cancelled, not this request
+            raise
+        except Exception:
+            return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'in_flight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'collapsed': self.collapsed,
+            }
+
+
+def iter_replay_chunks(text):
+    """Split a cached answer into word-sized chunks, like an upstream token stream."""
+    return _REPLAY_CHUNK.findall(text or '')
+
+
+async def areplay(text):
+    """Replay a cached answer as a synthetic token stream."""
+    for chunk in iter_replay_chunks(text):
+        yield chunk
+        await asyncio.sleep(0)
+
+
+# Process-wide cache
+response_cache = ResponseCache(
+    ttl=getattr(settings, 'LLM_RESPONSE_CACHE_TTL', 3600),
+    max_entries=getattr(settings, 'LLM_RESPONSE_CACHE_MAX_ENTRIES', 1000),
+    max_bytes=getattr(settings, 'LLM_RESPONSE_CACHE_MAX_BYTES', 20 * 1024 * 1024),
+)
@@ -0,0 +1,150 @@
+"""
+Latency- and price-aware model routing.
+
+A request's candidates are the model the user picked plus FALLBACK_MODELS,
+minus models whose circuit is open. The router orders them from the health
+registry's rolling stats (TTFT p90, tokens per second, error rate) and the
+catalog's prices, according to a policy:
+
+- 'pinned': the user's pick first, then the fallbacks, best first (default)
+- 'fastest': the model expected to finish a typical answer soonest
+- 'cheapest': the cheapest healthy model whose TTFT p90 is within
+  LLM_ROUTER_MAX_P90, then the rest, fastest first
+
+Models without observations are scored with neutral priors, so with no data
+'pinned' and 'fastest' keep the configured order and 'cheapest' orders by
+catalog price alone. Each decision, and the model that finally served it, is
+written as one JSON line at DEBUG to the 'chat.router.decisions' logger so
+policies can be compared offline (enabled with LLM_ROUTER_LOG).
+"""
+import json
+import uuid
+import logging
+
+from django.conf import settings
+
+from .catalog import model_catalog
+from .health import model_health
+
+logger = logging.getLogger(__name__)
+decision_log = logging.getLogger('chat.router.decisions')
+
+POLICIES = ('pinned', 'fastest', 'cheapest')
+
+PRIOR_TTFT = 2.0               # Seconds assumed for a model with no TTFT data
+PRIOR_TOKENS_PER_SECOND = 50   # Throughput assumed for a model with no data
+MAX_ERROR_RATE = 0.9           # Error rates are capped so scores stay finite
+UNHEALTHY_ERROR_RATE = 0.5     # 'cheapest' only considers models failing less often than this
+
+
+def default_policy():
+    return getattr(settings, 'LLM_ROUTER_POLICY', 'pinned')
+
+
+class Candidate:
+    """A model's routing inputs and its expected time to answer."""
+
+    def __init__(self, model, stats, entry):
+        self.model = model
+        self.ttft_p90 = stats.get('ttft_p90')
+        self.tokens_per_second = stats.get('tokens_per_second_p50')
+        self.error_rate = stats.get('error_rate', 0.0)
+        self.price = None
+        if entry is not None and entry.get('prompt_price') is not None and entry.get('completion_price') is not None:
+            self.price = entry['prompt_price'] + entry['completion_price']
+
+    @property
+    def expected_seconds(self):
+        """Time to first token plus a reference answer, inflated by the chance of having to retry."""
+        reference_tokens = getattr(settings, 'LLM_ROUTER_REFERENCE_TOKENS', 500)
+        ttft = self.ttft_p90 if self.ttft_p90 is not None else PRIOR_TTFT
+        speed = self.tokens_per_second or PRIOR_TOKENS_PER_SECOND
+        return (ttft + reference_tokens / speed) / (1 - min(self.error_rate, MAX_ERROR_RATE))
+
+    def as_dict(self):
+        return {
+            'model': self.model,
+            'ttft_p90': self.ttft_p90,
+            'tokens_per_second': self.tokens_per_second,
+            'error_rate': self.error_rate,
+            'price': self.price,
+            'expected_seconds': round(self.expected_seconds, 3),
+        }
+
+
+class RouteDecision:
+    """The order a request tries its models in, and why."""
+
+    def __init__(self, policy, requested, candidates, order):
+        self.id = uuid.uuid4().hex[:12]
+        self.policy = policy
+        self.requested = requested
+        self.candidates = candidates
+        self.order = order
+
+    def log(self):
+        if not decision_log.isEnabledFor(logging.DEBUG):
+            return
+        decision_log.debug(json.dumps({
+            'event': 'route',
+            'id': self.id,
+            'policy': self.policy,
+            'requested': self.requested,
+            'order': self.order,
+            'candidates': [c.as_dict() for c in self.candidates],
+        }))
+
+    def served(self, model, kind, latency, ttft=None, completion_tokens=None):
+        """Log the model that answered, with its observed timings."""
+        if not decision_log.isEnabledFor(logging.DEBUG):
+            return
+        decision_log.debug(json.dumps({
+            'event': 'served',
+            'id': self.id,
+            'policy': self.policy,
+            'model': model,
+            'rank': self.order.index(model) if model in self.order else None,
+            'kind': kind,
+            'latency': round(latency, 3),
+            'ttft': round(ttft, 3) if ttft is not None else None,
+            'completion_tokens': completion_tokens,
+        }))
+
+
+def _rank(policy, candidates, requested):
+    by_speed = lambda c: c.expected_seconds
+    if policy == 'fastest':
+        return sorted(candidates, key=by_speed)
+    if policy == 'cheapest':
+        max_p90 = getattr(settings, 'LLM_ROUTER_MAX_P90', 3.0)
+        eligible = [
+            c for c in candidates
+            if (c.ttft_p90 is None or c.ttft_p90 <= max_p90) and c.error_rate < UNHEALTHY_ERROR_RATE
+        ]
+        rest = [c for c in candidates if c not in eligible]
+        eligible.sort(key=lambda c: c.price if c.price is not None else float('inf'))
+        return eligible + sorted(rest, key=by_speed)
+    # 'pinned': the pick stays first (if its circuit is closed)
+    pinned = [c for c in candidates if c.model == requested]
+    return pinned + sorted([c for c in candidates if c.model != requested], key=by_speed)
+
+
+def route(requested, fallbacks, policy=None):
+    """
+    Decide the order to try `requested` and its `fallbacks` in. Open circuits
+    are skipped (the one reopening soonest is kept if all are open). Returns a
+    logged RouteDecision.
+    """
+    policy = policy if policy in POLICIES else default_policy()
+    models = [requested] + [m for m in fallbacks if m != requested]
+    available = model_health.filter_available(models)
+    stats = model_health.stats(available)
+    # Prices come from the catalog (on the event loop, from the list this worker holds)
+    candidates = [Candidate(m, stats.get(m, {}), model_catalog.lookup(m)) for m in available]
+    ranked = _rank(policy, candidates, requested)
+    decision = RouteDecision(policy, requested, candidates, [c.model for c in ranked])
+    try:
+        decision.log()
+    except Exception as e:
+        logger.warning(f"Could not log routing decision: {e}")
+    return decision
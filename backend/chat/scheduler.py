@@ -0,0 +1,267 @@
+"""
+Upstream concurrency scheduler.
+
+Every upstream LLM call takes a slot first. The scheduler caps concurrent
+calls per worker process and per user, and queues the rest in priority order:
+interactive sends from paying users, then other interactive sends, then
+background jobs (titles, summaries). The queue is bounded; when the expected
+wait for an interactive request is past the latency target, it is rejected at
+once with UpstreamOverloaded (a 503 with Retry-After) instead of timing out.
+
+Slots can be taken from worker threads (sync views, background tasks) and
+from the event loop (streaming), so the state is guarded by a threading lock
+and async waiters are woken through their loop.
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from bisect import insort
+from contextlib import contextmanager
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Priority tiers (lower runs first)
+INTERACTIVE_PAID = 0
+INTERACTIVE = 1
+BACKGROUND = 2
+
+TIER_NAMES = {INTERACTIVE_PAID: 'interactive_paid', INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+PAID_CACHE_PREFIX = 'sched:paid:'
+PAID_CACHE_TTL = 300
+
+
+class UpstreamOverloaded(Exception):
+    """Raised when a request is shed because the upstream queue is too long."""
+
+    def __init__(self, retry_after):
+        super().__init__("The AI service is busy right now. Please retry in a few seconds.")
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+def user_priority(user):
+    """Interactive tier for a user: paid if they have a successful payment (cached briefly)."""
+    from payments.models import Payment
+
+    key = f'{PAID_CACHE_PREFIX}{user.id}'
+    paid = cache.get(key)
+    if paid is None:
+        paid = Payment.objects.filter(user=user, status='success').exists()
+        cache.set(key, paid, PAID_CACHE_TTL)
+    return INTERACTIVE_PAID if paid else INTERACTIVE
+
+
+def forget_user_priority(user_id):
+    """Drop the cached tier (e.g. right after a payment succeeds)."""
+    cache.delete(f'{PAID_CACHE_PREFIX}{user_id}')
+
+
+class Lease:
+    """A queued or granted request for an upstream slot."""
+
+    __slots__ = ('priority', 'seq', 'user_id', 'enqueued_at', 'granted_at', 'released', 'event', 'loop', 'future')
+
+    def __init__(self, priority, seq, user_id):
+        self.priority = priority
+        self.seq = seq
+        self.user_id = user_id
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.released = False
+        self.event = None
+        self.loop = None
+        self.future = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def _wake(self):
+        if self.event is not None:
+            self.event.set()
+        elif self.future is not None:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class UpstreamScheduler:
+    """Process-wide slot allocator for upstream LLM calls."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = []            # Leases waiting, sorted by (priority, seq)
+        self._active = 0
+        self._per_user = Counter()
+        self._seq = 0
+        self._mean_hold = None      # EMA of how long a slot is held (seconds)
+        self.granted = Counter()
+        self.rejected = Counter()
+
+    def _reset_after_fork(self):
+        self.__init__()
+
+    @property
+    def max_concurrency(self):
+        return getattr(settings, 'LLM_SCHEDULER_MAX_CONCURRENCY', 32)
+
+    @property
+    def max_per_user(self):
+        return getattr(settings, 'LLM_SCHEDULER_MAX_PER_USER', 3)
+
+    @property
+    def max_queue(self):
+        return getattr(settings, 'LLM_SCHEDULER_MAX_QUEUE', 100)
+
+    @property
+    def queue_target(self):
+        return getattr(settings, 'LLM_SCHEDULER_QUEUE_TARGET', 10.0)
+
+    def _max_wait(self, priority):
+        if priority == BACKGROUND:
+            return getattr(settings, 'LLM_SCHEDULER_BACKGROUND_MAX_WAIT', 300.0)
+        return self.queue_target
+
+    def _estimated_wait(self, lease):
+        """Expected queueing delay: the work ahead of this lease spread over all slots."""
+        ahead = sum(1 for other in self._queue if other < lease)
+        hold = self._mean_hold if self._mean_hold is not None else 5.0
+        return (ahead + 1) * hold / max(1, self.max_concurrency)
+
+    def _dispatch(self):
+        """Grant slots to waiting leases in priority order (caller holds the lock)."""
+        index = 0
+        while index < len(self._queue) and self._active < self.max_concurrency:
+            lease = self._queue[index]
+            if lease.user_id is not None and self._per_user[lease.user_id] >= self.max_per_user:
+                index += 1
+                continue
+            self._queue.pop(index)
+            self._grant(lease)
+
+    def _grant(self, lease):
+        self._active += 1
+        if lease.user_id is not None:
+            self._per_user[lease.user_id] += 1
+        lease.granted_at = time.monotonic()
+        self.granted[TIER_NAMES[lease.priority]] += 1
+        lease._wake()
+
+    def _enqueue(self, user_id, priority, lease_setup):
+        with self._lock:
+            self._seq += 1
+            lease = Lease(priority, self._seq, user_id)
+            lease_setup(lease)
+            insort(self._queue, lease)
+            self._dispatch()
+            if lease.granted_at is not None:
+                return lease
+
+            # Has to wait: shed interactive load the queue can't serve in time
+            if priority != BACKGROUND:
+                wait = self._estimated_wait(lease)
+                if len(self._queue) > self.max_queue or wait > self.queue_target:
+                    self._queue.remove(lease)
+                    self.rejected[TIER_NAMES[priority]] += 1
+                    raise UpstreamOverloaded(wait)
+            return lease
+
+    def _give_up(self, lease):
+        """Leave the queue after a timeout. Returns False if the slot was granted meanwhile."""
+        with self._lock:
+            if lease.granted_at is not None:
+                return False
+            self._queue.remove(lease)
+            self.rejected[TIER_NAMES[lease.priority]] += 1
+            wait = self._estimated_wait(lease)
+        return wait
+
+    def acquire(self, user_id=None, priority=BACKGROUND):
+        """Take a slot from a worker thread, waiting in the queue if needed."""
+        def setup(lease):
+            lease.event = threading.Event()
+
+        lease = self._enqueue(user_id, priority, setup)
+        if lease.granted_at is None and not lease.event.wait(self._max_wait(priority)):
+            wait = self._give_up(lease)
+            if wait is not False:
+                raise UpstreamOverloaded(wait)
+        return lease
+
+    async def aacquire(self, user_id=None, priority=INTERACTIVE):
+        """Take a slot from the event loop without blocking it."""
+        loop = asyncio.get_running_loop()
+
+        def setup(lease):
+            lease.loop = loop
+            lease.future = loop.create_future()
+
+        lease = self._enqueue(user_id, priority, setup)
+        if lease.granted_at is not None:
+            return lease
+        try:
+            await asyncio.wait_for(asyncio.shield(lease.future), self._max_wait(priority))
+        except asyncio.TimeoutError:
+            wait = self._give_up(lease)
+            if wait is not False:
+                raise UpstreamOverloaded(wait)
+        except asyncio.CancelledError:
+            if self._give_up(lease) is False:
+                self.release(lease)
+            raise
+        return lease
+
+    def release(self, lease):
+        """Return a granted slot and hand it to the next waiting request. Releasing a lease again is a no-op."""
+        with self._lock:
+            if lease.released:
+                return
+            lease.released = True
+            held = time.monotonic() - lease.granted_at
+            self._active -= 1
+            if lease.user_id is not None:
+                self._per_user[lease.user_id] -= 1
+                if self._per_user[lease.user_id] <= 0:
+                    del self._per_user[lease.user_id]
+            self._mean_hold = held if self._mean_hold is None else self._mean_hold + 0.1 * (held - self._mean_hold)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, user_id=None, priority=BACKGROUND):
+        """Hold a slot for the duration of a block (sync callers)."""
+        lease = self.acquire(user_id, priority)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def stats(self):
+        with self._lock:
+            waiting = Counter(TIER_NAMES[lease.priority] for lease in self._queue)
+            oldest = max((time.monotonic() - lease.enqueued_at for lease in self._queue), default=0.0)
+            return {
+                'active': self._active,
+                'max_concurrency': self.max_concurrency,
+                'max_per_user': self.max_per_user,
+                'waiting': dict(waiting),
+                'oldest_wait': round(oldest, 3),
+                'mean_hold': round(self._mean_hold, 3) if self._mean_hold is not None else None,
+                'granted': dict(self.granted),
+                'rejected': dict(self.rejected),
+            }
+
+
+# Process-wide scheduler
+scheduler = UpstreamScheduler()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=scheduler._reset_after_fork)
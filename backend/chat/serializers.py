@@ -2,7 +2,8 @@
 Serializers for chat functionality.
 """
 from rest_framework import serializers
-from .models import Conversation, Message
+from .models import Conversation, Message, BatchJob
+from .router import POLICIES
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -10,8 +11,8 @@ class MessageSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Message
-        fields = ['id', 'role', 'content', 'tokens_used', 'created_at']
-        read_only_fields = ['id', 'tokens_used', 'created_at']
+        fields = ['id', 'role', 'content', 'tokens_used', 'status', 'created_at']
+        read_only_fields = ['id', 'tokens_used', 'status', 'created_at']
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -64,6 +65,44 @@ class SendMessageSerializer(serializers.Serializer):
     provider = serializers.CharField(required=False, default='gemini')
     model = serializers.CharField(required=False, allow_null=True)
     persona = serializers.CharField(required=False, default='general')
+    hedge = serializers.BooleanField(required=False, default=False)
+    routing = serializers.ChoiceField(choices=POLICIES, required=False)
+
+
+class CompareModelsSerializer(serializers.Serializer):
+    """Serializer for sending one message to several models side by side."""
+    
+    message = serializers.CharField(required=True, max_length=10000)
+    models = serializers.ListField(child=serializers.CharField(), min_length=2)
+    conversation_id = serializers.IntegerField(required=True)
+    persona = serializers.CharField(required=False, default='general')
+
+
+class BatchJobSerializer(serializers.ModelSerializer):
+    """Serializer for batch jobs (progress only, results are streamed separately)."""
+    
+    progress = serializers.ReadOnlyField()
+    stalled = serializers.ReadOnlyField(source='is_stalled')
+    
+    class Meta:
+        model = BatchJob
+        fields = [
+            'id', 'model', 'status', 'conversation', 'prompt_template', 'max_tokens',
+            'total_items', 'completed_items', 'failed_items', 'progress', 'total_tokens',
+            'stalled', 'created_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = fields
+
+
+class CreateBatchJobSerializer(serializers.Serializer):
+    """Serializer for submitting a batch job (the JSONL comes as `input` or an uploaded `file`)."""
+    
+    model = serializers.CharField(required=True)
+    input = serializers.CharField(required=False, allow_blank=True, trim_whitespace=False)
+    prompt_template_id = serializers.IntegerField(required=False, allow_null=True)
+    conversation_id = serializers.IntegerField(required=False, allow_null=True)
+    system_prompt = serializers.CharField(required=False, allow_blank=True, default='')
+    max_tokens = serializers.IntegerField(required=False, min_value=1, max_value=4000, default=1000)
 
 
 class CreateConversationSerializer(serializers.ModelSerializer):
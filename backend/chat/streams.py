@@ -0,0 +1,254 @@
+"""
+Resumable stream sessions.
+
+A generation runs as a task that publishes numbered events to a StreamSession,
+independently of the HTTP response that started it. Responses subscribe to the
+session and send the sequence number as the SSE `id:`, so a client that drops
+off can reconnect with Last-Event-ID, get the events it missed replayed and
+attach to the still-running generation without a new upstream call.
+
+Sessions live in the worker process and are kept for a short while after the
+generation ends, for late reconnects. The partial answer is also checkpointed
+to the assistant Message, which covers reconnects that land on another worker.
+
+When the last subscriber disconnects and nobody reattaches within a short
+grace period, the generation is cancelled so the upstream stream is closed
+instead of running on to max_tokens.
+"""
+import time
+import asyncio
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _token(parts):
+    return {'type': 'token', 'content': ''.join(parts)}
+
+
+class StreamSession:
+    """Event buffer and subscribers for one in-progress generation."""
+
+    def __init__(self, message_id, user_id):
+        self.message_id = message_id
+        self.user_id = user_id
+        self.events = []            # (seq, payload), seq starts at 1
+        self.finished = False
+        self.task = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    @property
+    def last_seq(self):
+        return self.events[-1][0] if self.events else 0
+
+    def publish(self, payload):
+        """Append an event and wake the subscribers. Returns its sequence number."""
+        seq = self.last_seq + 1
+        self.events.append((seq, payload))
+        self._notify()
+        return seq
+
+    def finish(self):
+        self.finished = True
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def start(self, generation):
+        """
+        Run the generation coroutine as a task (once); it outlives any single subscriber.
+        If nobody subscribes within the disconnect grace period, it is cancelled like an abandoned one.
+        """
+        if self.task is None:
+            self.task = asyncio.ensure_future(generation)
+            self.task.add_done_callback(self._on_done)
+            self._schedule_idle_cancel()
+        else:
+            generation.close()
+
+    def _on_done(self, task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Stream session {self.message_id} failed: {task.exception()}")
+        self.finish()
+        stream_registry.expire(self.message_id)
+
+    async def subscribe(self, after=0, coalesce=None, max_bytes=None, disconnected=None):
+        """
+        Yield (seq, payload) for events after `after`, live until the session finishes.
+
+        Consecutive token events are coalesced into one (sent with the last
+        token's seq) until `coalesce` seconds have passed since the first
+        buffered token or `max_bytes` are pending. The first token is sent
+        right away so time-to-first-token is unchanged. Ends early once the
+        `disconnected` event (set by the ASGI app when the client goes away) is set.
+        """
+        if coalesce is None:
+            coalesce = getattr(settings, 'LLM_STREAM_COALESCE_WINDOW', 0.03)
+        if max_bytes is None:
+            max_bytes = getattr(settings, 'LLM_STREAM_COALESCE_BYTES', 256)
+
+        self.subscribers += 1
+        watcher = asyncio.ensure_future(self._wake_on(disconnected)) if disconnected else None
+        try:
+            async for event in self._events_after(after, coalesce, max_bytes, disconnected):
+                yield event
+        finally:
+            if watcher:
+                watcher.cancel()
+            self.subscribers -= 1
+            if not self.subscribers and not self.finished:
+                self._schedule_idle_cancel()
+
+    async def _wake_on(self, disconnected):
+        await disconnected.wait()
+        self._notify()
+
+    def _schedule_idle_cancel(self):
+        grace = getattr(settings, 'LLM_STREAM_DISCONNECT_GRACE', 5)
+        asyncio.get_running_loop().call_later(grace, self._cancel_if_idle)
+
+    def _cancel_if_idle(self):
+        if not self.subscribers and not self.finished and self.task is not None:
+            logger.info(f"Stream session {self.message_id}: client gone, cancelling generation")
+            self.task.cancel()
+
+    async def _events_after(self, after, coalesce, max_bytes, disconnected):
+        index = 0
+        pending = []
+        pending_seq = pending_bytes = 0
+        deadline = None
+        first_sent = False
+        while True:
+            changed = self._changed
+            if disconnected is not None and disconnected.is_set():
+                return
+            while index < len(self.events):
+                seq, payload = self.events[index]
+                index += 1
+                if seq <= after:
+                    continue
+                if payload['type'] != 'token' or coalesce <= 0:
+                    if pending:
+                        yield pending_seq, _token(pending)
+                        pending, pending_bytes, deadline = [], 0, None
+                    yield seq, payload
+                    continue
+
+                pending.append(payload['content'])
+                pending_seq = seq
+                pending_bytes += len(payload['content'].encode('utf-8'))
+                if not first_sent or pending_bytes >= max_bytes:
+                    first_sent = True
+                    yield pending_seq, _token(pending)
+                    pending, pending_bytes, deadline = [], 0, None
+                elif deadline is None:
+                    deadline = time.monotonic() + coalesce
+
+            if pending and (self.finished or time.monotonic() >= deadline):
+                yield pending_seq, _token(pending)
+                pending, pending_bytes, deadline = [], 0, None
+            if self.finished:
+                return
+            try:
+                timeout = max(0.0, deadline - time.monotonic()) if pending else None
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class StreamRegistry:
+    """Stream sessions of this worker process, keyed by assistant message id."""
+
+    def __init__(self):
+        self._sessions = {}
+
+    def create(self, message_id, user_id):
+        session = self._sessions[message_id] = StreamSession(message_id, user_id)
+        return session
+
+    def get(self, message_id, user_id):
+        session = self._sessions.get(message_id)
+        if session is None or session.user_id != user_id:
+            return None
+        return session
+
+    def expire(self, message_id):
+        """Drop a finished session once late reconnects are no longer expected."""
+        ttl = getattr(settings, 'LLM_STREAM_SESSION_TTL', 60)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._sessions.pop(message_id, None)
+            return
+        loop.call_later(ttl, self._sessions.pop, message_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class Checkpointer:
+    """Decides when a partial answer is due to be written back (every N tokens or M seconds)."""
+
+    def __init__(self):
+        self.every_tokens = getattr(settings, 'LLM_STREAM_CHECKPOINT_TOKENS', 50)
+        self.every_seconds = getattr(settings, 'LLM_STREAM_CHECKPOINT_INTERVAL', 1.0)
+        self._tokens = 0
+        self._last = time.monotonic()
+
+    def tick(self):
+        """Count one token. True when a checkpoint is due."""
+        self._tokens += 1
+        if self._tokens >= self.every_tokens or time.monotonic() - self._last >= self.every_seconds:
+            self._tokens = 0
+            self._last = time.monotonic()
+            return True
+        return False
+
+
+class StreamStats:
+    """Counters for streams that were cancelled because the client went away."""
+
+    def __init__(self):
+        self.completed = 0
+        self.cancelled = 0
+        self.tokens_generated_before_cancel = 0
+        self.tokens_saved = 0
+        self._mean_completion = None
+
+    def record_completed(self, completion_tokens):
+        self.completed += 1
+        if self._mean_completion is None:
+            self._mean_completion = float(completion_tokens)
+        else:
+            self._mean_completion += 0.05 * (completion_tokens - self._mean_completion)
+
+    def record_cancelled(self, generated_tokens, max_tokens):
+        """
+        Count a cancelled stream. The tokens saved are estimated as what a typical
+        answer would still have produced (mean completed length, capped by max_tokens).
+        """
+        expected = self._mean_completion if self._mean_completion is not None else max_tokens / 4
+        saved = int(max(0, min(max_tokens, expected) - generated_tokens))
+        self.cancelled += 1
+        self.tokens_generated_before_cancel += generated_tokens
+        self.tokens_saved += saved
+        return saved
+
+    def snapshot(self):
+        return {
+            'active_sessions': len(stream_registry),
+            'completed': self.completed,
+            'cancelled_on_disconnect': self.cancelled,
+            'tokens_generated_before_cancel': self.tokens_generated_before_cancel,
+            'tokens_saved_estimate': self.tokens_saved,
+        }
+
+
+# Process-wide registry and counters
+stream_registry = StreamRegistry()
+stream_stats = StreamStats()
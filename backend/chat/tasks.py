@@ -0,0 +1,637 @@
+"""
+Background tasks for the chat app.
+
+These run on daemon threads inside the worker process (the same approach the
+knowledge base uses for document processing), so they never block a request.
+"""
+import os
+import json
+import atexit
+import time
+import queue
+import logging
+import threading
+from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .deadlines import Deadline
+from .scheduler import scheduler, BACKGROUND, UpstreamOverloaded
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TITLE = 'New Conversation'
+
+
+def fallback_title(first_message):
+    """Title used when generation fails: the start of the first message."""
+    return first_message[:50] + "..." if len(first_message) > 50 else first_message
+
+
+def _clean_title(title):
+    return str(title).strip().strip('"').strip()[:100]
+
+
+class BackgroundWorker:
+    """A queue drained by a lazily started daemon thread (restarted after fork)."""
+
+    thread_name = 'chat-worker'
+
+    def __init__(self):
+        self._reset_after_fork()
+
+    def _reset_after_fork(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        raise NotImplementedError
+
+
+class TitleGenerator(BackgroundWorker):
+    """
+    Generates conversation titles off the request path.
+
+    Pending titles are collected for a short window and sent to a cheap, fast
+    model in a single upstream call. The title is written to the conversation
+    (only if it still has the default title) and returned through a Future so a
+    stream that is still open can push it to the client.
+    """
+
+    thread_name = 'title-generator'
+
+    def enqueue(self, conversation_id, first_message):
+        """Schedule a title for a conversation. Returns a Future resolving to the title."""
+        future = Future()
+        self._queue.put((conversation_id, first_message, future))
+        self._ensure_worker()
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        window = getattr(settings, 'LLM_TITLE_BATCH_WINDOW', 0.5)
+        max_batch = getattr(settings, 'LLM_TITLE_MAX_BATCH', 8)
+        while len(batch) < max_batch:
+            try:
+                batch.append(self._queue.get(timeout=window))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                titles = self._generate([item[1] for item in batch])
+            except Exception as e:
+                logger.error(f"Title Gen Error: {e}")
+                titles = [None] * len(batch)
+
+            try:
+                self._save(batch, titles)
+            except Exception as e:
+                logger.error(f"Failed to save conversation titles: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                close_old_connections()
+
+    def _generate(self, messages):
+        """One upstream call for the whole batch. Returns a title (or None) per message."""
+        from .ai_providers import OpenRouterProvider, UpstreamCall
+
+        provider = OpenRouterProvider(getattr(settings, 'LLM_TITLE_MODEL', 'google/gemini-2.0-flash-001'))
+        numbered = '\n'.join(f"{i + 1}. {json.dumps(msg[:500])}" for i, msg in enumerate(messages))
+        prompt = [{
+            'role': 'user',
+            'content': (
+                f"Generate a short (max 5 words) conversation title for each of these {len(messages)} "
+                f"first messages:\n{numbered}\n\n"
+                f"Respond ONLY with a JSON array of {len(messages)} strings, in the same order."
+            ),
+        }]
+        with scheduler.slot(priority=BACKGROUND):
+            text, _, _ = provider.generate_response(
+                prompt, max_tokens=20 * len(messages) + 20, deadline=Deadline.for_endpoint('background'),
+                call=UpstreamCall('title')
+            )
+
+        text = (text or '').strip()
+        start, end = text.find('['), text.rfind(']')
+        titles = None
+        if start != -1 and end > start:
+            try:
+                titles = json.loads(text[start:end + 1])
+            except ValueError:
+                titles = None
+        if not isinstance(titles, list):
+            # Not JSON: accept one title per line
+            titles = [line.lstrip('0123456789.-) ') for line in text.splitlines() if line.strip()]
+        if len(titles) != len(messages):
+            return [None] * len(messages)
+        return [_clean_title(t) or None for t in titles]
+
+    def _save(self, batch, titles):
+        from .models import Conversation
+
+        for (conversation_id, first_message, future), title in zip(batch, titles):
+            title = title or fallback_title(first_message)
+            Conversation.objects.filter(id=conversation_id, title=DEFAULT_TITLE).update(title=title)
+            future.set_result(title)
+
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the new messages into the current summary. Keep the user's goals, preferences and constraints, "
+    "decisions made, open questions, and any names, numbers, file names or code identifiers that may be "
+    "referred to later. Drop greetings and filler. Write compact prose or bullet points, at most "
+    "{max_words} words. Respond ONLY with the updated summary."
+)
+
+
+def _transcript(turns):
+    lines = []
+    for turn in turns:
+        # Follow-up suggestions are not part of the conversation
+        content = turn['content'].split('===RELATED===')[0].strip()
+        lines.append(f"{turn['role'].upper()}: {content[:4000]}")
+    return '\n\n'.join(lines)
+
+
+class ConversationSummarizer(BackgroundWorker):
+    """
+    Compacts long conversations into a rolling summary.
+
+    When the unsummarized history of a conversation grows past a threshold, the
+    oldest turns (everything but a verbatim tail of recent messages) are folded
+    into the stored summary, a chunk at a time. Context assembly then sends the
+    summary in place of those turns.
+    """
+
+    thread_name = 'conversation-summarizer'
+    MAX_PASSES = 5      # Chunks folded per scheduling, so one huge backlog can't hog the worker
+
+    def _reset_after_fork(self):
+        super()._reset_after_fork()
+        self._pending = set()
+
+    def enqueue(self, conversation_id):
+        """Schedule compaction of a conversation (no-op if it is already scheduled)."""
+        if not getattr(settings, 'LLM_SUMMARY_ENABLED', True):
+            return
+        with self._lock:
+            if conversation_id in self._pending:
+                return
+            self._pending.add(conversation_id)
+        self._queue.put(conversation_id)
+        self._ensure_worker()
+
+    def _run(self):
+        while True:
+            conversation_id = self._queue.get()
+            try:
+                for _ in range(self.MAX_PASSES):
+                    if not self.compact(conversation_id):
+                        break
+            except Exception as e:
+                logger.error(f"Summarization failed for conversation {conversation_id}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(conversation_id)
+                close_old_connections()
+
+    def compact(self, conversation_id):
+        """Fold the next chunk of old turns into the summary. Returns True if anything was folded."""
+        from django.db.models import Exists, OuterRef, Sum
+        from .models import Conversation, Message
+        from .tokenizers import MESSAGE_OVERHEAD, count_tokens
+
+        keep_recent = getattr(settings, 'LLM_SUMMARY_KEEP_RECENT_TOKENS', 2000)
+        chunk_tokens = getattr(settings, 'LLM_SUMMARY_CHUNK_TOKENS', 6000)
+        summary_model = getattr(settings, 'LLM_SUMMARY_MODEL', 'google/gemini-2.0-flash-001')
+
+        conversation = Conversation.objects.filter(id=conversation_id).first()
+        if conversation is None:
+            return False
+        pending = conversation.messages.all()
+        if conversation.summary_until is not None:
+            pending = pending.filter(created_at__gt=conversation.summary_until)
+
+        backlog = pending.aggregate(total=Sum('tokens_used'))['total'] or 0
+        if backlog <= keep_recent:
+            return False
+
+        # Oldest unsummarized turns, stopping before the recent tail we keep verbatim
+        turns = []
+        used = 0
+        rows = pending.order_by('created_at', 'id').values('id', 'role', 'content', 'tokens_used', 'created_at')
+        for row in rows.iterator(chunk_size=50):
+            # Unaccounted turns are counted the way the summary model sees them
+            tokens = row['tokens_used'] or count_tokens(row['content'], summary_model, cache=True) + MESSAGE_OVERHEAD
+            if backlog - used - tokens < keep_recent or (turns and used + tokens > chunk_tokens):
+                break
+            turns.append(row)
+            used += tokens
+        if not turns:
+            return False
+
+        summary = self._summarize(conversation.summary, turns)
+        if not summary:
+            return False
+
+        # Only apply on top of the summary we read, and only if the turns are still there (a history
+        # cleared meanwhile leaves summary_until unchanged at None, but takes the messages with it)
+        updated = Conversation.objects.filter(
+            Exists(Message.objects.filter(id=turns[-1]['id'], conversation=OuterRef('pk'))),
+            id=conversation_id, summary_until=conversation.summary_until,
+        ).update(
+            summary=summary,
+            summary_until=turns[-1]['created_at'],
+            summary_tokens=count_tokens(summary),
+        )
+        if updated:
+            logger.info(f"Conversation {conversation_id}: folded {len(turns)} messages ({used} tokens) into the summary")
+        return bool(updated)
+
+    def _summarize(self, previous, turns):
+        from .ai_providers import OpenRouterProvider, UpstreamCall
+
+        max_words = getattr(settings, 'LLM_SUMMARY_MAX_WORDS', 300)
+        provider = OpenRouterProvider(getattr(settings, 'LLM_SUMMARY_MODEL', 'google/gemini-2.0-flash-001'))
+        prompt = [
+            {'role': 'system', 'content': SUMMARY_INSTRUCTIONS.format(max_words=max_words)},
+            {'role': 'user', 'content': (
+                f"Current summary:\n{previous or '(none yet)'}\n\n"
+                f"New messages:\n{_transcript(turns)}"
+            )},
+        ]
+        with scheduler.slot(priority=BACKGROUND):
+            text, _, _ = provider.generate_response(
+                prompt, max_tokens=max_words * 2, deadline=Deadline.for_endpoint('background'),
+                call=UpstreamCall('summary')
+            )
+        return (text or '').strip()
+
+
+class _TemplateVariables(dict):
+    """Leaves unknown {placeholders} in a template as they are."""
+
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+
+def parse_batch_prompts(text, template=None):
+    """
+    Prompts from a JSONL batch input, one per non-empty line. Returns a list of
+    (input, prompt) pairs; raises ValueError naming the first bad line.
+
+    Without a template, a line is a JSON string or an object with a "prompt".
+    With a template, a line is an object of template variables (or
+    {"variables": {...}}), or a string filling the {input} placeholder.
+    """
+    items = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError:
+            raise ValueError(f"Line {number} is not valid JSON")
+
+        if template is not None:
+            if isinstance(value, str):
+                variables = {'input': value}
+            elif isinstance(value, dict):
+                variables = value.get('variables', value)
+            else:
+                raise ValueError(f"Line {number} must be a string or an object of template variables")
+            prompt = template.content.format_map(_TemplateVariables(variables))
+        elif isinstance(value, str):
+            prompt = value
+        elif isinstance(value, dict) and isinstance(value.get('prompt'), str):
+            prompt = value['prompt']
+        else:
+            raise ValueError(f"Line {number} must be a string or an object with a \"prompt\"")
+
+        if not prompt.strip():
+            raise ValueError(f"Line {number} has an empty prompt")
+        items.append((value, prompt))
+    return items
+
+
+def batch_item_timeout():
+    """
+    Seconds a batch item can legitimately stay running: the longest wait for a
+    background slot plus the batch deadline, with LLM_BATCH_STALL_AFTER to
+    spare. A running item older than that belongs to a worker that went away.
+    """
+    return (
+        getattr(settings, 'LLM_SCHEDULER_BACKGROUND_MAX_WAIT', 300.0)
+        + Deadline.for_endpoint('batch').budget
+        + getattr(settings, 'LLM_BATCH_STALL_AFTER', 300)
+    )
+
+
+class BatchRunner(BackgroundWorker):
+    """
+    Processes batch jobs off the request path.
+
+    Jobs run one at a time per worker process, their items on a bounded thread
+    pool. Every call goes through the provider's usual retry and fallback
+    chain and takes a background scheduler slot, so interactive requests are
+    always served first. Items are claimed atomically, which lets any worker
+    pick up a stalled job without running an item twice, and each item reserves
+    its tokens before it runs, so concurrent items can't overdraw the
+    conversation. Finished items are saved together, as messages in the job's
+    conversation. A running job records a heartbeat every
+    LLM_BATCH_HEARTBEAT_INTERVAL seconds, so only a job whose worker went away
+    looks stalled.
+    """
+
+    thread_name = 'batch-runner'
+
+    def enqueue(self, job_id):
+        self._queue.put(job_id)
+        self._ensure_worker()
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self.process(job_id)
+            except Exception as e:
+                logger.error(f"Batch job {job_id} failed: {e}")
+            finally:
+                close_old_connections()
+
+    def process(self, job_id):
+        from .models import BatchJob
+
+        job = BatchJob.objects.get(id=job_id)
+        if not job.is_active:
+            return
+        now = timezone.now()
+        BatchJob.objects.filter(id=job_id, status='queued').update(status='running', started_at=now, heartbeat_at=now)
+
+        # Items left running by a worker that died are tried again (not ones still waiting or generating)
+        self._reset_stale_items(job, now - timedelta(seconds=batch_item_timeout()))
+
+        concurrency = max(1, getattr(settings, 'LLM_BATCH_CONCURRENCY', 4))
+        heartbeat = getattr(settings, 'LLM_BATCH_HEARTBEAT_INTERVAL', 30)
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch-item') as pool:
+            while BatchJob.objects.filter(id=job_id, status='running').exists():
+                ids = list(
+                    job.items.filter(status='pending').order_by('index')
+                    .values_list('id', flat=True)[:concurrency * 4]
+                )
+                if not ids:
+                    break
+                running = {pool.submit(self._run_item, job, item_id) for item_id in ids}
+                while running:
+                    # Items can wait minutes for a slot or an answer: keep the job visibly alive meanwhile
+                    BatchJob.objects.filter(id=job_id, status='running').update(heartbeat_at=timezone.now())
+                    finished, running = wait(running, timeout=heartbeat)
+                    results = [future.result() for future in finished if future.result() is not None]
+                    if results:
+                        self._save_results(job, results)
+
+        if not job.items.filter(status__in=('pending', 'running')).exists():
+            BatchJob.objects.filter(id=job_id, status='running').update(status='completed', finished_at=timezone.now())
+
+    def _reset_stale_items(self, job, stale):
+        from .models import BatchItem, Conversation
+
+        with transaction.atomic():
+            stale_items = list(
+                job.items.select_for_update().filter(status='running', started_at__lt=stale)
+                .values_list('id', 'reserved_tokens')
+            )
+            if not stale_items:
+                return
+            BatchItem.objects.filter(id__in=[item_id for item_id, _ in stale_items]).update(
+                status='pending', started_at=None, reserved_tokens=0,
+            )
+            refund = sum(reserved for _, reserved in stale_items)
+            if refund:
+                Conversation.objects.filter(id=job.conversation_id).update(total_tokens_used=F('total_tokens_used') - refund)
+
+    def _reserve(self, job, item, prompt_tokens):
+        """
+        Charge the conversation for an item's prompt and its largest answer before it runs, so
+        items running side by side can't spend the same tokens. The charge is only taken if it
+        still fits when it is written. Returns the answer's max_tokens, or None if it doesn't fit.
+        """
+        from .models import BatchItem, Conversation
+
+        for _ in range(3):
+            row = Conversation.objects.filter(id=job.conversation_id).values('token_limit', 'total_tokens_used').first()
+            room = row['token_limit'] - row['total_tokens_used'] - prompt_tokens if row else 0
+            if room < 500:
+                return None
+            # Never generate more than the conversation can still pay for
+            max_tokens = min(job.max_tokens, room)
+            reserved = prompt_tokens + max_tokens
+            with transaction.atomic():
+                taken = Conversation.objects.filter(
+                    id=job.conversation_id, total_tokens_used__lte=F('token_limit') - reserved
+                ).update(total_tokens_used=F('total_tokens_used') + reserved)
+                if taken:
+                    BatchItem.objects.filter(id=item.id).update(reserved_tokens=reserved)
+                    item.reserved_tokens = reserved
+                    return max_tokens
+        return None
+
+    def _release(self, job, item):
+        """Give an item's reservation back and return it to the queue."""
+        from .models import BatchItem, Conversation
+
+        with transaction.atomic():
+            Conversation.objects.filter(id=job.conversation_id).update(
+                total_tokens_used=F('total_tokens_used') - item.reserved_tokens
+            )
+            BatchItem.objects.filter(id=item.id).update(status='pending', started_at=None, reserved_tokens=0)
+
+    def _run_item(self, job, item_id):
+        """Run one item. Returns the finished item for _save_results, or None if it was not run."""
+        from .ai_providers import OpenRouterProvider, UpstreamCall
+        from .models import BatchItem
+
+        try:
+            claimed = BatchItem.objects.filter(id=item_id, status='pending').update(
+                status='running', started_at=timezone.now()
+            )
+            if not claimed:
+                return None
+            item = BatchItem.objects.get(id=item_id)
+
+            provider = OpenRouterProvider(job.model)
+            item.prompt_tokens = provider.count_tokens(item.prompt)
+            max_tokens = self._reserve(job, item, item.prompt_tokens)
+            if max_tokens is None:
+                item.status, item.error, item.prompt_tokens = 'failed', 'token_limit_exceeded', 0
+                return item
+
+            messages = [{'role': 'user', 'content': item.prompt}]
+            if job.system_prompt:
+                messages.insert(0, {'role': 'system', 'content': job.system_prompt})
+            try:
+                # Templated runs repeat prompts, so they may share cached answers
+                with scheduler.slot(priority=BACKGROUND):
+                    text, _, completion_tokens = provider.generate_response(
+                        messages, max_tokens=max_tokens, deadline=Deadline.for_endpoint('batch'),
+                        call=UpstreamCall('batch', job.user_id, job.conversation_id,
+                                          cacheable=job.prompt_template_id is not None)
+                    )
+            except UpstreamOverloaded as e:
+                # Busy with interactive traffic: leave the item for the next pass
+                self._release(job, item)
+                time.sleep(e.retry_after)
+                return None
+            except Exception as e:
+                item.status, item.error, item.prompt_tokens = 'failed', str(e)[:255], 0
+                return item
+
+            item.status, item.output, item.completion_tokens = 'done', text or '', completion_tokens
+            return item
+        except Exception as e:
+            logger.error(f"Batch item {item_id} error: {e}")
+            return None
+        finally:
+            close_old_connections()
+
+    def _save_results(self, job, items):
+        """
+        Write finished items in one transaction: their rows, the job's counters, and each answer
+        with its prompt as messages in the job's conversation (Message.bulk_record charges them
+        once), in place of the reservations.
+        """
+        from .models import BatchJob, BatchItem, Conversation, Message
+
+        now = timezone.now()
+        items = sorted(items, key=lambda item: item.index)
+        done = [item for item in items if item.status == 'done']
+        messages = []
+        for item in done:
+            messages.append(Message(conversation_id=job.conversation_id, user_id=job.user_id, role='user',
+                                    content=item.prompt, tokens_used=item.prompt_tokens))
+            messages.append(Message(conversation_id=job.conversation_id, role='assistant',
+                                    content=item.output, tokens_used=item.completion_tokens))
+        refund = sum(item.reserved_tokens for item in items)
+        for item in items:
+            item.finished_at = now
+            item.reserved_tokens = 0
+
+        with transaction.atomic():
+            if refund:
+                Conversation.objects.filter(id=job.conversation_id).update(
+                    total_tokens_used=F('total_tokens_used') - refund
+                )
+            Message.bulk_record(messages)
+            BatchItem.objects.bulk_update(items, [
+                'status', 'output', 'error', 'prompt_tokens', 'completion_tokens', 'reserved_tokens', 'finished_at',
+            ])
+            BatchJob.objects.filter(id=job.id).update(
+                completed_items=F('completed_items') + len(done),
+                failed_items=F('failed_items') + len(items) - len(done),
+                total_tokens=F('total_tokens') + sum(item.prompt_tokens + item.completion_tokens for item in done),
+                heartbeat_at=now,
+            )
+
+
+class UsageLedger(BackgroundWorker):
+    """
+    Writes the usage ledger (UsageRecord rows) off the request path.
+
+    Upstream calls only append a record to an in-memory queue. The writer
+    thread inserts them with one bulk_create per batch: up to
+    LLM_USAGE_FLUSH_SIZE rows, waiting at most LLM_USAGE_FLUSH_INTERVAL
+    seconds to fill one. If writes fall behind by LLM_USAGE_MAX_PENDING rows,
+    new records are dropped and counted instead of growing memory.
+    """
+
+    thread_name = 'usage-ledger'
+
+    def _reset_after_fork(self):
+        super()._reset_after_fork()
+        self.dropped = 0
+
+    def record(self, **fields):
+        """Queue one UsageRecord (model field values)."""
+        if self._queue.qsize() >= getattr(settings, 'LLM_USAGE_MAX_PENDING', 10000):
+            self.dropped += 1
+            return
+        fields.setdefault('created_at', timezone.now())
+        self._queue.put(fields)
+        self._ensure_worker()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        flush_size = getattr(settings, 'LLM_USAGE_FLUSH_SIZE', 200)
+        flush_at = time.monotonic() + getattr(settings, 'LLM_USAGE_FLUSH_INTERVAL', 2.0)
+        while len(batch) < flush_size:
+            remaining = flush_at - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} usage records: {e}")
+            finally:
+                close_old_connections()
+
+    def _write(self, batch):
+        from .models import UsageRecord
+
+        UsageRecord.objects.bulk_create([UsageRecord(**fields) for fields in batch])
+
+    def flush(self):
+        """Write everything queued right away (at shutdown)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} usage records at shutdown: {e}")
+
+
+title_generator = TitleGenerator()
+summarizer = ConversationSummarizer()
+batch_runner = BatchRunner()
+usage_ledger = UsageLedger()
+
+atexit.register(usage_ledger.flush)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=title_generator._reset_after_fork)
+    os.register_at_fork(after_in_child=summarizer._reset_after_fork)
+    os.register_at_fork(after_in_child=batch_runner._reset_after_fork)
+    os.register_at_fork(after_in_child=usage_ledger._reset_after_fork)
@@ -0,0 +1,1538 @@
+import json
+import time
+import asyncio
+import threading
+from datetime import timedelta
+from concurrent.futures import Future
+from unittest import mock
+
+import httpx
+import openai
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework.throttling import UserRateThrottle
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import catalog, clients, context, router, tokenizers
+from .ai_providers import OpenRouterProvider, UpstreamCall
+from .compare import ModelRun, compare_stream
+from .deadlines import Deadline, DeadlineExceeded, StreamTimeout
+from .catalog import ModelCatalogStore
+from .models import BatchItem, BatchJob, Conversation, Message, ModelCatalog
+from .prompt_cache import PromptCacheStats, cached_tokens, with_breakpoints
+from .response_cache import ResponseCache, response_cache
+from .scheduler import UpstreamScheduler, UpstreamOverloaded, BACKGROUND, INTERACTIVE, INTERACTIVE_PAID, scheduler
+from .streams import StreamSession, stream_registry
+from .tasks import DEFAULT_TITLE, BatchRunner, ConversationSummarizer, TitleGenerator
+from .views import _overloaded_response, sse_event
+
+
+class Interrupted(BaseException):
+    """Stands in for KeyboardInterrupt / GeneratorExit in a leader."""
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(ttl=60, max_entries=10, max_bytes=1024 * 1024)
+
+    def _follow(self, key, compute):
+        """Run call() as a follower on another thread once the leader is in flight."""
+        result = {}
+        thread = threading.Thread(target=lambda: result.setdefault('value', self.cache.call(key, compute)))
+        thread.start()
+        return thread, result
+
+    def _lead(self, key, failure):
+        """Start a leader that raises `failure` once released. Returns the release event and its thread."""
+        release = threading.Event()
+        started = threading.Event()
+
+        def compute():
+            started.set()
+            release.wait(5)
+            raise failure
+
+        def lead():
+            try:
+                self.cache.call(key, compute)
+            except BaseException:
+                pass
+
+        thread = threading.Thread(target=lead)
+        thread.start()
+        started.wait(5)
+        return release, thread
+
+    def test_follower_goes_upstream_when_leader_fails(self):
+        release, leader = self._lead('k', RuntimeError('upstream down'))
+        follower, result = self._follow('k', lambda: ('own answer', 1, 2))
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(result['value'], ('own answer', 1, 2))
+
+    def test_follower_goes_upstream_when_leader_is_interrupted(self):
+        release, leader = self._lead('k', Interrupted())
+        follower, result = self._follow('k', lambda: ('own answer', 1, 2))
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(result['value'], ('own answer', 1, 2))
+        self.assertEqual(self.cache.stats()['in_flight'], 0)
+
+    def test_follower_shares_leader_result(self):
+        calls = []
+        release, started = threading.Event(), threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ('shared', 1, 1)
+
+        leader = threading.Thread(target=lambda: self.cache.call('k', compute))
+        leader.start()
+        started.wait(5)
+        follower, result = self._follow('k', compute)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(result['value'], ('shared', 1, 1))
+        self.assertEqual(len(calls), 1)
+
+    def test_await_leader_treats_cancelled_leader_as_miss(self):
+        future = Future()
+        future.set_exception(asyncio.CancelledError())
+        self.assertIsNone(asyncio.run(self.cache.await_leader(future)))
+
+    def test_await_leader_propagates_own_cancellation(self):
+        future = Future()
+
+        async def follow():
+            task = asyncio.ensure_future(self.cache.await_leader(future))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(follow())
+        self.assertFalse(future.done())
+
+
+@override_settings(OPENROUTER_API_KEY='test', LLM_RESPONSE_CACHE_ENABLED=True)
+class CoalescedStreamTests(SimpleTestCase):
+    """Identical streams share one upstream call; a leader closed early must not take its followers down."""
+
+    ANSWER = ['Hello', ' there', ', friend']
+
+    def setUp(self):
+        self.upstream_calls = 0
+        self.release = None
+
+        async def chain(provider, clean_messages, max_tokens, call, deadline, models=None, last_error=None):
+            self.upstream_calls += 1
+            for token in self.ANSWER:
+                await self.release.wait()
+                yield token
+
+        patches = [
+            mock.patch.object(OpenRouterProvider, '_astream_chain', chain),
+            mock.patch.object(OpenRouterProvider, '_models_to_try',
+                              lambda provider: router.RouteDecision('pinned', 'test/model', [], ['test/model'])),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(response_cache._entries.clear)
+
+    def _stream(self, stop_after=None, temperature=0):
+        async def consume():
+            provider = OpenRouterProvider('test/model')
+            stream = provider.agenerate_response_stream([{'role': 'user', 'content': 'hi'}], max_tokens=50,
+                                                        call=UpstreamCall(temperature=temperature))
+            parts = []
+            try:
+                async for token in stream:
+                    parts.append(token)
+                    if stop_after is not None and len(parts) >= stop_after:
+                        break  # e.g. the token budget ran out
+            finally:
+                await stream.aclose()
+            return ''.join(parts)
+        return consume()
+
+    def test_follower_survives_leader_closing_early(self):
+        async def scenario():
+            self.release = asyncio.Event()
+            leader = asyncio.ensure_future(self._stream(stop_after=1))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(self._stream())
+            await asyncio.sleep(0)
+            self.release.set()
+            return await leader, await follower
+
+        leader_text, follower_text = asyncio.run(scenario())
+        self.assertEqual(leader_text, 'Hello')
+        self.assertEqual(follower_text, ''.join(self.ANSWER))
+        self.assertEqual(self.upstream_calls, 2)
+
+    def test_follower_survives_leader_cancellation(self):
+        async def scenario():
+            self.release = asyncio.Event()
+            leader = asyncio.ensure_future(self._stream())
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(self._stream())
+            await asyncio.sleep(0)
+            leader.cancel()  # the leader's client disconnected
+            await asyncio.sleep(0)
+            self.release.set()
+            return await follower
+
+        self.assertEqual(asyncio.run(scenario()), ''.join(self.ANSWER))
+
+    def test_identical_streams_share_one_upstream_call(self):
+        async def scenario():
+            self.release = asyncio.Event()
+            first = asyncio.ensure_future(self._stream())
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(self._stream())
+            await asyncio.sleep(0)
+            self.release.set()
+            return await first, await second
+
+        self.assertEqual(asyncio.run(scenario()), (''.join(self.ANSWER),) * 2)
+        self.assertEqual(self.upstream_calls, 1)
+
+    def test_sampled_streams_bypass_the_cache(self):
+        async def scenario():
+            self.release = asyncio.Event()
+            self.release.set()
+            await self._stream(temperature=0.7)
+            return await self._stream(temperature=0.7)
+
+        self.assertEqual(asyncio.run(scenario()), ''.join(self.ANSWER))
+        self.assertEqual(self.upstream_calls, 2)
+        self.assertEqual(response_cache.stats()['entries'], 0)
+
+
+@override_settings(LLM_SUMMARY_KEEP_RECENT_TOKENS=100, LLM_SUMMARY_CHUNK_TOKENS=1000)
+class ConversationSummarizerTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('summary@example.com', 'pw')
+        self.conversation = Conversation.objects.create(user=self.user)
+        Message.bulk_record([
+            Message(conversation=self.conversation, role='user' if i % 2 == 0 else 'assistant',
+                    content=f'turn {i}', tokens_used=100)
+            for i in range(6)
+        ])
+
+    def test_compact_folds_old_turns(self):
+        with mock.patch.object(ConversationSummarizer, '_summarize', return_value='the summary'):
+            self.assertTrue(ConversationSummarizer().compact(self.conversation.id))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, 'the summary')
+        self.assertIsNotNone(self.conversation.summary_until)
+
+    @override_settings(LLM_SUMMARY_MODEL='google/gemini-2.0-flash-001')
+    def test_unaccounted_turns_are_counted_with_the_tokenizer(self):
+        first = self.conversation.messages.order_by('created_at', 'id').first()
+        Message.objects.filter(id=first.id).update(tokens_used=0)
+        summarize = mock.Mock(return_value='the summary')
+        with mock.patch.object(ConversationSummarizer, '_summarize', summarize), \
+                mock.patch('chat.tokenizers.count_tokens', return_value=196) as count_tokens:
+            ConversationSummarizer().compact(self.conversation.id)
+        count_tokens.assert_any_call(first.content, 'google/gemini-2.0-flash-001', cache=True)
+        # 200 tokens for the first turn leaves room for two more before the recent tail
+        turns = summarize.call_args[0][1]
+        self.assertEqual([turn['id'] for turn in turns][0], first.id)
+        self.assertEqual(len(turns), 3)
+
+    def test_history_cleared_while_summarizing_is_not_summarized(self):
+        def clear_then_summarize(previous, turns):
+            self.conversation.messages.all().delete()
+            self.conversation.reset_summary()
+            return 'summary of deleted turns'
+
+        with mock.patch.object(ConversationSummarizer, '_summarize', side_effect=clear_then_summarize):
+            self.assertFalse(ConversationSummarizer().compact(self.conversation.id))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, '')
+        self.assertIsNone(self.conversation.summary_until)
+
+
+class MessageAccountingTests(TestCase):
+    """Token totals add up when several requests charge the same conversation."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('tokens@example.com', 'pw')
+        self.conversation = Conversation.objects.create(user=self.user)
+        self.other = Conversation.objects.create(user=self.user)
+
+    def _messages(self, conversation, *tokens):
+        return [Message(conversation=conversation, role='user', content=f'message {i}', tokens_used=n)
+                for i, n in enumerate(tokens)]
+
+    def test_bulk_record_charges_each_conversation_once(self):
+        created = Message.bulk_record(self._messages(self.conversation, 10, 20) + self._messages(self.other, 5))
+
+        self.assertTrue(all(message.pk for message in created))
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual((self.conversation.total_tokens_used, self.other.total_tokens_used), (30, 5))
+
+    def test_bulk_record_without_returned_primary_keys(self):
+        # e.g. MySQL, which reports no ids for a bulk insert
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert',
+                               new_callable=mock.PropertyMock, return_value=False):
+            created = Message.bulk_record(self._messages(self.conversation, 10, 20))
+
+        self.assertEqual(sorted(message.pk for message in created),
+                         sorted(Message.objects.values_list('pk', flat=True)))
+        self.assertEqual(self.conversation.total_tokens_used, 30)
+
+    def test_interleaved_charges_are_not_lost(self):
+        # Two requests loaded the conversation before either charged it
+        first = Conversation.objects.get(pk=self.conversation.pk)
+        second = Conversation.objects.get(pk=self.conversation.pk)
+
+        first.charge(100)
+        Message.bulk_record(self._messages(second, 30))
+        second.charge(50)
+        first.charge(0)
+
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).total_tokens_used, 180)
+        self.assertEqual(second.total_tokens_used, 180)
+        self.assertEqual(first.total_tokens_used, 100)  # no-op charges don't reload
+
+
+class TokenizerTests(SimpleTestCase):
+    """Encoding selection per model, and the character estimate when a BPE file is not vendored."""
+
+    def setUp(self):
+        tokenizers._count_cached.cache_clear()
+        self.addCleanup(tokenizers._count_cached.cache_clear)
+
+    def test_models_map_to_their_encoding(self):
+        self.assertEqual(tokenizers.model_family('openai/gpt-4o-mini'), 'o200k_base')
+        self.assertEqual(tokenizers.model_family('openai/gpt-4-turbo'), 'cl100k_base')
+        self.assertEqual(tokenizers.model_family('anthropic/claude-3.5-sonnet'), 'claude')
+        self.assertEqual(tokenizers.model_family('some/unknown-model'), 'other')
+        self.assertEqual(tokenizers._encoding_for('o200k_base'), 'o200k_base')
+        # Families without a local tokenizer are estimated with cl100k_base
+        self.assertEqual(tokenizers._encoding_for('claude'), tokenizers.ESTIMATOR_ENCODING)
+
+    def test_missing_bpe_file_falls_back_to_estimates_without_downloading(self):
+        with self.settings(TIKTOKEN_CACHE_DIR='/nonexistent'), \
+                mock.patch.dict(tokenizers._encodings, clear=True), \
+                mock.patch('tiktoken.get_encoding') as get_encoding:
+            self.assertIsNone(tokenizers.get_encoding('cl100k_base'))
+            self.assertEqual(tokenizers.count_tokens('x' * 400, 'openai/gpt-4'), 100)
+            # Other families scale the estimate by their learned ratio
+            with mock.patch.dict(tokenizers._ratios, {'claude': 1.5}):
+                self.assertEqual(tokenizers.count_tokens('x' * 400, 'anthropic/claude-3'), 150)
+        get_encoding.assert_not_called()
+
+    def test_startup_refuses_missing_tokenizers_when_required(self):
+        with self.settings(TIKTOKEN_CACHE_DIR='/nonexistent', TIKTOKEN_REQUIRED=True), \
+                mock.patch.dict(tokenizers._encodings, clear=True):
+            with self.assertRaises(ImproperlyConfigured):
+                tokenizers.load_encodings()
+        with self.settings(TIKTOKEN_CACHE_DIR='/nonexistent', TIKTOKEN_REQUIRED=False), \
+                mock.patch.dict(tokenizers._encodings, clear=True):
+            tokenizers.load_encodings()
+
+    def test_only_prompt_parts_are_cached(self):
+        with mock.patch.dict(tokenizers._encodings, {'cl100k_base': None}):
+            tokenizers.count_tokens('streamed answer', 'openai/gpt-4')
+            self.assertEqual(tokenizers._count_cached.cache_info().currsize, 0)
+            tokenizers.count_messages_tokens([{'role': 'system', 'content': 'You are helpful.'}], 'openai/gpt-4')
+            self.assertEqual(tokenizers._count_cached.cache_info().currsize, 1)
+
+
+class FakeStreamProvider(OpenRouterProvider):
+    """Streams a fixed answer without going upstream."""
+
+    def __init__(self, tokens):
+        super().__init__('test/model')
+        self.tokens = tokens
+
+    async def agenerate_response_stream(self, messages, max_tokens=4096, hedge=False, deadline=None, call=None):
+        for token in self.tokens:
+            await asyncio.sleep(0)
+            yield token
+
+
+@override_settings(LLM_TITLE_PUSH_WAIT=30, LLM_RESPONSE_CACHE_ENABLED=False)
+class StreamChargingTests(TestCase):
+    """A streamed answer is saved and charged exactly once, whenever the client goes away."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('stream@example.com', 'pw')
+        self.conversation = Conversation.objects.create(user=self.user)
+
+    async def _stream(self, tokens, until):
+        """POST to the stream endpoint and read events until one of type `until`. Returns (events, session)."""
+        # Context assembly runs on its own thread pool, outside the test transaction
+        prompt = [{'role': 'user', 'content': 'Hello'}]
+        with mock.patch('chat.views.AIServiceFactory.get_service', return_value=FakeStreamProvider(tokens)), \
+                mock.patch('chat.views.build_messages', return_value=prompt):
+            response = await self.async_client.post(
+                '/api/chat/stream/',
+                {'message': 'Hello', 'conversation_id': self.conversation.id, 'model': 'test/model'},
+                content_type='application/json',
+                headers={'Authorization': f'Bearer {AccessToken.for_user(self.user)}'},
+            )
+            self.assertEqual(response.status_code, 200, getattr(response, 'content', b''))
+            events = []
+            async for frame in response.streaming_content:
+                text = frame.decode() if isinstance(frame, bytes) else frame
+                data = next(line for line in text.splitlines() if line.startswith('data: '))
+                events.append(json.loads(data[len('data: '):]))
+                if events[-1]['type'] == until:
+                    break
+        session = stream_registry.get(events[0]['message_id'], self.user.id)
+        return events, session
+
+    async def _cancel(self, session):
+        """What the disconnect grace timer does once nobody listens any more."""
+        session.task.cancel()
+        try:
+            await session.task
+        except asyncio.CancelledError:
+            pass
+
+    async def _totals(self):
+        conversation = await Conversation.objects.aget(id=self.conversation.id)
+        answer = await Message.objects.filter(conversation=conversation, role='assistant').afirst()
+        return conversation.total_tokens_used, answer
+
+    async def test_disconnect_during_title_wait_keeps_answer_charged_once(self):
+        pending_title = Future()  # The title never arrives within the push wait
+        with mock.patch('chat.views.title_generator.enqueue', return_value=pending_title):
+            events, session = await self._stream(['Hello', ' there', ', friend'], until='done')
+            done = events[-1]
+            await self._cancel(session)
+
+        total, answer = await self._totals()
+        self.assertEqual(answer.status, 'complete')
+        self.assertEqual(answer.content, 'Hello there, friend')
+        self.assertEqual(total, done['user_message']['tokens_used'] + done['assistant_message']['tokens_used'])
+
+    async def test_slot_is_released_before_the_title_wait(self):
+        active = scheduler.stats()['active']
+        with mock.patch('chat.views.title_generator.enqueue', return_value=Future()):
+            events, session = await self._stream(['Hello'], until='done')
+            self.assertFalse(session.task.done())  # still waiting for the title
+            self.assertEqual(scheduler.stats()['active'], active)
+            await self._cancel(session)
+        self.assertEqual(scheduler.stats()['active'], active)
+
+    async def test_disconnect_mid_stream_charges_partial_answer_once(self):
+        with mock.patch('chat.views.title_generator.enqueue', return_value=Future()):
+            events, session = await self._stream(['Hello'] + [' more'] * 1000, until='token')
+            await self._cancel(session)
+            late = await Message.objects.aget(role='assistant')
+            self.assertFalse(await sync_to_async(late.finalize)('late', 999))
+
+        total, answer = await self._totals()
+        self.assertEqual(answer.status, 'truncated')
+        user_msg = await Message.objects.aget(role='user')
+        self.assertEqual(total, user_msg.tokens_used + answer.tokens_used)
+        self.assertNotEqual(answer.content, 'late')
+
+    @override_settings(LLM_STREAM_DISCONNECT_GRACE=0)
+    async def test_response_that_is_never_read_releases_the_slot(self):
+        active = scheduler.stats()['active']
+        provider = FakeStreamProvider(['Hello'] + [' more'] * 1000)
+        sessions = []
+        create = stream_registry.create
+
+        def track(*args):
+            sessions.append(create(*args))
+            return sessions[-1]
+
+        with mock.patch('chat.views.AIServiceFactory.get_service', return_value=provider), \
+                mock.patch('chat.views.build_messages', return_value=[{'role': 'user', 'content': 'Hello'}]), \
+                mock.patch.object(stream_registry, 'create', side_effect=track):
+            response = await self.async_client.post(
+                '/api/chat/stream/',
+                {'message': 'Hello', 'conversation_id': self.conversation.id, 'model': 'test/model'},
+                content_type='application/json',
+                headers={'Authorization': f'Bearer {AccessToken.for_user(self.user)}'},
+            )
+            self.assertEqual(response.status_code, 200)
+            # The client is gone before the body is sent: nothing ever iterates it
+            session, = sessions
+            self.assertIsNotNone(session.task)
+            await asyncio.wait([session.task], timeout=5)
+        self.assertTrue(session.task.cancelled())
+        self.assertEqual(scheduler.stats()['active'], active)
+
+    def test_finalize_applies_once(self):
+        answer = Message.objects.create(conversation=self.conversation, role='assistant', content='', status='streaming')
+        self.assertTrue(answer.finalize('done', 40))
+        self.assertFalse(answer.finalize('done again', 40, status='truncated'))
+        self.conversation.refresh_from_db()
+        answer.refresh_from_db()
+        self.assertEqual(self.conversation.total_tokens_used, 40)
+        self.assertEqual((answer.content, answer.status), ('done', 'complete'))
+
+
+class AsyncViewAuthTests(TestCase):
+    """The plain async views authenticate and throttle like the DRF views."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('async-auth@example.com', 'pw')
+        self.headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    async def test_missing_or_invalid_token_is_rejected(self):
+        response = await self.async_client.post('/api/chat/stream/', {}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.post('/api/chat/stream/', {}, content_type='application/json',
+                                                headers={'Authorization': 'Bearer not-a-token'})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_user_rate_limit_applies(self):
+        with mock.patch.object(UserRateThrottle, 'rate', '2/hour', create=True):
+            for _ in range(2):
+                response = await self.async_client.post('/api/chat/stream/999/resume/', headers=self.headers)
+                self.assertEqual(response.status_code, 404)
+            response = await self.async_client.post('/api/chat/stream/999/resume/', headers=self.headers)
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response.headers)
+            response = await self.async_client.post('/api/chat/compare/', {}, content_type='application/json',
+                                                    headers=self.headers)
+            self.assertEqual(response.status_code, 429)
+
+
+@override_settings(LLM_SCHEDULER_MAX_CONCURRENCY=1, LLM_SCHEDULER_MAX_PER_USER=1, LLM_SCHEDULER_MAX_QUEUE=10,
+                   LLM_SCHEDULER_QUEUE_TARGET=3.0, LLM_SCHEDULER_BACKGROUND_MAX_WAIT=5.0)
+class SchedulerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.scheduler = UpstreamScheduler()
+
+    def test_sheds_interactive_request_with_retry_after(self):
+        held = self.scheduler.acquire(1, INTERACTIVE)
+        # One slot, held for ~5s on average (the prior): the next request would wait past the 3s target
+        with self.assertRaises(UpstreamOverloaded) as shed:
+            self.scheduler.acquire(2, INTERACTIVE)
+        self.assertEqual(shed.exception.retry_after, 5)
+        self.assertEqual(self.scheduler.stats()['rejected'], {'interactive': 1})
+        self.assertEqual(self.scheduler.stats()['waiting'], {})
+
+        response = _overloaded_response(shed.exception)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(response.data['retry_after'], 5)
+        self.scheduler.release(held)
+
+    def test_background_request_waits_instead_of_being_shed(self):
+        held = self.scheduler.acquire(1, INTERACTIVE)
+        granted = threading.Event()
+
+        def background():
+            with self.scheduler.slot(priority=BACKGROUND):
+                granted.set()
+
+        thread = threading.Thread(target=background)
+        thread.start()
+        self.assertFalse(granted.wait(0.1))
+        self.scheduler.release(held)
+        self.assertTrue(granted.wait(5))
+        thread.join(5)
+        self.assertEqual(self.scheduler.stats()['active'], 0)
+
+    def test_paid_requests_are_served_first(self):
+        held = self.scheduler.acquire(None, BACKGROUND)
+        order = []
+
+        def wait_for_slot(user_id, priority):
+            with self.scheduler.slot(user_id, priority):
+                order.append(priority)
+
+        threads = [threading.Thread(target=wait_for_slot, args=(None, BACKGROUND))]
+        threads[0].start()
+        while not self.scheduler.stats()['waiting']:
+            time.sleep(0.01)
+        with override_settings(LLM_SCHEDULER_QUEUE_TARGET=60):
+            threads.append(threading.Thread(target=wait_for_slot, args=(7, INTERACTIVE_PAID)))
+            threads[1].start()
+            while sum(self.scheduler.stats()['waiting'].values()) < 2:
+                time.sleep(0.01)
+        self.scheduler.release(held)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, [INTERACTIVE_PAID, BACKGROUND])
+
+    def test_release_is_idempotent(self):
+        first = self.scheduler.acquire(1, INTERACTIVE)
+        self.scheduler.release(first)
+        self.scheduler.release(first)
+        self.assertEqual(self.scheduler.stats()['active'], 0)
+
+        second = self.scheduler.acquire(1, INTERACTIVE)
+        self.scheduler.release(first)  # a stale release must not free someone else's slot
+        self.assertEqual(self.scheduler.stats()['active'], 1)
+        self.scheduler.release(second)
+        self.assertEqual(self.scheduler.stats()['active'], 0)
+
+
+@override_settings(LLM_CONTEXT_RAG_TIMEOUT=0.05)
+class BuildMessagesTests(SimpleTestCase):
+    """Context stages: RAG is optional and bounded, history is not."""
+
+    def setUp(self):
+        self.provider = OpenRouterProvider('test/model')
+        self.conversation = mock.Mock(id=1, summary='', summary_until=None, remaining_tokens=20000)
+        self.user = mock.Mock(id=1)
+        self.user_msg = Message(id=None, role='user', content='What did I say?', tokens_used=5)
+        patches = [
+            mock.patch.object(context, 'prompt_window', return_value=10000),
+            mock.patch('chat.tasks.summarizer.enqueue'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _slow(self, seconds, value):
+        def stage(*args):
+            time.sleep(seconds)
+            return value
+        return stage
+
+    def test_slow_history_is_waited_for(self):
+        earlier = [{'role': 'user', 'content': 'My name is Ada', 'tokens_used': 6}]
+        with mock.patch.object(context, 'load_history_window', self._slow(0.2, (earlier, True))), \
+                mock.patch.object(context, '_find_documents', return_value=[]):
+            messages = context.build_messages(self.provider, self.conversation, self.user_msg, 'general', self.user)
+        self.assertEqual([m['content'] for m in messages[1:]], ['My name is Ada', 'What did I say?'])
+
+    def test_slow_rag_is_left_out(self):
+        with mock.patch.object(context, 'load_history_window', return_value=([], True)), \
+                mock.patch.object(context, '_find_documents', self._slow(0.5, ['a matching chunk'])):
+            messages = context.build_messages(self.provider, self.conversation, self.user_msg, 'general', self.user)
+        self.assertEqual(messages[-1]['content'], 'What did I say?')
+
+    def test_history_does_not_queue_behind_abandoned_rag(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        pool = ThreadPoolExecutor(max_workers=1)
+        release = threading.Event()
+        self.addCleanup(pool.shutdown)
+        self.addCleanup(release.set)
+        # Every worker is held by a RAG lookup that an earlier request gave up on
+        pool.submit(release.wait)
+        earlier = [{'role': 'user', 'content': 'My name is Ada', 'tokens_used': 6}]
+        with mock.patch.object(context, '_executor', pool), \
+                mock.patch.object(context, 'load_history_window', return_value=(earlier, True)), \
+                mock.patch.object(context, '_find_documents', return_value=['a matching chunk']) as find:
+            started = time.monotonic()
+            messages = context.build_messages(self.provider, self.conversation, self.user_msg, 'general', self.user)
+            elapsed = time.monotonic() - started
+            release.set()
+            pool.shutdown(wait=True)
+        self.assertLess(elapsed, 1)
+        self.assertEqual([m['content'] for m in messages[1:]], ['My name is Ada', 'What did I say?'])
+        # The lookup that missed its deadline while queued never runs
+        find.assert_not_called()
+
+    def test_vector_store_is_not_queried_without_documents(self):
+        with mock.patch.object(context, '_has_ready_documents', return_value=False), \
+                mock.patch.object(context, '_query_documents') as query:
+            self.assertEqual(context._find_documents(self.user, 'question'), [])
+        query.assert_not_called()
+
+
+
+class FallbackWindowTests(SimpleTestCase):
+    """A fallback with a smaller window gets the prompt re-packed, counted with its own tokenizer."""
+
+    def test_fallback_is_repacked_with_its_own_token_counts(self):
+        provider = OpenRouterProvider('test/a')
+        messages = [
+            {'role': 'system', 'content': 's' * 10},
+            {'role': 'user', 'content': 'old' * 10},
+            {'role': 'user', 'content': 'q' * 10},
+        ]
+
+        def count_tokens(text, model=None, cache=False):
+            # The fallback's tokenizer splits this text ten times finer
+            return len(text) * (10 if model == 'test/fallback' else 1)
+
+        with mock.patch.object(context.model_catalog, 'context_window', return_value=600), \
+                mock.patch('chat.tokenizers.count_tokens', side_effect=count_tokens):
+            packed, max_tokens = provider._fit_window('test/fallback', messages, 200)
+        self.assertEqual(max_tokens, 150)
+        self.assertEqual([m['content'] for m in packed], ['s' * 10, 'q' * 10])
+
+@override_settings(LLM_PERSONA_MAX_TOKENS={'general': 2000})
+class PromptWindowTests(TestCase):
+    """History gives way to the budget; the system prompt and the question never do."""
+
+    def setUp(self):
+        self.provider = OpenRouterProvider('test/model')
+        self.user = get_user_model().objects.create_user('window@example.com', 'pw')
+        self.conversation = Conversation.objects.create(user=self.user)
+        self.user_msg = Message(conversation=self.conversation, role='user', content='And now?', tokens_used=3)
+        patch = mock.patch.object(context.model_catalog, 'context_window', return_value=None)
+        self.context_window = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_budget_below_the_answer_reserve_keeps_the_prompt(self):
+        Conversation.objects.filter(id=self.conversation.id).update(total_tokens_used=18500)
+        self.conversation.refresh_from_db()
+        earlier = [{'role': 'user', 'content': 'Earlier question', 'tokens_used': 5}]
+        with mock.patch.object(context, 'load_history_window', return_value=(earlier, True)), \
+                mock.patch('chat.tasks.summarizer.enqueue'):
+            messages = context.build_messages(self.provider, self.conversation, self.user_msg, 'general')
+        self.assertEqual([m['role'] for m in messages], ['system', 'user'])
+        self.assertEqual(messages[-1]['content'], 'And now?')
+
+    def test_no_room_for_history_does_not_schedule_a_summary(self):
+        Message.objects.create(conversation=self.conversation, role='user', content='Earlier', tokens_used=5)
+        Conversation.objects.filter(id=self.conversation.id).update(total_tokens_used=18500)
+        self.conversation.refresh_from_db()
+        self.assertEqual(context.load_history_window(self.provider, self.conversation, 0), ([], True))
+        with mock.patch('chat.tasks.summarizer.enqueue') as enqueue:
+            context.build_messages(self.provider, self.conversation, self.user_msg, 'general')
+        enqueue.assert_not_called()
+
+    def test_window_leaves_room_for_the_answer(self):
+        self.context_window.return_value = 8000
+        self.assertEqual(context.prompt_window(self.provider, self.conversation, 'general'), 6000)
+
+    def test_no_room_for_an_answer_fails_before_calling_the_model(self):
+        self.context_window.return_value = 50
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch('chat.views.AIServiceFactory.get_service', return_value=self.provider), \
+                mock.patch.object(OpenRouterProvider, 'generate_response') as generate:
+            response = client.post('/api/chat/send/', {
+                'message': 'And now?', 'conversation_id': self.conversation.id, 'model': 'test/model',
+            }, format='json')
+        self.assertEqual(response.status_code, 402)
+        self.assertEqual(response.data['error'], 'token_limit_exceeded')
+        generate.assert_not_called()
+        self.assertFalse(Message.objects.exists())
+
+
+@override_settings(LLM_PERSONA_MAX_TOKENS={'general': 1000})
+class CompletionBudgetTests(SimpleTestCase):
+    """max_tokens follows the tightest limit; only the conversation's limit ends an answer early."""
+
+    def setUp(self):
+        self.provider = OpenRouterProvider('test/model')
+        patch = mock.patch.object(context.model_catalog, 'lookup', return_value=None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _budget(self, remaining, **kwargs):
+        conversation = mock.Mock(remaining_tokens=remaining)
+        return context.completion_budget(self.provider, conversation, 'general', [], **kwargs)
+
+    def test_tightest_limit_wins_and_ties_go_to_the_conversation(self):
+        budget = self._budget(5000)
+        self.assertEqual((budget.max_tokens, budget.limited_by), (1000, 'persona'))
+        budget = self._budget(1000)
+        self.assertEqual((budget.max_tokens, budget.limited_by), (1000, 'conversation'))
+
+    def test_reserved_tokens_and_shares(self):
+        budget = self._budget(1300, reserved=100, share=2)
+        self.assertEqual((budget.max_tokens, budget.limited_by), (600, 'conversation'))
+        self.assertEqual(self._budget(50, reserved=100).max_tokens, 1)
+
+    def test_tighten_only_lowers_the_cap(self):
+        budget = context.CompletionBudget(1000, 'persona')
+        budget.tighten(2000)
+        self.assertEqual((budget.max_tokens, budget.limited_by), (1000, 'persona'))
+        budget.tighten(400)
+        self.assertEqual((budget.max_tokens, budget.limited_by), (400, 'conversation'))
+        budget.tighten(-50)  # a concurrent answer overspent
+        self.assertEqual(budget.max_tokens, 0)
+        self.assertTrue(budget.exhausted(0))
+
+    def test_exhausted_only_by_the_conversation(self):
+        self.assertFalse(context.CompletionBudget(1000, 'persona').exhausted(1000))
+        budget = context.CompletionBudget(1000, 'conversation')
+        self.assertFalse(budget.exhausted(999))
+        self.assertTrue(budget.exhausted(1000))
+
+
+class InlineExecutor:
+    """Runs submitted work right away on the calling thread (the test transaction is not shared across threads)."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+@override_settings(LLM_BATCH_STALL_AFTER=300, LLM_SCHEDULER_BACKGROUND_MAX_WAIT=300, LLM_DEADLINES={'batch': 300})
+class BatchRunnerTests(TestCase):
+    """Items are claimed once, only abandoned items are reset, and a live job is not picked up again."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('batch@example.com', 'pw')
+        self.conversation = Conversation.objects.create(user=self.user)
+        now = timezone.now()
+        self.job = BatchJob.objects.create(
+            user=self.user, conversation=self.conversation, model='test/model', max_tokens=100,
+            total_items=3, status='running', started_at=now, heartbeat_at=now - timedelta(minutes=1),
+        )
+        self.items = BatchItem.objects.bulk_create([
+            BatchItem(job=self.job, index=i, input=f'prompt {i}', prompt=f'prompt {i}') for i in range(3)
+        ])
+        self.calls = []
+
+        self.max_tokens = []
+
+        def generate(provider, messages, max_tokens=4096, deadline=None, call=None):
+            self.calls.append(call)
+            self.max_tokens.append(max_tokens)
+            return 'answer', 0, 7
+
+        patches = [
+            mock.patch('chat.tasks.ThreadPoolExecutor', InlineExecutor),
+            mock.patch.object(OpenRouterProvider, 'generate_response', generate),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_item_is_claimed_and_charged_once(self):
+        runner = BatchRunner()
+        finished = runner._run_item(self.job, self.items[0].id)
+        self.assertIsNone(runner._run_item(self.job, self.items[0].id))
+        runner._save_results(self.job, [finished])
+
+        self.assertEqual(len(self.calls), 1)
+        item = BatchItem.objects.get(id=self.items[0].id)
+        self.assertEqual((item.status, item.output, item.completion_tokens), ('done', 'answer', 7))
+        self.job.refresh_from_db()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.job.completed_items, 1)
+        self.assertEqual(self.conversation.total_tokens_used, item.prompt_tokens + 7)
+        self.assertEqual(self.job.total_tokens, item.prompt_tokens + 7)
+        self.assertEqual(item.reserved_tokens, 0)
+
+    def test_items_in_flight_cannot_overdraw_the_conversation(self):
+        Conversation.objects.filter(id=self.conversation.id).update(token_limit=1200)
+        BatchJob.objects.filter(id=self.job.id).update(max_tokens=600)
+        self.job.refresh_from_db()
+        BatchRunner().process(self.job.id)
+
+        prompt_tokens = OpenRouterProvider('test/model').count_tokens('prompt 0')
+        # All three run side by side: each answer cap was reserved before the next item started
+        self.assertLessEqual(sum(prompt_tokens + cap for cap in self.max_tokens), 1200)
+        statuses = dict(BatchItem.objects.filter(job=self.job).values_list('index', 'status'))
+        self.assertEqual(statuses, {0: 'done', 1: 'done', 2: 'failed'})
+        # The reservations are replaced by what the answers used
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.total_tokens_used, 2 * (prompt_tokens + 7))
+
+    def test_results_are_saved_as_conversation_messages(self):
+        BatchRunner().process(self.job.id)
+        messages = list(self.conversation.messages.order_by('created_at', 'id').values_list('role', 'content'))
+        self.assertEqual(messages, [('user', 'prompt 0'), ('assistant', 'answer'),
+                                    ('user', 'prompt 1'), ('assistant', 'answer'),
+                                    ('user', 'prompt 2'), ('assistant', 'answer')])
+        self.conversation.refresh_from_db()
+        self.job.refresh_from_db()
+        self.assertEqual(self.conversation.total_tokens_used, self.job.total_tokens)
+
+    def test_process_only_resets_items_past_their_timeout(self):
+        now = timezone.now()
+        # Still within a slot wait plus the deadline (600s < 300 + 300 + 300): another worker has it
+        BatchItem.objects.filter(id=self.items[0].id).update(status='running', started_at=now - timedelta(minutes=10))
+        # Abandoned by a worker that went away
+        BatchItem.objects.filter(id=self.items[1].id).update(status='running', started_at=now - timedelta(minutes=20))
+
+        BatchRunner().process(self.job.id)
+
+        statuses = dict(BatchItem.objects.filter(job=self.job).values_list('index', 'status'))
+        self.assertEqual(statuses, {0: 'running', 1: 'done', 2: 'done'})
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'running')  # item 0 is still out
+        self.assertGreater(self.job.heartbeat_at, now)
+
+        BatchRunner().process(self.job.id)  # processing again changes nothing
+        self.assertEqual(len(self.calls), 2)
+
+    def test_items_are_billed_as_their_own_calls(self):
+        BatchRunner().process(self.job.id)
+        self.assertEqual(len({id(call) for call in self.calls}), 3)
+        self.assertEqual({(call.endpoint, call.user_id, call.conversation_id) for call in self.calls},
+                         {('batch', self.user.id, self.conversation.id)})
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.completed_items), ('completed', 3))
+
+    def test_resume_only_restarts_a_stalled_job(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch('chat.views.batch_runner.enqueue') as enqueue:
+            client.post(f'/api/chat/batches/{self.job.id}/resume/')
+            enqueue.assert_not_called()
+
+            BatchJob.objects.filter(id=self.job.id).update(heartbeat_at=timezone.now() - timedelta(minutes=6))
+            # Polling only reports it
+            response = client.get(f'/api/chat/batches/{self.job.id}/')
+            self.assertTrue(response.data['batch']['stalled'])
+            enqueue.assert_not_called()
+
+            client.post(f'/api/chat/batches/{self.job.id}/resume/')
+            enqueue.assert_called_once_with(self.job.id)
+
+
+@override_settings(OPENROUTER_API_KEY='test', LLM_RESPONSE_CACHE_ENABLED=False)
+class PerCallStateTests(SimpleTestCase):
+    """Concurrent calls on one provider keep their own routing decision, ledger scope and usage."""
+
+    def test_concurrent_streams_keep_their_own_state(self):
+        decisions = iter([
+            router.RouteDecision('pinned', 'test/a', [], ['test/a', 'test/b']),
+            router.RouteDecision('fastest', 'test/a', [], ['test/b', 'test/a']),
+        ])
+        records = []
+        gates = {'test/a': asyncio.Event(), 'test/b': asyncio.Event()}
+        reported = {'test/a': 5, 'test/b': 9}
+        first_call, second_call = UpstreamCall('stream', 1, 10), UpstreamCall('stream', 2, 20)
+
+        async def upstream(provider, model, clean_messages, max_tokens, deadline, call):
+            started = time.monotonic()
+            await gates[model].wait()
+            yield 'token'
+            usage = mock.Mock(prompt_tokens=1, completion_tokens=reported[model], prompt_tokens_details=None)
+            provider._record_stream_success(model, call, clean_messages, usage, started, 0.1, 1)
+
+        async def consume(provider, call):
+            stream = provider.agenerate_response_stream([{'role': 'user', 'content': 'hi'}], call=call)
+            return [token async for token in stream]
+
+        async def scenario():
+            provider = OpenRouterProvider('test/a')
+            first = asyncio.ensure_future(consume(provider, first_call))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(consume(provider, second_call))  # starts while the first is still streaming
+            await asyncio.sleep(0)
+            gates['test/b'].set()
+            await second
+            gates['test/a'].set()
+            await first
+
+        with mock.patch.object(router, 'route', lambda *args: next(decisions)), \
+                mock.patch.object(OpenRouterProvider, '_astream_api', upstream), \
+                mock.patch('chat.ai_providers.usage_ledger.record', lambda **fields: records.append(fields)), \
+                mock.patch.object(router.RouteDecision, 'served'):
+            asyncio.run(scenario())
+
+        self.assertEqual(sorted((r['model'], r['fallback_depth'], r['user_id'], r['conversation_id']) for r in records),
+                         [('test/a', 0, 1, 10), ('test/b', 0, 2, 20)])
+        self.assertEqual((first_call.usage.completion_tokens, second_call.usage.completion_tokens), (5, 9))
+
+
+def _chunk(content=None, usage=None):
+    choices = [mock.Mock(delta=mock.Mock(content=content))] if content is not None else []
+    return mock.Mock(choices=choices, usage=usage)
+
+
+class FakeUpstreamStream:
+    """An upstream chat completion stream: the given chunks, then (with `stall`) silence."""
+
+    def __init__(self, chunks, stall=False):
+        self.chunks = chunks
+        self.stall = stall
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.stall:
+            await asyncio.Event().wait()
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def close(self):
+        pass
+
+
+def _fake_async_client(*streams):
+    client = mock.Mock()
+    client.chat.completions.create = mock.AsyncMock(side_effect=list(streams))
+    return client
+
+
+class StreamAccountingTests(SimpleTestCase):
+    """What a stream attempt reports to the routing decision, the health registry and the ledger."""
+
+    def setUp(self):
+        self.provider = OpenRouterProvider('test/model')
+        self.call = UpstreamCall('stream', 1, 10)
+        self.call.route = mock.Mock(order=['test/model'])
+        self.records = []
+        patch = mock.patch('chat.ai_providers.usage_ledger.record', lambda **fields: self.records.append(fields))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_reported_completion_tokens_win_over_chunks(self):
+        usage = mock.Mock(prompt_tokens=12, completion_tokens=42, prompt_tokens_details=None)
+        self.provider._record_stream_success('test/model', self.call, [], usage, time.monotonic(), 0.1, 10)
+        self.assertEqual(self.call.route.served.call_args[0][-1], 42)
+        self.assertEqual(self.records[-1]['completion_tokens'], 42)
+
+    def test_chunks_stand_in_without_usage(self):
+        self.provider._record_stream_success('test/model', self.call, [], None, time.monotonic(), 0.1, 10)
+        self.assertEqual(self.call.route.served.call_args[0][-1], 10)
+        self.assertTrue(self.records[-1]['estimated'])
+
+
+    @override_settings(OPENROUTER_API_KEY='test-key', LLM_STREAM_IDLE_TIMEOUT=0.05)
+    def test_stall_after_tokens_is_recorded_as_cancelled_with_the_partial_count(self):
+        upstream = FakeUpstreamStream([_chunk('Hello'), _chunk(' there')], stall=True)
+
+        async def consume():
+            tokens = []
+            with self.assertRaises(StreamTimeout):
+                async for token in self.provider._astream_api('test/model', [], 100, Deadline(30), self.call):
+                    tokens.append(token)
+            return tokens
+
+        with mock.patch.object(OpenRouterProvider, 'async_client', new_callable=mock.PropertyMock,
+                               return_value=_fake_async_client(upstream)), \
+                mock.patch('chat.ai_providers.model_health') as health:
+            self.assertEqual(asyncio.run(consume()), ['Hello', ' there'])
+        self.assertEqual([(r['status'], r['completion_tokens']) for r in self.records], [('cancelled', 2)])
+        # The model still stalled: health sees the failure
+        health.record_error.assert_called_once_with('test/model')
+
+
+class DeadlineTimeoutTests(SimpleTestCase):
+    """A timeout caused by the request's own deadline is not held against the model."""
+
+    def setUp(self):
+        self.provider = OpenRouterProvider('test/model')
+        self.call = UpstreamCall('send', 1, 10)
+        self.records = []
+        patches = [
+            mock.patch('chat.ai_providers.usage_ledger.record', lambda **fields: self.records.append(fields)),
+            mock.patch('chat.ai_providers.model_health'),
+            mock.patch.object(OpenRouterProvider, 'client', new_callable=mock.PropertyMock),
+        ]
+        self.health = patches[1].start()
+        self.client = patches[2].start().return_value
+        patches[0].start()
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def _times_out(self, seconds):
+        def create(**kwargs):
+            time.sleep(seconds)
+            raise openai.APITimeoutError(request=httpx.Request('POST', 'https://openrouter.ai/api/v1/chat/completions'))
+        return create
+
+    def test_timeout_at_the_deadline_is_not_a_model_failure(self):
+        self.client.chat.completions.create.side_effect = self._times_out(0.06)
+        with self.assertRaises(DeadlineExceeded):
+            self.provider._call_api('test/model', [], 100, Deadline(0.05), self.call)
+        self.health.record_error.assert_not_called()
+        self.assertEqual([r['status'] for r in self.records], ['deadline'])
+
+    def test_timeout_with_time_left_is_a_model_failure(self):
+        self.client.chat.completions.create.side_effect = self._times_out(0)
+        with self.assertRaises(openai.APITimeoutError):
+            self.provider._call_api('test/model', [], 100, Deadline(30), self.call)
+        self.health.record_error.assert_called_with('test/model')
+        self.assertIn('error', [r['status'] for r in self.records])
+
+@override_settings(OPENROUTER_API_KEY='test-key')
+class CatalogLookupTests(TestCase):
+    """Lookups see the shared row, in cold workers and after another worker's refresh."""
+
+    def setUp(self):
+        self.store = ModelCatalogStore()
+        self._store([{'id': 'a/model', 'context_length': 8000}], 'v1')
+
+    def _store(self, entries, etag):
+        ModelCatalog.objects.update_or_create(pk=1, defaults={
+            'entries': entries, 'etag': etag, 'fetched_at': timezone.now(),
+        })
+
+    def test_cold_worker_loads_the_stored_list(self):
+        self.assertEqual(self.store.context_window('a/model'), 8000)
+        self.assertIsNone(self.store.lookup('unknown/model'))
+
+    def test_refresh_by_another_worker_is_picked_up(self):
+        self.assertEqual(self.store.context_window('a/model'), 8000)
+        self._store([{'id': 'a/model', 'context_length': 16000}], 'v2')
+        # Within the check interval the worker keeps its copy
+        self.assertEqual(self.store.context_window('a/model'), 8000)
+        self.store._checked_at -= catalog.LOCAL_CHECK_INTERVAL
+        self.assertEqual(self.store.context_window('a/model'), 16000)
+
+    async def test_event_loop_uses_the_list_warmed_at_startup(self):
+        # No database access on the event loop: a worker that was not warmed has no list there
+        self.assertIsNone(self.store.lookup('a/model'))
+        await sync_to_async(self.store.warm)()
+        self.assertEqual(self.store.lookup('a/model')['context_length'], 8000)
+
+
+class MetricsEndpointTests(SimpleTestCase):
+    """/metrics is only served to a scraper holding METRICS_TOKEN."""
+
+    @override_settings(METRICS_TOKEN='')
+    def test_not_served_without_a_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_requires_the_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+class RouterDecisionLogTests(SimpleTestCase):
+    """Routing decisions are debug output: silent unless the decision logger is turned down to DEBUG."""
+
+    def setUp(self):
+        self.decision = router.RouteDecision('pinned', 'test/a', [], ['test/a', 'test/b'])
+        level = router.decision_log.level
+        self.addCleanup(router.decision_log.setLevel, level)
+
+    def test_decisions_are_not_logged_by_default(self):
+        router.decision_log.setLevel('INFO')
+        with mock.patch.object(router.decision_log, 'handle') as handle:
+            self.decision.log()
+            self.decision.served('test/a', 'stream', 1.0, ttft=0.2, completion_tokens=10)
+        handle.assert_not_called()
+
+    def test_decisions_are_logged_as_json_lines_at_debug(self):
+        router.decision_log.setLevel('DEBUG')
+        with self.assertLogs('chat.router.decisions', 'DEBUG') as logs:
+            self.decision.log()
+            self.decision.served('test/b', 'stream', 1.0)
+        events = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual([e['event'] for e in events], ['route', 'served'])
+        self.assertEqual(events[1]['rank'], 1)
+
+
+class HangingModel:
+    """Compare service that sends one token and then never finishes."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.closed = False
+
+    def count_tokens(self, text, cache=False):
+        return len(text.split())
+
+    async def astream_model(self, messages, max_tokens=None, deadline=None, call=None):
+        try:
+            yield f'{self.model_name} says'
+            await asyncio.Event().wait()
+        finally:
+            self.closed = True
+
+
+class ScriptedModel(HangingModel):
+    """Compare service that streams its tokens, or fails before the first one."""
+
+    def __init__(self, model_name, tokens=None, error=None):
+        super().__init__(model_name)
+        self.tokens, self.error = tokens or [], error
+
+    async def astream_model(self, messages, max_tokens=None, deadline=None, call=None):
+        if self.error:
+            raise self.error
+        for token in self.tokens:
+            await asyncio.sleep(0)
+            yield token
+
+
+class CompareTests(TestCase):
+    """Comparisons run inside an existing conversation and leave nothing running behind them."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('compare@example.com', 'pw')
+        self.headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    async def test_conversation_id_is_required(self):
+        response = await self.async_client.post(
+            '/api/chat/compare/', {'message': 'hi', 'models': ['test/a', 'test/b']},
+            content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('conversation_id', json.loads(response.content))
+        self.assertEqual(await Conversation.objects.filter(user=self.user).acount(), 0)
+
+    def test_events_are_tagged_per_model_and_failures_stay_separate(self):
+        services = [ScriptedModel('test/a', ['One', ' two']), ScriptedModel('test/b', ['Uno']),
+                    ScriptedModel('test/c', error=Exception('Rate limited'))]
+
+        async def scenario():
+            stream = compare_stream([ModelRun(service) for service in services], [], self.user.id,
+                                    INTERACTIVE, Deadline(30))
+            return await _async_list(stream)
+
+        events = asyncio.run(scenario())
+        tokens = {}
+        for event in events:
+            if event['type'] == 'token':
+                tokens.setdefault(event['model'], []).append(event['content'])
+        self.assertEqual(tokens, {'test/a': ['One', ' two'], 'test/b': ['Uno']})
+        done = {event['model']: event for event in events if event['type'] == 'model_done'}
+        self.assertEqual(done['test/a']['content'], 'One two')
+        self.assertEqual(done['test/a']['stats']['completion_tokens'], 2)  # counted, nothing was reported
+        errors = [event for event in events if event['type'] == 'model_error']
+        self.assertEqual([(e['model'], e['message']) for e in errors], [('test/c', 'Rate limited')])
+
+    def test_closing_early_waits_for_the_cancelled_models(self):
+        services = [HangingModel('test/a'), HangingModel('test/b')]
+
+        async def scenario():
+            stream = compare_stream([ModelRun(service) for service in services], [], self.user.id,
+                                    INTERACTIVE, Deadline(30))
+            event = await stream.__anext__()
+            await stream.aclose()  # the client went away
+            return event, [service.closed for service in services], scheduler._active
+
+        active = scheduler._active
+        event, closed, active_after = asyncio.run(scenario())
+        self.assertEqual(event['type'], 'token')
+        self.assertEqual(closed, [True, True])
+        self.assertEqual(active_after, active)
+
+
+@override_settings(OPENROUTER_API_KEY='test')
+class SharedClientTests(SimpleTestCase):
+    """Providers share one keep-alive pool per process, and one async pool per event loop."""
+
+    def setUp(self):
+        clients._reset_after_fork()
+        self.addCleanup(clients._reset_after_fork)
+
+    def test_providers_share_the_sync_client(self):
+        first, second = OpenRouterProvider('test/a'), OpenRouterProvider('test/b')
+        self.assertIs(first.client, second.client)
+        self.assertIs(first.client._client, clients.get_http_client())
+        self.assertEqual(first.client.max_retries, 0)  # the providers retry within the deadline
+
+    def test_async_clients_are_per_event_loop(self):
+        async def pair():
+            return OpenRouterProvider('test/a').async_client, OpenRouterProvider('test/b').async_client
+
+        first, second = asyncio.run(pair())
+        self.assertIs(first, second)
+        other, _ = asyncio.run(pair())
+        self.assertIsNot(first, other)
+
+    def test_forked_child_builds_its_own_pool(self):
+        parent = clients.get_http_client()
+        clients._reset_after_fork()
+        self.assertIsNot(clients.get_http_client(), parent)
+        self.assertIsNone(clients.pool_stats()['prewarmed_at'])
+
+
+@override_settings(OPENROUTER_API_KEY='test', LLM_HEDGE_DELAY='0.05')
+class HedgedStreamTests(SimpleTestCase):
+    """A slow first token races the next model; the loser is closed and the primary alone is the normal case."""
+
+    def setUp(self):
+        self.first_token_after = {}   # model -> seconds before its first token
+        self.started, self.closed = [], []
+
+        async def stream_api(provider, model, clean_messages, max_tokens, deadline, call):
+            self.started.append(model)
+            try:
+                await asyncio.sleep(self.first_token_after[model])
+                yield f'{model}:1'
+                yield f'{model}:2'
+            finally:
+                self.closed.append(model)
+
+        patches = [
+            mock.patch.object(OpenRouterProvider, '_astream_api', stream_api),
+            mock.patch.object(OpenRouterProvider, '_fit_window',
+                              lambda provider, model, clean_messages, max_tokens: (clean_messages, max_tokens)),
+            mock.patch.object(OpenRouterProvider, '_models_to_try',
+                              lambda provider: router.RouteDecision('pinned', 'test/a', [], ['test/a', 'test/b'])),
+            mock.patch.object(OpenRouterProvider, 'MIN_HEDGE_DELAY', 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _stream(self):
+        async def consume():
+            provider = OpenRouterProvider('test/a')
+            return [token async for token in provider.agenerate_response_stream(
+                [{'role': 'user', 'content': 'hi'}], max_tokens=50, hedge=True)]
+        return asyncio.run(consume())
+
+    def test_slow_primary_is_hedged_and_cancelled(self):
+        self.first_token_after = {'test/a': 10, 'test/b': 0}
+        self.assertEqual(self._stream(), ['test/b:1', 'test/b:2'])
+        self.assertEqual(self.started, ['test/a', 'test/b'])
+        self.assertCountEqual(self.closed, ['test/a', 'test/b'])
+
+    def test_fast_primary_is_not_hedged(self):
+        self.first_token_after = {'test/a': 0, 'test/b': 0}
+        self.assertEqual(self._stream(), ['test/a:1', 'test/a:2'])
+        self.assertEqual(self.started, ['test/a'])
+
+
+class TitleGeneratorTests(TestCase):
+    """Titles for several conversations come from one upstream call and never overwrite a renamed chat."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('titles@example.com', 'pw')
+        self.generator = TitleGenerator()
+
+    def _generate(self, reply, messages):
+        with mock.patch.object(OpenRouterProvider, 'generate_response', return_value=(reply, 0, 0)) as generate:
+            titles = self.generator._generate(messages)
+        return titles, generate
+
+    def test_one_upstream_call_per_batch(self):
+        titles, generate = self._generate('Sure: ["Python Lists", "\\"Trip to Rome\\""]', ['lists?', 'rome?'])
+        self.assertEqual(titles, ['Python Lists', 'Trip to Rome'])
+        generate.assert_called_once()
+        self.assertEqual(generate.call_args.kwargs['call'].endpoint, 'title')
+
+    def test_unusable_reply_falls_back_per_message(self):
+        titles, _ = self._generate('Python Lists', ['lists?', 'rome?'])  # one title for two messages
+        self.assertEqual(titles, [None, None])
+        titles, _ = self._generate('1. Python Lists\n2. Trip to Rome', ['lists?', 'rome?'])
+        self.assertEqual(titles, ['Python Lists', 'Trip to Rome'])
+
+    def test_save_keeps_titles_the_user_set(self):
+        fresh = Conversation.objects.create(user=self.user, title=DEFAULT_TITLE)
+        renamed = Conversation.objects.create(user=self.user, title='My title')
+        first_message = 'x' * 80
+        batch = [(fresh.id, first_message, Future()), (renamed.id, 'rome?', Future())]
+        self.generator._save(batch, [None, 'Trip to Rome'])
+
+        fresh.refresh_from_db()
+        renamed.refresh_from_db()
+        self.assertEqual(fresh.title, 'x' * 50 + '...')
+        self.assertEqual(renamed.title, 'My title')
+        self.assertEqual([future.result() for _, _, future in batch], ['x' * 50 + '...', 'Trip to Rome'])
+
+
+class HistoryWindowTests(TestCase):
+    """History is read newest first, a page at a time, and only as far back as the budget reaches."""
+
+    def setUp(self):
+        self.provider = OpenRouterProvider('test/model')
+        user = get_user_model().objects.create_user('history@example.com', 'pw')
+        self.conversation = Conversation.objects.create(user=user)
+        self.messages = Message.objects.bulk_create([
+            Message(conversation=self.conversation, role='user' if i % 2 == 0 else 'assistant',
+                    content=f'message {i}', tokens_used=10)
+            for i in range(10)
+        ])
+        # Same timestamp throughout: pages must still be cut by id
+        Message.objects.filter(conversation=self.conversation).update(created_at=timezone.now())
+        patch = mock.patch.object(context, 'HISTORY_PAGE_SIZE', 3)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_newest_messages_that_fit_oldest_first(self):
+        window, complete = context.load_history_window(self.provider, self.conversation, 45)
+        self.assertEqual([m['content'] for m in window], [f'message {i}' for i in range(6, 10)])
+        self.assertFalse(complete)
+
+    def test_reads_only_the_pages_the_budget_needs(self):
+        with self.assertNumQueries(1):
+            window, _ = context.load_history_window(self.provider, self.conversation, 25)
+        self.assertEqual(len(window), 2)
+        with self.assertNumQueries(4):  # 3 + 3 + 3 + 1
+            window, complete = context.load_history_window(self.provider, self.conversation, 1000)
+        self.assertEqual(len(window), 10)
+        self.assertTrue(complete)
+
+    def test_exclude_and_after(self):
+        newest = self.messages[-1]
+        window, _ = context.load_history_window(self.provider, self.conversation, 1000, exclude_id=newest.id)
+        self.assertEqual(window[-1]['content'], 'message 8')
+        Message.objects.filter(id__in=[m.id for m in self.messages[:7]]).update(
+            created_at=timezone.now() - timedelta(hours=1))
+        window, complete = context.load_history_window(self.provider, self.conversation, 1000,
+                                                       after=timezone.now() - timedelta(minutes=30))
+        self.assertEqual([m['content'] for m in window], ['message 7', 'message 8', 'message 9'])
+        self.assertTrue(complete)
+
+
+class PromptCacheTests(SimpleTestCase):
+    """Breakpoints go after the stable prefix, only for models that need them; hits are measured per model."""
+
+    MESSAGES = [
+        {'role': 'system', 'content': 'You are helpful.'},
+        {'role': 'user', 'content': 'Earlier question'},
+        {'role': 'assistant', 'content': 'Earlier answer'},
+        {'role': 'user', 'content': 'New question'},
+    ]
+
+    def _marked(self, messages):
+        return [i for i, m in enumerate(messages) if not isinstance(m['content'], str)]
+
+    def test_breakpoints_after_system_prompt_and_history(self):
+        marked = with_breakpoints('anthropic/claude-3.5-sonnet', self.MESSAGES)
+        self.assertEqual(self._marked(marked), [0, 2])
+        self.assertEqual(marked[2]['content'][0], {'type': 'text', 'text': 'Earlier answer',
+                                                    'cache_control': {'type': 'ephemeral'}})
+        self.assertIsInstance(self.MESSAGES[0]['content'], str)  # the input is left alone
+
+    def test_first_turn_marks_the_system_prompt_only(self):
+        marked = with_breakpoints('anthropic/claude-3.5-sonnet', [self.MESSAGES[0], self.MESSAGES[-1]])
+        self.assertEqual(self._marked(marked), [0])
+
+    def test_implicitly_cached_models_are_unchanged(self):
+        self.assertIs(with_breakpoints('openai/gpt-4o', self.MESSAGES), self.MESSAGES)
+        with override_settings(LLM_PROMPT_CACHE_ENABLED=False):
+            self.assertIs(with_breakpoints('anthropic/claude-3.5-sonnet', self.MESSAGES), self.MESSAGES)
+
+    def test_hit_rate_per_model(self):
+        stats = PromptCacheStats()
+        hit = mock.Mock(prompt_tokens=1000, prompt_tokens_details={'cached_tokens': 800})
+        miss = mock.Mock(prompt_tokens=1000, prompt_tokens_details=None)
+        self.assertEqual(cached_tokens(hit), 800)
+        self.assertEqual(cached_tokens(miss), 0)
+        stats.record('test/model', hit, latency=1.0, ttft=0.2)
+        stats.record('test/model', miss, latency=2.0, ttft=0.6)
+        snapshot = stats.snapshot()['test/model']
+        self.assertEqual((snapshot['requests'], snapshot['hit_rate'], snapshot['cached_share']), (2, 0.5, 0.4))
+        self.assertEqual((snapshot['ttft_hit'], snapshot['ttft_miss']), (0.2, 0.6))
+
+
+async def _async_list(iterator):
+    return [item async for item in iterator]
+
+
+def _frames(chunks):
+    """(id, payload) for each SSE frame, id None when the frame has none."""
+    frames = []
+    for chunk in chunks:
+        text = chunk.decode() if isinstance(chunk, bytes) else chunk
+        lines = text.splitlines()
+        event_id = next((int(line[len('id: '):]) for line in lines if line.startswith('id: ')), None)
+        data = next(line for line in lines if line.startswith('data: '))
+        frames.append((event_id, json.loads(data[len('data: '):])))
+    return frames
+
+
+@override_settings(LLM_STREAM_COALESCE_WINDOW=0)
+class ResumableStreamTests(TestCase):
+    """A dropped client reconnects with Last-Event-ID and gets only what it missed, then the live rest."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('resume@example.com', 'pw')
+        self.headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        conversation = Conversation.objects.create(user=self.user)
+        Message.objects.create(conversation=conversation, user=self.user, role='user', content='Hi', tokens_used=1)
+        self.message = Message.objects.create(conversation=conversation, role='assistant', content='Hel',
+                                              status='streaming')
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    async def _resume(self, last_event_id):
+        return await self.async_client.post(f'/api/chat/stream/{self.message.id}/resume/',
+                                            headers={**self.headers, 'Last-Event-ID': str(last_event_id)})
+
+    async def test_replays_missed_events_then_follows_the_generation(self):
+        session = stream_registry.create(self.message.id, self.user.id)
+        self.addCleanup(stream_registry._sessions.pop, self.message.id, None)
+        session.publish({'type': 'start', 'message_id': self.message.id})
+        session.publish({'type': 'token', 'content': 'Hel'})
+        session.publish({'type': 'token', 'content': 'lo'})
+
+        response = await self._resume(2)
+        self.assertEqual(response.status_code, 200)
+        reader = asyncio.ensure_future(_async_list(response.streaming_content))
+        await asyncio.sleep(0.01)
+        session.publish({'type': 'token', 'content': ' there'})
+        session.publish({'type': 'done'})
+        session.finish()
+
+        frames = _frames(await reader)
+        self.assertEqual([event_id for event_id, _ in frames], [3, 4, 5])
+        self.assertEqual([payload.get('content') for _, payload in frames[:2]], ['lo', ' there'])
+
+    async def test_other_worker_follows_the_checkpoints(self):
+        await Message.objects.filter(id=self.message.id).aupdate(content='Hello there', status='complete',
+                                                                 tokens_used=2)
+        response = await self._resume(2)
+        frames = _frames(await _async_list(response.streaming_content))
+        self.assertEqual([payload['type'] for _, payload in frames], ['snapshot', 'done'])
+        self.assertEqual(frames[0][1]['content'], 'Hello there')
+        self.assertEqual(frames[1][1]['assistant_message']['content'], 'Hello there')
+
+    async def test_other_users_cannot_resume(self):
+        other = await sync_to_async(get_user_model().objects.create_user)('other@example.com', 'pw')
+        response = await self.async_client.post(f'/api/chat/stream/{self.message.id}/resume/',
+                                                headers={'Authorization': f'Bearer {AccessToken.for_user(other)}'})
+        self.assertEqual(response.status_code, 404)
+
+
+
+class CoalescedFramingTests(SimpleTestCase):
+    """Token events are merged into fewer SSE frames without delaying the first token."""
+
+    def _subscribe(self, publish, **kwargs):
+        async def scenario():
+            session = StreamSession(message_id=1, user_id=1)
+            reader = asyncio.ensure_future(_async_list(session.subscribe(**kwargs)))
+            await asyncio.sleep(0)
+            await publish(session)
+            session.finish()
+            return await reader
+        return asyncio.run(scenario())
+
+    def test_first_token_alone_then_merged_within_the_window(self):
+        async def publish(session):
+            for token in ['Hel', 'lo', ' the', 're']:
+                session.publish({'type': 'token', 'content': token})
+            await asyncio.sleep(0.05)  # past the window: the rest is flushed
+            session.publish({'type': 'done'})
+
+        events = self._subscribe(publish, coalesce=0.01, max_bytes=256)
+        self.assertEqual(events, [
+            (1, {'type': 'token', 'content': 'Hel'}),
+            (4, {'type': 'token', 'content': 'lo there'}),  # sent with the last merged token's seq
+            (5, {'type': 'done'}),
+        ])
+
+    def test_byte_limit_and_other_events_flush(self):
+        async def publish(session):
+            for token in ['a', 'bb', 'cc', 'd']:
+                session.publish({'type': 'token', 'content': token})
+            session.publish({'type': 'title', 'title': 'Letters'})
+
+        events = self._subscribe(publish, coalesce=10, max_bytes=4)
+        self.assertEqual([payload.get('content') for _, payload in events], ['a', 'bbcc', 'd', None])
+        self.assertEqual([seq for seq, _ in events], [1, 3, 4, 5])
+
+    def test_token_frame_matches_json(self):
+        for payload in ({'type': 'token', 'content': 'say "hi"\n\u00e9'}, {'type': 'done', 'id': 1}):
+            frame = sse_event(payload, 7)
+            self.assertTrue(frame.startswith('id: 7\ndata: '))
+            self.assertEqual(json.loads(frame.split('data: ', 1)[1]), payload)
@@ -0,0 +1,219 @@
+"""
+Tokenizer registry for OpenRouter model IDs.
+
+Maps each model to a tokenizer family. OpenAI families are counted exactly with
+tiktoken; the BPE files are read from TIKTOKEN_CACHE_DIR (populated at build
+time by `manage.py vendor_tokenizers`) and are never downloaded at runtime.
+The servers load them at startup (load_encodings) and refuse to start without
+them when TIKTOKEN_REQUIRED is set. Prompt parts that repeat across requests
+(system prompts, history, RAG chunks) hit an LRU cache; streamed answers don't.
+
+Families without a local tokenizer (Claude, Gemini, Llama, ...) are estimated
+with cl100k_base and a per-family ratio learned from provider-reported usage.
+"""
+import os
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+# (model id prefix, family). First match wins.
+MODEL_FAMILIES = [
+    ('openai/gpt-4o', 'o200k_base'),
+    ('openai/gpt-4.1', 'o200k_base'),
+    ('openai/gpt-4.5', 'o200k_base'),
+    ('openai/gpt-5', 'o200k_base'),
+    ('openai/o1', 'o200k_base'),
+    ('openai/o3', 'o200k_base'),
+    ('openai/o4', 'o200k_base'),
+    ('openai/gpt-4', 'cl100k_base'),
+    ('openai/gpt-3.5', 'cl100k_base'),
+    ('anthropic/', 'claude'),
+    ('google/', 'gemini'),
+    ('meta-llama/', 'llama'),
+    ('mistralai/', 'mistral'),
+    ('deepseek/', 'deepseek'),
+    ('qwen/', 'qwen'),
+]
+
+LOCAL_ENCODINGS = {'o200k_base', 'cl100k_base'}
+ESTIMATOR_ENCODING = 'cl100k_base'
+
+# Where tiktoken looks for each BPE file in TIKTOKEN_CACHE_DIR (the sha1 of its URL), and its sha256.
+# tiktoken re-downloads a file that is missing or fails the hash, so both are checked before loading.
+BPE_FILES = {
+    'cl100k_base': (
+        'https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken',
+        '223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7',
+    ),
+    'o200k_base': (
+        'https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken',
+        '446a9538cb6c348e3516120d7c08b09f57c36495e2acfffe59a5bf8b0cfb1a2d',
+    ),
+}
+
+# Starting ratios (provider tokens per cl100k token) before any usage is observed
+INITIAL_RATIOS = {
+    'claude': 1.15,
+    'gemini': 1.0,
+    'llama': 1.0,
+    'mistral': 1.1,
+    'deepseek': 1.0,
+    'qwen': 1.0,
+    'other': 1.1,
+}
+RATIO_SMOOTHING = 0.1       # EMA weight of each new observation
+MESSAGE_OVERHEAD = 4        # Tokens of chat framing per message
+
+_lock = threading.Lock()
+_encodings = {}
+_ratios = dict(INITIAL_RATIOS)
+
+
+def model_family(model):
+    """Tokenizer family for an OpenRouter model ID."""
+    model = (model or '').lower()
+    for prefix, family in MODEL_FAMILIES:
+        if model.startswith(prefix):
+            return family
+    return 'other'
+
+
+def bpe_path(name):
+    """Path of an encoding's vendored BPE file."""
+    url, _ = BPE_FILES[name]
+    return os.path.join(str(settings.TIKTOKEN_CACHE_DIR), hashlib.sha1(url.encode()).hexdigest())
+
+
+def is_vendored(name):
+    """True if the encoding's BPE file is in TIKTOKEN_CACHE_DIR and intact."""
+    if name not in BPE_FILES:
+        return False
+    try:
+        with open(bpe_path(name), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return False
+    return hashlib.sha256(data).hexdigest() == BPE_FILES[name][1]
+
+
+def _load(name):
+    if not is_vendored(name):
+        logger.warning(f"Tokenizer '{name}' is not vendored (run `manage.py vendor_tokenizers`); "
+                       f"using character estimates.")
+        return None
+    os.environ['TIKTOKEN_CACHE_DIR'] = str(settings.TIKTOKEN_CACHE_DIR)
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.warning(f"Tokenizer '{name}' unavailable ({e}); using character estimates.")
+        return None
+
+
+def get_encoding(name):
+    """A tiktoken encoding from its vendored file, loaded once per process. None if it is unavailable."""
+    if name in _encodings:
+        return _encodings[name]
+    with _lock:
+        if name not in _encodings:
+            _encodings[name] = _load(name)
+    return _encodings[name]
+
+
+def load_encodings():
+    """
+    Load the local encodings at server startup, so no request waits for them.
+    Raises ImproperlyConfigured if one is missing and TIKTOKEN_REQUIRED is set.
+    """
+    missing = sorted(name for name in LOCAL_ENCODINGS if get_encoding(name) is None)
+    if missing and getattr(settings, 'TIKTOKEN_REQUIRED', False):
+        raise ImproperlyConfigured(
+            f"Tokenizers {', '.join(missing)} are not vendored in {settings.TIKTOKEN_CACHE_DIR}. "
+            f"Run `manage.py vendor_tokenizers` at build time."
+        )
+
+
+def _count(encoding_name, text):
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode_ordinary(text))
+
+
+# Repeated prompt parts only: one-off text would evict them and keep large strings alive
+_count_cached = lru_cache(maxsize=4096)(_count)
+
+
+def _encoding_for(family):
+    return family if family in LOCAL_ENCODINGS else ESTIMATOR_ENCODING
+
+
+def count_tokens(text, model=None, cache=False):
+    """
+    Token count of text for a model (exact for OpenAI families, calibrated estimate otherwise).
+    cache=True memoizes the count, for text that repeats across requests (system prompts, history).
+    """
+    if not text:
+        return 0
+    family = model_family(model)
+    tokens = (_count_cached if cache else _count)(_encoding_for(family), text)
+    if family in LOCAL_ENCODINGS:
+        return tokens
+    return int(round(tokens * _ratios.get(family, 1.0)))
+
+
+def encode_batch(texts, model=None):
+    """Encode several texts in one call (token ids from the model's encoding or the estimator)."""
+    name = _encoding_for(model_family(model))
+    encoding = get_encoding(name)
+    if encoding is None:
+        raise RuntimeError(f"Tokenizer '{name}' is not available. Run `manage.py vendor_tokenizers`.")
+    return encoding.encode_ordinary_batch(list(texts))
+
+
+def count_tokens_batch(texts, model=None):
+    """Token counts for several prompt texts; cached strings skip encoding."""
+    return [count_tokens(text, model, cache=True) for text in texts]
+
+
+def count_messages_tokens(messages, model=None):
+    """Prompt token count for a chat message list, including per-message framing."""
+    total = 3
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list):
+            content = ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+        total += count_tokens(content or '', model, cache=True) + MESSAGE_OVERHEAD
+    return total
+
+
+def observe_usage(model, messages, reported_prompt_tokens):
+    """Learn the estimate ratio for families without a local tokenizer from provider-reported usage."""
+    family = model_family(model)
+    if family in LOCAL_ENCODINGS or not reported_prompt_tokens:
+        return
+    raw = 3
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            raw += _count_cached(ESTIMATOR_ENCODING, content) + MESSAGE_OVERHEAD
+    if raw < 20:
+        return  # Too short to say anything about the ratio
+    observed = reported_prompt_tokens / raw
+    if not 0.3 <= observed <= 3.0:
+        return  # Outlier (e.g. images or provider-side prompt rewriting)
+    with _lock:
+        current = _ratios.get(family, 1.0)
+        _ratios[family] = current + RATIO_SMOOTHING * (observed - current)
+
+
+def calibration():
+    """Current estimate ratios per family."""
+    with _lock:
+        return dict(_ratios)
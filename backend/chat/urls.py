@@ -8,9 +8,19 @@ from .views import (
     ChatHistoryView,
     SendMessageView,
     StreamingMessageView,
+    ResumeStreamView,
+    CompareModelsView,
     TokenUsageView,
+    UsageSummaryView,
     ClearConversationView,
     AvailableModelsView,
+    BatchJobListCreateView,
+    BatchJobDetailView,
+    BatchJobResultsView,
+    BatchJobCancelView,
+    BatchJobResumeView,
+    UpstreamPoolStatsView,
+    ModelHealthView,
 )
 
 urlpatterns = [
@@ -20,6 +30,16 @@ urlpatterns = [
     path('history/', ChatHistoryView.as_view(), name='chat_history'),
     path('send/', SendMessageView.as_view(), name='send_message'),
     path('stream/', StreamingMessageView.as_view(), name='stream_message'),
+    path('stream/<int:pk>/resume/', ResumeStreamView.as_view(), name='resume_stream'),
+    path('compare/', CompareModelsView.as_view(), name='compare_models'),
     path('token-usage/', TokenUsageView.as_view(), name='token_usage'),
+    path('usage/', UsageSummaryView.as_view(), name='usage_summary'),
     path('models/', AvailableModelsView.as_view(), name='available_models'),
+    path('batches/', BatchJobListCreateView.as_view(), name='batch_jobs'),
+    path('batches/<int:pk>/', BatchJobDetailView.as_view(), name='batch_job_detail'),
+    path('batches/<int:pk>/results/', BatchJobResultsView.as_view(), name='batch_job_results'),
+    path('batches/<int:pk>/cancel/', BatchJobCancelView.as_view(), name='batch_job_cancel'),
+    path('batches/<int:pk>/resume/', BatchJobResumeView.as_view(), name='batch_job_resume'),
+    path('upstream/pool/', UpstreamPoolStatsView.as_view(), name='upstream_pool_stats'),
+    path('upstream/health/', ModelHealthView.as_view(), name='upstream_model_health'),
 ]
\ No newline at end of file
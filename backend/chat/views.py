@@ -5,15 +5,38 @@ from rest_framework import status, generics
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import AuthenticationFailed, Throttled
+from rest_framework.settings import api_settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Avg, Count, F, Q, Sum
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from asgiref.sync import sync_to_async
+import asyncio
+import json
+import hashlib
+import hmac
+import time
 import logging
+from datetime import timedelta
+from decimal import Decimal
 
 logger = logging.getLogger(__name__)
 
-from .models import Conversation, Message
+from .models import Conversation, Message, BatchJob, BatchItem, UsageRecord
 
 from .serializers import (
+    BatchJobSerializer,
+    CreateBatchJobSerializer,
+    CompareModelsSerializer,
     ConversationSerializer,
     ConversationDetailSerializer,
     MessageSerializer,
@@ -21,7 +44,18 @@ from .serializers import (
     CreateConversationSerializer,
     TokenUsageSerializer,
 )
-from .ai_providers import AIServiceFactory, OpenRouterProvider
+from .ai_providers import AIServiceFactory, UpstreamCall
+from . import clients, metrics
+from .catalog import model_catalog, search
+from .compare import ModelRun, compare_stream
+from .deadlines import Deadline, DeadlineExceeded
+from .health import model_health
+from .prompt_cache import prompt_cache_stats
+from .response_cache import response_cache
+from .streams import stream_registry, stream_stats, Checkpointer
+from .scheduler import scheduler, user_priority, UpstreamOverloaded
+from .tasks import title_generator, batch_runner, parse_batch_prompts, DEFAULT_TITLE
+from .context import BudgetExhausted, build_messages, completion_budget, token_usage
 
 
 class ConversationListCreateView(generics.ListCreateAPIView):
@@ -114,17 +148,20 @@ class SendMessageView(APIView):
     permission_classes = [IsAuthenticated]
     
     def post(self, request):
+        deadline = Deadline.for_endpoint('send')
         serializer = SendMessageSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         
         user_message = serializer.validated_data['message']
-        conversation_id = serializer.validated_data.get('conversation_id')
+        conversation_id = serializer.validated_data['conversation_id']
         provider = serializer.validated_data.get('provider', 'gemini')
         model = serializer.validated_data.get('model')
+        persona = serializer.validated_data.get('persona', 'general')
+        routing = serializer.validated_data.get('routing')
         
         # Get AI Service
         try:
-             ai_service = AIServiceFactory.get_service(provider, model)
+             ai_service = AIServiceFactory.get_service(provider, model, routing)
         except Exception as e:
              return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
@@ -150,17 +187,12 @@ class SendMessageView(APIView):
                 'success': False,
                 'error': 'token_limit_exceeded',
                 'message':  'Token limit reached.Please make a payment to continue.',
-                'token_usage': {
-                    'total_tokens_used': conversation.total_tokens_used,
-                    'token_limit': conversation.token_limit,
-                    'remaining_tokens': conversation.remaining_tokens,
-                    'usage_percentage': conversation.usage_percentage,
-                }
+                'token_usage': token_usage(conversation)
             }, status=status.HTTP_402_PAYMENT_REQUIRED)
         
-        # Save user message
+        # The user message is saved together with the answer (see Message.bulk_record)
         user_msg_tokens = ai_service.count_tokens(user_message)
-        user_msg = Message.objects.create(
+        user_msg = Message(
             conversation=conversation,
             user=request.user,
             role='user',
@@ -168,84 +200,33 @@ class SendMessageView(APIView):
             tokens_used=user_msg_tokens
         )
         
-        # Build context from conversation history
-        # Inclusion of tokens_used allows AIService.truncate_context to skip re-calculating tokens
-        history = list(conversation.messages.exclude(id=user_msg.id).values('role', 'content', 'tokens_used'))
-        
-        persona = serializer.validated_data.get('persona', 'general')
-        
-        # Define System Prompts
-        system_prompts = {
-            'general': (
-                "You are a helpful AI assistant. At the end of every response, you MUST provide 3 related follow-up questions or topics. "
-                "Separate this section from the main response with the exact string '===RELATED==='. "
-                "Format the related topics as a simple list, one title per line, without numbering or bullets. "
-            ),
-            'developer': (
-                "You are an expert Senior Software Engineer. You write clean, efficient, and well-documented code. "
-                "Always explain your architectural decisions. Prefer modern best practices. "
-                "At the end of every response, provide 3 related advanced technical topics or optimization tips using '===RELATED===' separator."
-            ),
-            'creative': (
-                "You are a visionary creative writer and storyteller. Use evocative language, vivid imagery, and unique metaphors. "
-                "Avoid clichés. Inspire the user with your responses. "
-                "At the end of every response, suggest 3 creative directions or twists using '===RELATED===' separator."
-            ),
-            'analyst': (
-                "You are a meticulous Data Analyst. Focus on facts, statistics, and logical deductions. "
-                "Structure your answers with clear headings and bullet points. Avoid speculation. "
-                "At the end of every response, suggest 3 further analytical angles or data points to investigate using '===RELATED===' separator."
-            )
-        }
-        
-        selected_prompt = system_prompts.get(persona, system_prompts['general'])
-        
-        # --- RAG Context Injection ---
-        rag_context = ""
+        # Build context from history, persona prompt and RAG chunks
         try:
-            from knowledge_base.services import query_knowledge_base
-            from knowledge_base.models import Document
-            
-            # Check if user has any ready documents
-            has_docs = Document.objects.filter(user=request.user, status='ready').exists()
-            if has_docs:
-                relevant_chunks = query_knowledge_base(
-                    user_id=request.user.id,
-                    query_text=user_message,
-                    n_results=3,
-                )
-                if relevant_chunks:
-                    rag_context = (
-                        "\n\n--- CONTEXT FROM USER'S DOCUMENTS ---\n"
-                        + "\n---\n".join(relevant_chunks)
-                        + "\n--- END CONTEXT ---\n"
-                        "Use the above context to inform your answer when relevant. "
-                        "If the context is not relevant to the question, ignore it.\n"
-                    )
-        except Exception as e:
-            import logging
-            logging.getLogger(__name__).warning(f"RAG query failed: {e}")
-        
-        system_instruction = {
-            'role': 'system', 
-            'content': selected_prompt + rag_context
-        }
-        
-        # Prepare messages for truncation
-        full_mesages_stack = [system_instruction] + history + [{'role': 'user', 'content': user_message, 'tokens_used': user_msg_tokens}]
-
-        # Truncate context if needed (uses pre-calculated tokens from history)
-        available_tokens = conversation.remaining_tokens - 1000  # Reserve for response
-        messages = ai_service.truncate_context(full_mesages_stack, available_tokens)
+            messages = build_messages(ai_service, conversation, user_msg, persona, request.user)
+        except BudgetExhausted as e:
+            return _budget_exhausted_response(conversation, e)
+        # The answer may not spend more than the conversation has left after the message
+        budget = completion_budget(ai_service, conversation, persona, messages, reserved=user_msg_tokens)
         
         # Generate AI response
         try:
-            # Allow response to complete even if it exceeds remaining tokens (overdraft)
-            response_text, prompt_tokens, completion_tokens = ai_service.generate_response(
-                messages,
-                max_tokens=4000
-            )
+            with scheduler.slot(request.user.id, user_priority(request.user)):
+                response_text, prompt_tokens, completion_tokens = ai_service.generate_response(
+                    messages,
+                    max_tokens=budget.max_tokens,
+                    deadline=deadline,
+                    call=UpstreamCall('send', request.user.id, conversation.id)
+                )
 
+        except UpstreamOverloaded as e:
+            return _overloaded_response(e)
+        except DeadlineExceeded as e:
+            logger.warning(f"Send gave up after its {e.budget:.0f}s deadline")
+            return Response({
+                'success': False,
+                'error': 'deadline_exceeded',
+                'message': str(e)
+            }, status=status.HTTP_504_GATEWAY_TIMEOUT)
         except Exception as e:
             logger.error(f"AI Generation Error: {e}")
             error_msg = str(e)
@@ -256,209 +237,525 @@ class SendMessageView(APIView):
                  'message': error_msg
              }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Save assistant message
-        assistant_msg = Message.objects.create(
+        # Save both messages and charge their tokens in one transaction
+        assistant_msg = Message(
             conversation=conversation,
             user=None,
             role='assistant',
             content=response_text,
             tokens_used=completion_tokens
         )
+        Message.bulk_record([user_msg, assistant_msg])
         
-        # Update conversation title if it's the first message
-        if conversation.messages.count() <= 2 and conversation.title == 'New Conversation':
-            new_title = ai_service.generate_title(user_message)
-            conversation.title = new_title
-            conversation.save(update_fields=['title'])
+        # Title the conversation in the background; clients pick it up on the next list fetch
+        if conversation.messages.count() <= 2 and conversation.title == DEFAULT_TITLE:
+            title_generator.enqueue(conversation.id, user_message)
         
         return Response({
             'success': True,
             'user_message': MessageSerializer(user_msg).data,
             'assistant_message': MessageSerializer(assistant_msg).data,
             'conversation': ConversationSerializer(conversation).data,
-            'token_usage': {
-                'total_tokens_used': conversation.total_tokens_used,
-                'token_limit': conversation.token_limit,
-                'remaining_tokens': conversation.remaining_tokens,
-                'usage_percentage': conversation.usage_percentage,
-            }
+            'token_usage': token_usage(conversation),
+            'budget_exhausted': budget.exhausted(completion_tokens),
         })
 
 
-class StreamingMessageView(APIView):
-    """Stream AI response token-by-token using Server-Sent Events (SSE)."""
-    
-    permission_classes = [IsAuthenticated]
+# Token frames are the bulk of a stream: only the content needs encoding
+TOKEN_FRAME_PREFIX = 'data: {"type": "token", "content": '
+
+
+def sse_event(data, event_id=None):
+    """Format a payload as a Server-Sent Events frame (with an optional `id:` for resuming)."""
+    if data.get('type') == 'token' and len(data) == 2:
+        frame = f"{TOKEN_FRAME_PREFIX}{json.dumps(data['content'])}}}\n\n"
+    else:
+        frame = f"data: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+    if event_id is not None:
+        frame = f"id: {event_id}\n" + frame
+    return frame
+
+
+def _overloaded_response(error, json_response=False):
+    """503 with Retry-After for a request shed by the upstream scheduler."""
+    body = {'success': False, 'error': 'overloaded', 'message': str(error), 'retry_after': error.retry_after}
+    if json_response:
+        response = JsonResponse(body, status=503)
+    else:
+        response = Response(body, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def _budget_exhausted_response(conversation, error, json_response=False):
+    """402 for a conversation without room for the prompt and an answer (see context.BudgetExhausted)."""
+    body = {
+        'success': False,
+        'error': 'token_limit_exceeded',
+        'message': str(error),
+        'token_usage': token_usage(conversation),
+    }
+    if json_response:
+        return JsonResponse(body, status=402)
+    return Response(body, status=status.HTTP_402_PAYMENT_REQUIRED)
+
+
+def _disconnect_event(request):
+    """asyncio.Event set when the client disconnects (see byteforge.asgi), if the server provides one."""
+    return getattr(request, 'scope', {}).get('disconnected')
+
+
+def _sse_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
+    return response
+
+
+def _authenticate(request, view):
+    """
+    Authenticate a plain Django view the way APIView would: the JWT user, then
+    the API's default throttles. Returns (user, None), or (None, error response).
+    """
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except (InvalidToken, AuthenticationFailed) as e:
+        return None, JsonResponse({'detail': str(e)}, status=401)
+    user = result[0] if result else None
+    if user is None or not user.is_active:
+        return None, JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    request.user = user
+    for throttle_class in api_settings.DEFAULT_THROTTLE_CLASSES:
+        throttle = throttle_class()
+        if not throttle.allow_request(request, view):
+            wait = throttle.wait()
+            response = JsonResponse({'detail': str(Throttled(wait).detail)}, status=429)
+            if wait is not None:
+                response['Retry-After'] = str(int(wait))
+            return None, response
+    return user, None
+
+
+def _done_payload(user_msg, assistant_msg, conversation):
+    """Final SSE metadata event sent once the stream is persisted."""
+    return {
+        'type': 'done',
+        'user_message': MessageSerializer(user_msg).data,
+        'assistant_message': MessageSerializer(assistant_msg).data,
+        'conversation': ConversationSerializer(conversation).data,
+        'token_usage': token_usage(conversation),
+    }
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class StreamingMessageView(View):
+    """
+    Stream AI response token-by-token using Server-Sent Events (SSE).
+
+    Fully async so it runs natively under byteforge.asgi: the upstream call uses
+    the async OpenAI client and the event loop is never blocked while a stream is
+    open, so a single worker can hold many concurrent streams.
+    """
     
-    def post(self, request):
-        import json
-        from django.http import StreamingHttpResponse
-        from django.core.serializers.json import DjangoJSONEncoder
+    async def post(self, request):
+        deadline = Deadline.for_endpoint('stream')
+        user, error = await sync_to_async(_authenticate)(request, self)
+        if error is not None:
+            return error
         
-        serializer = SendMessageSerializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
+        try:
+            payload = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid JSON body'}, status=400)
+        
+        serializer = SendMessageSerializer(data=payload)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
         
         user_message = serializer.validated_data['message']
-        conversation_id = serializer.validated_data.get('conversation_id')
+        conversation_id = serializer.validated_data['conversation_id']
         provider = serializer.validated_data.get('provider', 'openai')
         model = serializer.validated_data.get('model')
         persona = serializer.validated_data.get('persona', 'general')
+        hedge = serializer.validated_data.get('hedge') or settings.LLM_HEDGE_STREAMS
+        routing = serializer.validated_data.get('routing')
         
         # Get AI Service
         try:
-            ai_service = AIServiceFactory.get_service(provider, model)
+            ai_service = AIServiceFactory.get_service(provider, model, routing)
         except Exception as e:
-            return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
         
         # Get or create conversation
         if conversation_id:
             try:
-                conversation = Conversation.objects.get(id=conversation_id, user=request.user)
+                conversation = await Conversation.objects.aget(id=conversation_id, user=user)
             except Conversation.DoesNotExist:
-                return Response({'success': False, 'error': 'Conversation not found'}, status=404)
+                return JsonResponse({'success': False, 'error': 'Conversation not found'}, status=404)
         else:
-            conversation = Conversation.objects.create(user=request.user, title='New Conversation')
+            conversation = await Conversation.objects.acreate(user=user, title='New Conversation')
         
         # Check token limit
         estimated_tokens = ai_service.count_tokens(user_message) + 500
         if not conversation.can_send_message(estimated_tokens):
-            return Response({
+            return JsonResponse({
                 'success': False,
                 'error': 'token_limit_exceeded',
                 'message': 'Token limit reached. Please make a payment to continue.',
-                'token_usage': {
-                    'total_tokens_used': conversation.total_tokens_used,
-                    'token_limit': conversation.token_limit,
-                    'remaining_tokens': conversation.remaining_tokens,
-                    'usage_percentage': conversation.usage_percentage,
-                }
-            }, status=status.HTTP_402_PAYMENT_REQUIRED)
-        
-        # Save user message
-        user_msg_tokens = ai_service.count_tokens(user_message)
-        user_msg = Message.objects.create(
-            conversation=conversation,
-            user=request.user,
-            role='user',
-            content=user_message,
-            tokens_used=user_msg_tokens
-        )
-        
-        # Build context
-        history = list(conversation.messages.exclude(id=user_msg.id).values('role', 'content', 'tokens_used'))
-        
-        system_prompts = {
-            'general': (
-                "You are a helpful AI assistant. At the end of every response, you MUST provide 3 related follow-up questions or topics. "
-                "Separate this section from the main response with the exact string '===RELATED==='. "
-                "Format the related topics as a simple list, one title per line, without numbering or bullets. "
-            ),
-            'developer': (
-                "You are an expert Senior Software Engineer. You write clean, efficient, and well-documented code. "
-                "Always explain your architectural decisions. Prefer modern best practices. "
-                "At the end of every response, provide 3 related advanced technical topics or optimization tips using '===RELATED===' separator."
-            ),
-            'creative': (
-                "You are a visionary creative writer and storyteller. Use evocative language, vivid imagery, and unique metaphors. "
-                "Avoid clichés. Inspire the user with your responses. "
-                "At the end of every response, suggest 3 creative directions or twists using '===RELATED===' separator."
-            ),
-            'analyst': (
-                "You are a meticulous Data Analyst. Focus on facts, statistics, and logical deductions. "
-                "Structure your answers with clear headings and bullet points. Avoid speculation. "
-                "At the end of every response, suggest 3 further analytical angles or data points to investigate using '===RELATED===' separator."
-            )
-        }
+                'token_usage': token_usage(conversation)
+            }, status=402)
         
-        selected_prompt = system_prompts.get(persona, system_prompts['general'])
+        # Upstream slot (held until the upstream stream ends); shed load before anything is saved
+        try:
+            priority = await sync_to_async(user_priority)(user)
+            lease = await scheduler.aacquire(user.id, priority)
+        except UpstreamOverloaded as e:
+            return _overloaded_response(e, json_response=True)
         
-        # RAG context
-        rag_context = ""
         try:
-            from knowledge_base.services import query_knowledge_base
-            from knowledge_base.models import Document
+            user_msg_tokens = ai_service.count_tokens(user_message)
+            user_msg = Message(
+                conversation=conversation,
+                user=user,
+                role='user',
+                content=user_message,
+                tokens_used=user_msg_tokens
+            )
             
-            has_docs = Document.objects.filter(user=request.user, status='ready').exists()
-            if has_docs:
-                relevant_chunks = query_knowledge_base(user_id=request.user.id, query_text=user_message, n_results=3)
-                if relevant_chunks:
-                    rag_context = (
-                        "\n\n--- CONTEXT FROM USER'S DOCUMENTS ---\n"
-                        + "\n---\n".join(relevant_chunks)
-                        + "\n--- END CONTEXT ---\n"
-                        "Use the above context to inform your answer when relevant. "
-                        "If the context is not relevant to the question, ignore it.\n"
-                    )
-        except Exception as e:
-            logger.warning(f"RAG query failed: {e}")
-        
-        system_instruction = {'role': 'system', 'content': selected_prompt + rag_context}
-        
-        full_messages_stack = [system_instruction] + history + [
-            {'role': 'user', 'content': user_message, 'tokens_used': user_msg_tokens}
-        ]
-        
-        available_tokens = conversation.remaining_tokens - 1000
-        messages = ai_service.truncate_context(full_messages_stack, available_tokens)
+            # RAG and history are loaded off the event loop (embedding + vector search are blocking)
+            messages = await sync_to_async(build_messages)(ai_service, conversation, user_msg, persona, user)
+            budget = await sync_to_async(completion_budget)(
+                ai_service, conversation, persona, messages, reserved=user_msg_tokens
+            )
+            
+            # The answer is persisted as it streams, so a dropped client can resume it. The user
+            # message and the placeholder are saved (and the message charged) in one transaction.
+            assistant_msg = Message(
+                conversation=conversation,
+                user=None,
+                role='assistant',
+                content='',
+                status='streaming',
+            )
+            await sync_to_async(Message.bulk_record)([user_msg, assistant_msg])
+        except BudgetExhausted as e:
+            scheduler.release(lease)
+            return _budget_exhausted_response(conversation, e, json_response=True)
+        except BaseException:
+            scheduler.release(lease)
+            raise
+        session = stream_registry.create(assistant_msg.id, user.id)
+        session.publish({
+            'type': 'start',
+            'message_id': assistant_msg.id,
+            'conversation_id': conversation.id,
+        })
         
-        def event_stream():
-            """Generator that yields SSE events."""
+        async def generate():
+            """Run the upstream stream and publish its events to the session."""
             full_response = []
+            checkpoint = Checkpointer()
+            max_tokens = budget.max_tokens
+            # Completion tokens so far, one per content chunk (the final charge uses the reported usage)
+            used = 0
+            # Set once the answer is saved and charged; a disconnect after that changes nothing
+            finalized = False
+            metrics.ACTIVE_STREAMS.inc()
             
             try:
                 # Stream tokens from OpenRouter
-                for token in ai_service.generate_response_stream(messages, max_tokens=4000):
-                    full_response.append(token)
-                    # SSE format: data: {json}\n\n
-                    yield f"data: {json.dumps({'type': 'token', 'content': token})}\n\n"
+                call = UpstreamCall('stream', user.id, conversation.id)
+                stream = ai_service.agenerate_response_stream(messages, max_tokens=max_tokens, hedge=hedge,
+                                                              deadline=deadline, call=call)
+                try:
+                    async for token in stream:
+                        full_response.append(token)
+                        session.publish({'type': 'token', 'content': token})
+                        used += 1
+                        if checkpoint.tick():
+                            partial_text = ''.join(full_response)
+                            await Message.objects.filter(id=assistant_msg.id).aupdate(content=partial_text)
+                            # Other answers in this conversation may have spent tokens meanwhile
+                            limit, spent = await Conversation.objects.filter(id=conversation.id).values_list(
+                                'token_limit', 'total_tokens_used'
+                            ).aget()
+                            budget.tighten(limit - spent)
+                        if budget.exhausted(used):
+                            break
+                finally:
+                    # Stops the upstream generation when we leave early
+                    await stream.aclose()
+                    # Upstream work is over: don't hold the slot while saving or waiting for the title
+                    scheduler.release(lease)
                 
                 # Streaming complete — save to DB
                 response_text = ''.join(full_response)
-                completion_tokens = ai_service.count_tokens(response_text)
-                
-                assistant_msg = Message.objects.create(
-                    conversation=conversation,
-                    user=None,
-                    role='assistant',
-                    content=response_text,
-                    tokens_used=completion_tokens
+                # Provider-reported usage when the stream had it; the upstream stops at max_tokens,
+                # so a local estimate above that is not charged
+                usage = call.usage
+                if usage is not None and usage.completion_tokens:
+                    completion_tokens = usage.completion_tokens
+                else:
+                    completion_tokens = min(ai_service.count_tokens(response_text), max_tokens)
+                exhausted = budget.exhausted(max(used, completion_tokens))
+                await sync_to_async(assistant_msg.finalize)(
+                    response_text, completion_tokens, status='truncated' if exhausted else 'complete'
                 )
+                finalized = True
+                stream_stats.record_completed(completion_tokens)
+                if exhausted:
+                    logger.info(f"Stream {assistant_msg.id} stopped: conversation {conversation.id} is out of tokens")
+                
+                # Title the conversation in the background (a cheap model, batched)
+                title_future = None
+                if await conversation.messages.acount() <= 2 and conversation.title == DEFAULT_TITLE:
+                    title_future = title_generator.enqueue(conversation.id, user_message)
                 
-                # Auto-generate title for first message
-                if conversation.messages.count() <= 2 and conversation.title == 'New Conversation':
+                # Send final metadata event (serializers hit the DB, so run them off the loop);
+                # a stream cut short by the token budget ends with 'budget_exhausted' instead of 'done'
+                done = await sync_to_async(_done_payload)(user_msg, assistant_msg, conversation)
+                if exhausted:
+                    done['type'] = 'budget_exhausted'
+                    done['message'] = 'Token limit reached. Please make a payment to continue.'
+                session.publish(done)
+                
+                # Push the title as an update event if it is ready shortly after the answer
+                if title_future is not None:
                     try:
-                        new_title = ai_service.generate_title(user_message)
-                        conversation.title = new_title
-                        conversation.save(update_fields=['title'])
+                        title = await asyncio.wait_for(
+                            asyncio.shield(asyncio.wrap_future(title_future)),
+                            settings.LLM_TITLE_PUSH_WAIT,
+                        )
+                        session.publish({'type': 'title', 'conversation_id': conversation.id, 'title': title})
                     except Exception:
-                        pass
-                
-                # Send final metadata event (use DjangoJSONEncoder for datetime/UUID)
-                done_data = {
-                    'type': 'done',
-                    'user_message': MessageSerializer(user_msg).data,
-                    'assistant_message': MessageSerializer(assistant_msg).data,
-                    'conversation': ConversationSerializer(conversation).data,
-                    'token_usage': {
-                        'total_tokens_used': conversation.total_tokens_used,
-                        'token_limit': conversation.token_limit,
-                        'remaining_tokens': conversation.remaining_tokens,
-                        'usage_percentage': conversation.usage_percentage,
-                    }
-                }
-                yield f"data: {json.dumps(done_data, cls=DjangoJSONEncoder)}\n\n"
+                        pass  # The title still lands in the next conversation list fetch
                 
+            except asyncio.CancelledError:
+                # Nobody is listening any more: the upstream stream is closed by the cancellation
+                # (while waiting for the title the answer is already saved and charged)
+                if not finalized:
+                    partial_text = ''.join(full_response)
+                    saved = stream_stats.record_cancelled(used, max_tokens)
+                    metrics.STREAMS_CANCELLED.inc()
+                    metrics.TOKENS_SAVED.inc(saved)
+                    logger.info(f"Stream {assistant_msg.id} cancelled after client disconnect (~{saved} tokens saved)")
+                    await _abandon_stream(assistant_msg, partial_text, ai_service)
+                raise
             except Exception as e:
                 logger.error(f"Stream Error: {e}")
-                yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+                if not finalized:
+                    await _abandon_stream(assistant_msg, ''.join(full_response), ai_service)
+                session.publish({'type': 'error', 'message': str(e)})
+            finally:
+                scheduler.release(lease)
+                metrics.ACTIVE_STREAMS.dec()
         
-        response = StreamingHttpResponse(
-            event_stream(),
-            content_type='text/event-stream'
-        )
-        response['Cache-Control'] = 'no-cache'
-        response['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
-        return response
+        # Started here rather than when the body is first read: the task owns the slot from now
+        # on, so a response that is never sent (the client left already) still releases it
+        session.start(generate())
+        
+        async def event_stream():
+            """Async generator that yields SSE events."""
+            async for seq, payload in session.subscribe(disconnected=_disconnect_event(request)):
+                yield sse_event(payload, seq)
+        
+        return _sse_response(event_stream())
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ResumeStreamView(View):
+    """
+    Reconnect to an assistant message's stream.
+
+    Replays the events after Last-Event-ID and then follows the still-running
+    generation. If the stream is not held by this worker, the message's
+    checkpoints are followed from the database instead.
+    """
+    
+    async def post(self, request, pk):
+        user, error = await sync_to_async(_authenticate)(request, self)
+        if error is not None:
+            return error
+        
+        try:
+            message = await Message.objects.select_related('conversation').aget(
+                id=pk, role='assistant', conversation__user=user
+            )
+        except Message.DoesNotExist:
+            return JsonResponse({'success': False, 'error': 'Message not found'}, status=404)
+        
+        try:
+            last_event_id = int(request.headers.get('Last-Event-ID') or request.GET.get('last_event_id') or 0)
+        except ValueError:
+            last_event_id = 0
+        
+        session = stream_registry.get(message.id, user.id)
+        if session is not None:
+            events = _replay_session(session, last_event_id, _disconnect_event(request))
+        else:
+            events = _follow_checkpoints(message)
+        return _sse_response(events)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CompareModelsView(View):
+    """
+    Send one message to several models at once and stream all answers over a
+    single SSE connection, every event tagged with its model.
+
+    Comparisons run inside an existing conversation (conversation_id is
+    required). The prompt is assembled once from it and the token budget is
+    checked once for the whole fan-out. Comparisons are not added to the
+    conversation history; their tokens (the message once, plus every answer)
+    are charged to the conversation.
+    """
+    
+    async def post(self, request):
+        deadline = Deadline.for_endpoint('compare')
+        user, error = await sync_to_async(_authenticate)(request, self)
+        if error is not None:
+            return error
+        
+        try:
+            payload = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid JSON body'}, status=400)
+        
+        serializer = CompareModelsSerializer(data=payload)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+        
+        user_message = serializer.validated_data['message']
+        conversation_id = serializer.validated_data['conversation_id']
+        persona = serializer.validated_data.get('persona', 'general')
+        models = list(dict.fromkeys(serializer.validated_data['models']))
+        max_models = settings.LLM_COMPARE_MAX_MODELS
+        if not 2 <= len(models) <= max_models:
+            return JsonResponse({
+                'success': False,
+                'error': f'Pick between 2 and {max_models} different models to compare'
+            }, status=400)
+        
+        try:
+            runs = [ModelRun(AIServiceFactory.get_service('openrouter', model)) for model in models]
+        except Exception as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        ai_service = runs[0].service
+        
+        try:
+            conversation = await Conversation.objects.aget(id=conversation_id, user=user)
+        except Conversation.DoesNotExist:
+            return JsonResponse({'success': False, 'error': 'Conversation not found'}, status=404)
+        for run in runs:
+            run.call = UpstreamCall('compare', user.id, conversation.id)
+        
+        # One budget check for the whole fan-out: the message once, a response reserve per model
+        user_msg_tokens = ai_service.count_tokens(user_message)
+        if not conversation.can_send_message(user_msg_tokens + 500 * len(runs)):
+            return JsonResponse({
+                'success': False,
+                'error': 'token_limit_exceeded',
+                'message': 'Token limit reached. Please make a payment to continue.',
+                'token_usage': token_usage(conversation)
+            }, status=402)
+        
+        # The message is not saved: it only carries the prompt into context assembly
+        user_msg = Message(conversation=conversation, user=user, role='user',
+                           content=user_message, tokens_used=user_msg_tokens)
+        try:
+            messages = await sync_to_async(build_messages)(ai_service, conversation, user_msg, persona, user)
+        except BudgetExhausted as e:
+            return _budget_exhausted_response(conversation, e, json_response=True)
+        priority = await sync_to_async(user_priority)(user)
+        # Each model gets an equal share of what the conversation has left after the message
+        for run in runs:
+            budget = await sync_to_async(completion_budget)(
+                run.service, conversation, persona, messages, reserved=user_msg_tokens, share=len(runs)
+            )
+            run.max_tokens = min(budget.max_tokens, settings.LLM_COMPARE_MAX_TOKENS)
+        
+        async def event_stream():
+            yield sse_event({'type': 'start', 'conversation_id': conversation.id, 'models': models})
+            try:
+                async for event in compare_stream(runs, messages, user.id, priority, deadline,
+                                                  disconnected=_disconnect_event(request)):
+                    yield sse_event(event)
+            finally:
+                # Partial answers of cancelled models are charged too
+                tokens = user_msg_tokens + sum(run.completion_tokens for run in runs)
+                conversation_data = await sync_to_async(_charge_comparison)(conversation, tokens)
+            yield sse_event({
+                'type': 'done',
+                'conversation': conversation_data,
+                'token_usage': token_usage(conversation),
+                'results': {
+                    run.model: {'error': run.error} if run.error else run.stats()
+                    for run in runs
+                },
+            })
+        
+        return _sse_response(event_stream())
+
+
+def _charge_comparison(conversation, tokens):
+    """Charge a comparison's tokens to its conversation. Returns the serialized conversation."""
+    try:
+        conversation.charge(tokens)
+    except Exception as e:
+        logger.error(f"Failed to charge comparison tokens to conversation {conversation.id}: {e}")
+    return ConversationSerializer(conversation).data
+
+
+async def _abandon_stream(assistant_msg, partial_text, ai_service):
+    """Keep a partial answer as a truncated message; drop the placeholder if nothing arrived."""
+    try:
+        if partial_text:
+            await sync_to_async(assistant_msg.finalize)(
+                partial_text, ai_service.count_tokens(partial_text), status='truncated'
+            )
+        else:
+            await Message.objects.filter(id=assistant_msg.id, status='streaming').adelete()
+    except Exception as e:
+        logger.error(f"Failed to persist interrupted stream {assistant_msg.id}: {e}")
+
+
+async def _replay_session(session, last_event_id, disconnected):
+    """Events after last_event_id from this worker's session, then the live ones."""
+    async for seq, payload in session.subscribe(after=last_event_id, disconnected=disconnected):
+        yield sse_event(payload, seq)
+
+
+async def _follow_checkpoints(message):
+    """Stream a message from its database checkpoints (resume on a worker without the session)."""
+    interval = getattr(settings, 'LLM_STREAM_CHECKPOINT_INTERVAL', 1.0)
+    stale_after = getattr(settings, 'LLM_STREAM_STALE_AFTER', 30)
+    
+    sent = message.content
+    yield sse_event({'type': 'snapshot', 'message_id': message.id, 'content': sent})
+    last_change = time.monotonic()
+    
+    while message.status == 'streaming':
+        if time.monotonic() - last_change > stale_after:
+            yield sse_event({'type': 'error', 'message': 'The response was interrupted. Please try again.'})
+            return
+        await asyncio.sleep(interval)
+        try:
+            message = await Message.objects.select_related('conversation').aget(id=message.id)
+        except Message.DoesNotExist:
+            yield sse_event({'type': 'error', 'message': 'The response was interrupted. Please try again.'})
+            return
+        if message.content != sent:
+            if message.content.startswith(sent):
+                yield sse_event({'type': 'token', 'content': message.content[len(sent):]})
+            else:
+                yield sse_event({'type': 'snapshot', 'message_id': message.id, 'content': message.content})
+            sent = message.content
+            last_change = time.monotonic()
+    
+    user_msg = await message.conversation.messages.filter(
+        role='user', created_at__lte=message.created_at
+    ).order_by('-created_at', '-id').afirst()
+    yield sse_event(await sync_to_async(_done_payload)(user_msg, message, message.conversation))
 
 
 class TokenUsageView(APIView):
@@ -505,6 +802,60 @@ class TokenUsageView(APIView):
         })
 
 
+class UsageSummaryView(APIView):
+    """
+    The user's upstream usage from the ledger, per model: calls, tokens, cost
+    and latency over the last `days` (default 30, optionally one conversation).
+    """
+    
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request):
+        try:
+            days = min(max(int(request.query_params.get('days', 30)), 1), 365)
+            conversation_id = int(request.query_params.get('conversation_id') or 0)
+        except ValueError:
+            return Response({
+                'success': False,
+                'error': 'days and conversation_id must be numbers'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        records = UsageRecord.objects.filter(
+            user=request.user, created_at__gte=timezone.now() - timedelta(days=days)
+        )
+        if conversation_id:
+            records = records.filter(conversation_id=conversation_id)
+        
+        by_model = list(
+            records.values('model').annotate(
+                calls=Count('id'),
+                failed=Count('id', filter=Q(status__in=('error', 'rate_limited'))),
+                fallbacks=Count('id', filter=Q(status='ok', fallback_depth__gt=0)),
+                prompt_tokens=Sum('prompt_tokens'),
+                completion_tokens=Sum('completion_tokens'),
+                cached_tokens=Sum('cached_tokens'),
+                cost=Sum('cost'),
+                avg_latency_ms=Avg('latency_ms', filter=Q(status='ok')),
+                avg_ttft_ms=Avg('ttft_ms', filter=Q(status='ok')),
+            ).order_by('-calls')
+        )
+        for row in by_model:
+            for field in ('avg_latency_ms', 'avg_ttft_ms'):
+                row[field] = round(row[field]) if row[field] is not None else None
+        
+        return Response({
+            'success': True,
+            'days': days,
+            'totals': {
+                'calls': sum(row['calls'] for row in by_model),
+                'prompt_tokens': sum(row['prompt_tokens'] or 0 for row in by_model),
+                'completion_tokens': sum(row['completion_tokens'] or 0 for row in by_model),
+                'cost': sum((row['cost'] for row in by_model if row['cost'] is not None), Decimal(0)),
+            },
+            'models': by_model,
+        })
+
+
 class ClearConversationView(APIView):
     """Clear all messages in a conversation."""
     
@@ -517,12 +868,14 @@ class ClearConversationView(APIView):
             user=request.user
         )
         
-        # Delete all messages
-        conversation.messages.all().delete()
-        
-        # Reset token count
-        conversation.total_tokens_used = 0
-        conversation.save(update_fields=['total_tokens_used'])
+        with transaction.atomic():
+            # Delete all messages
+            conversation.messages.all().delete()
+            
+            # Reset token count
+            conversation.total_tokens_used = 0
+            conversation.save(update_fields=['total_tokens_used'])
+            conversation.reset_summary()
         
         return Response({
             'success': True,
@@ -532,57 +885,267 @@ class ClearConversationView(APIView):
 
 
 class AvailableModelsView(APIView):
-    """Fetch available AI models from OpenRouter + featured models."""
+    """
+    The shared model catalog (see chat.catalog), with optional server-side filters:
+    provider (comma-separated), free (true/false), min_context, q (fuzzy name search)
+    and page / page_size. Without page_size the whole filtered list is returned.
+    Responses carry an ETag; a matching If-None-Match gets 304 Not Modified.
+    """
     permission_classes = [IsAuthenticated]
 
-    # Simple in-memory cache (refreshes every 10 minutes)
-    _cache = None
-    _cache_time = None
+    MAX_PAGE_SIZE = 200
 
     def get(self, request):
-        import time
-        now = time.time()
+        params = request.query_params
+        try:
+            min_context = int(params['min_context']) if params.get('min_context') else None
+            page = max(1, int(params.get('page', 1)))
+            page_size = min(self.MAX_PAGE_SIZE, max(1, int(params['page_size']))) if params.get('page_size') else None
+        except ValueError:
+            return Response({
+                'success': False,
+                'message': 'min_context, page and page_size must be integers'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        catalog = model_catalog.get()
 
-        # Return cached data if fresh (10 min)
-        if AvailableModelsView._cache and AvailableModelsView._cache_time and (now - AvailableModelsView._cache_time < 600):
-            return Response({'success': True, 'models': AvailableModelsView._cache})
+        # Same catalog version and same query: the client's copy is still good
+        query = '&'.join(f'{key}={value}' for key, value in sorted(params.items()))
+        etag = f'W/"{catalog.etag}-{hashlib.sha1(query.encode("utf-8")).hexdigest()[:8]}"'
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
-        openrouter_key = getattr(settings, 'OPENROUTER_API_KEY', '')
+        free = params.get('free', '').lower()
+        models = search(
+            catalog.models,
+            provider={p.strip() for p in params.get('provider', '').split(',') if p.strip()},
+            free={'true': True, '1': True, 'false': False, '0': False}.get(free),
+            min_context=min_context,
+            query=params.get('q', '').strip(),
+        )
+
+        total = len(models)
+        if page_size:
+            models = models[(page - 1) * page_size:page * page_size]
+
+        return Response({
+            'success': True,
+            'models': models,
+            'source': catalog.source,
+            'total': total,
+            'page': page if page_size else 1,
+            'has_more': bool(page_size) and page * page_size < total,
+        }, headers=headers)
 
-        if openrouter_key:
-            # Fetch full model list from OpenRouter
-            all_models = OpenRouterProvider.fetch_available_models()
 
-            # Mark featured models
-            featured_ids = {m['id'] for m in AIServiceFactory.FEATURED_MODELS}
-            for model in all_models:
-                model['featured'] = model['id'] in featured_ids
+class BatchJobListCreateView(APIView):
+    """
+    List the user's batch jobs, or submit one: a JSONL of prompts (as `input` or
+    an uploaded `file`) for one model, optionally applied to a PromptTemplate.
+    Results are added to the given conversation (or a new one) as messages and charged to it.
+    """
+    permission_classes = [IsAuthenticated]
 
-            # Sort: featured first, then by provider, then by name
-            all_models.sort(key=lambda m: (not m.get('featured', False), m.get('provider', 'zzz'), m.get('name', '')))
+    def get(self, request):
+        jobs = BatchJob.objects.filter(user=request.user)[:50]
+        return Response({
+            'success': True,
+            'batches': BatchJobSerializer(jobs, many=True).data
+        })
 
-            AvailableModelsView._cache = all_models
-            AvailableModelsView._cache_time = now
+    def post(self, request):
+        from prompts.models import PromptTemplate
 
+        serializer = CreateBatchJobSerializer(data=request.data)
+        if not serializer.is_valid():
             return Response({
-                'success': True,
-                'models': all_models,
-                'source': 'openrouter',
-                'total': len(all_models),
-            })
+                'success': False,
+                'errors': serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+
+        upload = request.FILES.get('file')
+        try:
+            text = upload.read().decode('utf-8') if upload else data.get('input', '')
+        except UnicodeDecodeError:
+            return Response({'success': False, 'message': 'The file must be UTF-8 encoded JSONL.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        template = None
+        if data.get('prompt_template_id'):
+            template = PromptTemplate.objects.filter(
+                Q(id=data['prompt_template_id']),
+                Q(user=request.user) | Q(is_public=True) | Q(is_system=True)
+            ).first()
+            if template is None:
+                return Response({'success': False, 'message': 'Prompt not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            prompts = parse_batch_prompts(text, template)
+        except ValueError as e:
+            return Response({'success': False, 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        max_items = settings.LLM_BATCH_MAX_ITEMS
+        if not prompts or len(prompts) > max_items:
+            return Response({
+                'success': False,
+                'message': f'A batch needs between 1 and {max_items} prompts.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        if data.get('conversation_id'):
+            conversation = get_object_or_404(Conversation, id=data['conversation_id'], user=request.user)
         else:
-            # Fallback: return legacy hardcoded models
-            legacy_models = [
-                {'id': 'gemini-flash-latest', 'name': 'Gemini 1.5 Flash', 'provider': 'gemini'},
-                {'id': 'gemini-pro-latest', 'name': 'Gemini 1.5 Pro', 'provider': 'gemini'},
-                {'id': 'gemini-2.0-flash', 'name': 'Gemini 2.0 Flash', 'provider': 'gemini'},
-                {'id': 'claude-3-5-sonnet-20240620', 'name': 'Claude 3.5 Sonnet', 'provider': 'anthropic'},
-                {'id': 'gpt-4o', 'name': 'GPT-4o', 'provider': 'openai'},
-                {'id': 'gpt-3.5-turbo', 'name': 'GPT-3.5 Turbo', 'provider': 'openai'},
-            ]
+            conversation = Conversation.objects.create(user=request.user, title=f'Batch: {len(prompts)} prompts')
+
+        # The prompts alone must fit the budget; answers are checked item by item as the job runs
+        ai_service = AIServiceFactory.get_service('openrouter', data['model'])
+        if not conversation.can_send_message(sum(ai_service.count_tokens(prompt) for _, prompt in prompts)):
             return Response({
-                'success': True,
-                'models': legacy_models,
-                'source': 'legacy',
-                'total': len(legacy_models),
-            })
\ No newline at end of file
+                'success': False,
+                'error': 'token_limit_exceeded',
+                'message': 'Token limit reached. Please make a payment to continue.',
+                'token_usage': token_usage(conversation)
+            }, status=status.HTTP_402_PAYMENT_REQUIRED)
+
+        with transaction.atomic():
+            job = BatchJob.objects.create(
+                user=request.user,
+                conversation=conversation,
+                prompt_template=template,
+                model=data['model'],
+                system_prompt=data.get('system_prompt', ''),
+                max_tokens=data['max_tokens'],
+                total_items=len(prompts),
+            )
+            BatchItem.objects.bulk_create(
+                [BatchItem(job=job, index=index, input=value, prompt=prompt)
+                 for index, (value, prompt) in enumerate(prompts)],
+                batch_size=500,
+            )
+            if template is not None:
+                PromptTemplate.objects.filter(id=template.id).update(usage_count=F('usage_count') + 1)
+            transaction.on_commit(lambda: batch_runner.enqueue(job.id))
+
+        return Response({
+            'success': True,
+            'batch': BatchJobSerializer(job).data
+        }, status=status.HTTP_201_CREATED)
+
+
+class BatchJobDetailView(APIView):
+    """Progress of a batch job (`stalled` once its worker went away, see BatchJobResumeView)."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        job = get_object_or_404(BatchJob, id=pk, user=request.user)
+        return Response({
+            'success': True,
+            'batch': BatchJobSerializer(job).data
+        })
+
+
+class BatchJobResultsView(APIView):
+    """Stream a batch job's items as JSONL, in input order (finished or not)."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        job = get_object_or_404(BatchJob, id=pk, user=request.user)
+        response = StreamingHttpResponse(_batch_results(job), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="batch-{job.id}.jsonl"'
+        return response
+
+
+def _batch_results(job):
+    for item in job.items.order_by('index').iterator(chunk_size=200):
+        yield json.dumps({
+            'index': item.index,
+            'input': item.input,
+            'status': item.status,
+            'output': item.output,
+            'error': item.error or None,
+            'usage': {'prompt_tokens': item.prompt_tokens, 'completion_tokens': item.completion_tokens},
+        }) + '\n'
+
+
+class BatchJobCancelView(APIView):
+    """Cancel a batch job: items not started yet are skipped, running ones finish."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk):
+        job = get_object_or_404(BatchJob, id=pk, user=request.user)
+        if job.is_active:
+            BatchJob.objects.filter(id=job.id).update(status='cancelled', finished_at=timezone.now())
+            job.items.filter(status='pending').update(status='cancelled')
+            job.refresh_from_db()
+        return Response({
+            'success': True,
+            'batch': BatchJobSerializer(job).data
+        })
+
+
+class BatchJobResumeView(APIView):
+    """Pick up a stalled batch job in this worker (a job that is still running is left alone)."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk):
+        job = get_object_or_404(BatchJob, id=pk, user=request.user)
+        if job.is_stalled:
+            logger.info(f"Batch job {job.id} stalled, picking it up in this worker")
+            batch_runner.enqueue(job.id)
+        return Response({
+            'success': True,
+            'batch': BatchJobSerializer(job).data
+        })
+
+
+def _admin_required_response(user):
+    """403 response for non-admin users, or None if the user is an admin."""
+    if user.is_admin or user.email == settings.ADMIN_EMAIL:
+        return None
+    return Response({
+        'success': False,
+        'message': 'Admin access required'
+    }, status=status.HTTP_403_FORBIDDEN)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint (bearer METRICS_TOKEN required; not served without one)."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if not token:
+        return HttpResponse(status=404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE_LATEST)
+
+
+class UpstreamPoolStatsView(APIView):
+    """Connection pool statistics for the upstream OpenRouter clients (admin only)."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        denied = _admin_required_response(request.user)
+        if denied:
+            return denied
+
+        return Response({
+            'success': True,
+            'pool': clients.pool_stats(),
+            'response_cache': response_cache.stats(),
+            'streams': stream_stats.snapshot(),
+            'scheduler': scheduler.stats(),
+        })
+
+
+class ModelHealthView(APIView):
+    """Per-model health and circuit breaker state (admin only)."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        denied = _admin_required_response(request.user)
+        if denied:
+            return denied
+
+        return Response({
+            'success': True,
+            'models': model_health.snapshot(),
+            'prompt_cache': prompt_cache_stats.snapshot(),
+        })
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings (loaded automatically from the working directory).
+
+With PROMETHEUS_MULTIPROC_DIR set, workers share their metrics through files
+in that directory (see chat.metrics); the hooks below keep it consistent.
+"""
+import os
+import shutil
+
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+
+def on_starting(server):
+    """Start from an empty metrics directory (old files would be counted again)."""
+    if MULTIPROC_DIR:
+        shutil.rmtree(MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drop a dead worker's live gauges."""
+    if not MULTIPROC_DIR:
+        return
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid, MULTIPROC_DIR)
@@ -54,4 +54,8 @@ class Payment(models.Model):
         # Add tokens to conversation
         self.conversation.add_tokens(self.tokens_added)
         
+        # Paying users get the priority upstream tier from now on
+        from chat.scheduler import forget_user_priority
+        forget_user_priority(self.user_id)
+        
         return True
\ No newline at end of file
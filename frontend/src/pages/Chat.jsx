@@ -165,68 +165,123 @@ const Chat = () => {
         return;
       }
 
-      // Read the SSE stream
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
-      let buffer = '';
       let fullContent = '';
+      let streamMessageId = null;
+      let lastEventId = 0;
+      let finished = false;
+
+      const handleEvent = (event) => {
+        if (event.type === 'start') {
+          // Assistant message id: lets us resume the stream if the connection drops
+          streamMessageId = event.message_id;
+        } else if (event.type === 'token' || event.type === 'snapshot') {
+          // Append token to the streaming message (a snapshot replaces it after a resume)
+          fullContent = event.type === 'token' ? fullContent + event.content : event.content;
+          setMessages((prev) =>
+            prev.map((m) =>
+              m.id === tempAssistantMsg.id
+                ? { ...m, content: fullContent }
+                : m
+            )
+          );
+        } else if (event.type === 'done' || event.type === 'budget_exhausted') {
+          finished = true;
+          if (event.type === 'budget_exhausted') {
+            // The answer was cut off because the conversation ran out of tokens
+            toast.error(event.message || 'Token limit reached. Please top up to continue.');
+          }
+          // Stream complete — replace temp messages with real ones
+          setMessages((prev) => {
+            const filtered = prev.filter(
+              (m) => m.id !== tempUserMsg.id && m.id !== tempAssistantMsg.id
+            );
+            return [...filtered, event.user_message, event.assistant_message];
+          });
+          setConversation(event.conversation);
+          setTokenUsage(event.token_usage);
+
+          if (!conversationId && event.conversation?.id) {
+            navigate(`/chat/${event.conversation.id}`, { replace: true });
+          }
+          setRefreshSidebar((prev) => prev + 1);
+        } else if (event.type === 'title') {
+          // Title is generated in the background and pushed after 'done'
+          setConversation((prev) =>
+            prev && prev.id === event.conversation_id ? { ...prev, title: event.title } : prev
+          );
+          setRefreshSidebar((prev) => prev + 1);
+        } else if (event.type === 'error') {
+          finished = true;
+          toast.error(event.message || 'AI generation failed');
+          // Keep the partial response if any content was streamed
+          if (!fullContent) {
+            setMessages((prev) =>
+              prev.filter((m) => m.id !== tempUserMsg.id && m.id !== tempAssistantMsg.id)
+            );
+          }
+        }
+      };
+
+      // Read an SSE stream, remembering the last event id
+      const readStream = async (res) => {
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+
+          buffer += decoder.decode(value, { stream: true });
+
+          // Parse SSE events from buffer
+          const lines = buffer.split('\n');
+          buffer = lines.pop(); // Keep incomplete line in buffer
 
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-
-        buffer += decoder.decode(value, { stream: true });
-
-        // Parse SSE events from buffer
-        const lines = buffer.split('\n');
-        buffer = lines.pop(); // Keep incomplete line in buffer
-
-        for (const line of lines) {
-          if (!line.startsWith('data: ')) continue;
-          const jsonStr = line.slice(6).trim();
-          if (!jsonStr) continue;
-
-          try {
-            const event = JSON.parse(jsonStr);
-
-            if (event.type === 'token') {
-              // Append token to the streaming message
-              fullContent += event.content;
-              setMessages((prev) =>
-                prev.map((m) =>
-                  m.id === tempAssistantMsg.id
-                    ? { ...m, content: fullContent }
-                    : m
-                )
-              );
-            } else if (event.type === 'done') {
-              // Stream complete — replace temp messages with real ones
-              setMessages((prev) => {
-                const filtered = prev.filter(
-                  (m) => m.id !== tempUserMsg.id && m.id !== tempAssistantMsg.id
-                );
-                return [...filtered, event.user_message, event.assistant_message];
-              });
-              setConversation(event.conversation);
-              setTokenUsage(event.token_usage);
-
-              if (!conversationId && event.conversation?.id) {
-                navigate(`/chat/${event.conversation.id}`, { replace: true });
-              }
-              setRefreshSidebar((prev) => prev + 1);
-            } else if (event.type === 'error') {
-              toast.error(event.message || 'AI generation failed');
-              // Keep the partial response if any content was streamed
-              if (!fullContent) {
-                setMessages((prev) =>
-                  prev.filter((m) => m.id !== tempUserMsg.id && m.id !== tempAssistantMsg.id)
-                );
-              }
+          for (const line of lines) {
+            if (line.startsWith('id: ')) {
+              lastEventId = Number(line.slice(4)) || lastEventId;
+              continue;
+            }
+            if (!line.startsWith('data: ')) continue;
+            const jsonStr = line.slice(6).trim();
+            if (!jsonStr) continue;
+
+            try {
+              handleEvent(JSON.parse(jsonStr));
+            } catch (parseErr) {
+              // Skip malformed SSE events
             }
-          } catch (parseErr) {
-            // Skip malformed SSE events
           }
         }
+      };
+
+      try {
+        await readStream(response);
+      } catch (readErr) {
+        console.warn('Stream interrupted:', readErr);
+      }
+
+      // Connection dropped before the answer finished: resume from the last event
+      for (let attempt = 1; !finished && streamMessageId && attempt <= 3; attempt++) {
+        await new Promise((resolve) => setTimeout(resolve, 1000 * attempt));
+        try {
+          const resumed = await fetch(`${apiUrl}/chat/stream/${streamMessageId}/resume/`, {
+            method: 'POST',
+            headers: {
+              'Authorization': `Bearer ${tokens?.access}`,
+              'Last-Event-ID': String(lastEventId),
+            },
+          });
+          if (resumed.ok) {
+            await readStream(resumed);
+          }
+        } catch (resumeErr) {
+          console.warn('Resume failed:', resumeErr);
+        }
+      }
+      if (!finished) {
+        throw new Error('Stream ended before completion');
       }
     } catch (err) {
       console.error('Stream error:', err);